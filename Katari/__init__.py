@@ -11,13 +11,32 @@ SIP (Session Initiated Protocol) Application Framework
 
 """
 import sys
+import time
+import asyncio
+import inspect
+import contextvars
+from logging import DEBUG, INFO
+from Katari.server import WorkerSupervisor
+from Katari.server.admission import AdmissionControl
+from Katari.server.fastpath import FastPath
 from Katari.server.udp import UDPSipServer
-from Katari.logging import KatariLogging
+from Katari.server.tcp import TCPSipServer
+from Katari.server.tls import TLSSipServer, create_server_context
+from Katari.logging import KatariLogging, AccessLog
+from Katari.metrics import get_metrics, start_metrics_server
+from Katari.profiling import profile_settings, start_profiler
+from Katari.registrar import start_snapshots
 from Katari.sip import SipMessage
+from Katari.sip.utils import set_uri_cache_size
+from Katari.sip.transaction import TransactionLayer, top_via
 from Katari.sip.response._4xx import MethodNotAllowed405
-from Katari.sip.response import NullMessage, Ack
-from Katari.errors import NoSettingsFound
-from Katari.middleware import MiddlewareLoader
+from Katari.sip.response import ResponseFactory
+from Katari.errors import StopProcessing
+from Katari.middleware import MiddlewareLoader, MiddlewareChain
+
+
+# Admission slot of the message being handled, tasks it schedules inherit it
+_admission_slot = contextvars.ContextVar("katari_admission_slot", default=None)
 
 
 class KatariApplication(UDPSipServer):
@@ -33,15 +52,44 @@ class KatariApplication(UDPSipServer):
             self.settings = settings
 
 
-        UDPSipServer.settings = settings
+        UDPSipServer.settings = self.settings
+        UDPSipServer.compile_acl()
+        set_uri_cache_size(getattr(self.settings, "URI_CACHE_SIZE", 1024))
 
-        self.loggerinit = KatariLogging(filename=self.settings.KATARI_LOGGING['LOGFILE'], output_mode=self.settings.KATARI_LOGGING['OUTPUTMODE'])
+        logging_settings = self.settings.KATARI_LOGGING
+        self.loggerinit = KatariLogging(
+            filename=logging_settings['LOGFILE'], output_mode=logging_settings['OUTPUTMODE'],
+            level=logging_settings.get('LEVEL', DEBUG), queued=logging_settings.get('QUEUED', False)
+        )
         self.logger = self.loggerinit.get_logger()
+        self.access_log = None
+        if logging_settings.get('ACCESS_LOG'):
+            self.access_log = AccessLog(
+                logging_settings['ACCESS_LOG'], logging_settings.get('ACCESS_LOG_FORMAT', "json"),
+                queued=logging_settings.get('QUEUED', False)
+            )
         self._copy = False
-        self.socket = None
-        self.client = None
+        self.loop = None
+        # Senders by Via transport name, filled in by the servers as they start
+        self.transports = {}
+        self.tls_context = None
+        self.transactions = TransactionLayer() if getattr(self.settings, "TRANSACTIONS", True) else None
+        self.metrics = None
+        self.metrics_server = None
+        self.profile = None
+        self.profiler = None
+        self.admission = AdmissionControl.from_settings(self.settings)
+        self.fast_path = FastPath.from_settings(self.settings)
+        if (getattr(self.settings, "METRICS", None) or {}).get("ENABLED", False):
+            self.metrics = get_metrics()
+            if self.transactions is not None:
+                self.metrics.add_collector(self._transaction_metrics)
+            if self.admission is not None:
+                self.metrics.add_collector(self.admission.metrics)
+            self.metrics.add_collector(self.fast_path.metrics)
 
         self.middleware_array = None
+        self.middleware = None
 
         self.load_middleware()
 
@@ -49,7 +97,7 @@ class KatariApplication(UDPSipServer):
             "INVITE": self.default_response,
             "ACK": self.null_response,
             "BYE": self.default_response,
-            "CANCEL": self.ack,
+            "CANCEL": self.cancel_response,
             "REGISTER": self.default_response,
             "OPTIONS": self.default_response,
             "PRACK": self.default_response,
@@ -60,155 +108,450 @@ class KatariApplication(UDPSipServer):
             "REFER": self.default_response,
             "MESSAGE": self.default_response,
             "UPDATE": self.default_response,
-            "RESPONSE": self.default_response,
+            "RESPONSE": self.drop_response,
         }
+        self.configure_responses()
 
-    def register(self):
+    def route(self, method):
+        """
+        Registers the decorated function as the handler for a SIP method,
+        "RESPONSE" handles responses
+
+        :param method:
+        :return:
+        """
         def decorator(f):
-            self.method_endpoint_register["REGISTER"] = f
+            self.method_endpoint_register[method.upper()] = f
             return f
         return decorator
 
+    def register(self):
+        return self.route("REGISTER")
+
     def ack(self):
-        def decorator(f):
-            self.method_endpoint_register["ACK"] = f
-            return f
+        return self.route("ACK")
 
-        return decorator
+    def bye(self):
+        return self.route("BYE")
 
     def cancel(self):
-        def decorator(f):
-            self.method_endpoint_register["CANCEL"] = f
-            return f
-
-        return decorator
+        return self.route("CANCEL")
 
     def invite(self):
-        def decorator(f):
-            self.method_endpoint_register["INVITE"] = f
-            return f
-
-        return decorator
+        return self.route("INVITE")
 
     def options(self):
-        def decorator(f):
-            self.method_endpoint_register["OPTIONS"] = f
-            return f
+        return self.route("OPTIONS")
 
-        return decorator
+    def prack(self):
+        return self.route("PRACK")
 
     def subscribe(self):
-        def decorator(f):
-            self.method_endpoint_register["SUBSCRIBE"] = f
-            return f
+        return self.route("SUBSCRIBE")
 
-        return decorator
+    def notify(self):
+        return self.route("NOTIFY")
+
+    def publish(self):
+        return self.route("PUBLISH")
 
     def info(self):
-        def decorator(f):
-            self.method_endpoint_register["INFO"] = f
-            return f
+        return self.route("INFO")
 
-        return decorator
+    def refer(self):
+        return self.route("REFER")
 
+    def message(self):
+        return self.route("MESSAGE")
 
-    def status_response(self):
-        def decorator(f):
-            self.method_endpoint_register["RESPONSE"] = f
-            return f
-        return decorator
+    def update(self):
+        return self.route("UPDATE")
 
-
-    def run(self):
+    def status_response(self):
+        return self.route("RESPONSE")
+
+    def run(self, workers=None, profile=None):
+        """
+        Starts the server, with more than one worker the application is
+        forked into supervised processes sharing HOST:PORT via SO_REUSEPORT
+
+        :param workers: defaults to WORKERS in settings
+        :param profile: directory for sampled stacks, or a dict like KATARI_PROFILE
+        :return:
+        """
+        self.profile = profile_settings(self.settings, profile)
+        if workers is None:
+            workers = getattr(self.settings, "WORKERS", 1)
+        if getattr(self.settings, "TLS", False) and self.tls_context is None:
+            # Before forking, so every worker resumes sessions from the same ticket keys
+            self.tls_context = create_server_context(self.settings)
+        if workers > 1:
+            self.logger.info(
+                "Starting {} workers on {}:{}".format(
+                    workers, self.settings.HOST, self.settings.PORT
+                )
+            )
+            UDPSipServer.reuse_port = True
+            WorkerSupervisor(self._serve, workers).run()
+        else:
+            self._serve()
+
+    def _serve(self):
+        self.configure_responses()
+        self.start_metrics()
+        snapshot = start_snapshots()
+        if snapshot is not None:
+            self.logger.info("Writing registrar snapshots to {}".format(snapshot))
+        if self.profile is not None:
+            # Started in each worker, a sampling thread doesn't survive fork
+            self.profiler = start_profiler(self.profile)
+            self.logger.info("Writing profiles to {}".format(self.profile["DIRECTORY"]))
         try:
             self.logger.info(
                 "Starting Server on {}:{}".format(
                     self.settings.HOST, self.settings.PORT
                 )
             )
+            if getattr(self.settings, "TCP", False):
+                TCPSipServer.start_background(
+                    (self.settings.HOST, getattr(self.settings, "TCP_PORT", None) or self.settings.PORT), self
+                )
+            if getattr(self.settings, "TLS", False):
+                TLSSipServer.start_background(
+                    (self.settings.HOST, getattr(self.settings, "TLS_PORT", 5061)), self
+                )
             KatariApplication.start(
                 (self.settings.HOST, self.settings.PORT), self
             )
         except KeyboardInterrupt:
             self.logger.info("Stopping Server")
             sys.exit()
+        finally:
+            if self.profiler is not None:
+                self.profiler.stop()
+
+    def reload_acl(self, allowed=None, denied=None):
+        """
+        Recompiles the access list while the server runs, from the given
+        lists or from ALLOWED_HOSTS and DENIED_HOSTS in settings
+
+        :param allowed: addresses and CIDR ranges
+        :param denied: addresses and CIDR ranges
+        :return:
+        """
+        if allowed is None:
+            allowed = getattr(self.settings, "ALLOWED_HOSTS", ())
+        if denied is None:
+            denied = getattr(self.settings, "DENIED_HOSTS", ())
+        if UDPSipServer.acl_settings is not UDPSipServer.settings:
+            UDPSipServer.compile_acl()
+        UDPSipServer.acl.reload(allowed, denied)
+        self.logger.info("Access list reloaded, {} allowed {} denied".format(len(allowed), len(denied)))
+
+    def admit(self, datagram, client):
+        """
+        Admission check done by the servers before a message is parsed,
+        every admitted message is handed to _run_admitted, which frees it
+
+        :param datagram: raw message
+        :param client: RequestContext
+        :return: False when the message was turned away
+        """
+        return self.admission is None or self.admission.admit(datagram, client)
+
+    def _run_admitted(self, datagram, client):
+        """
+        Parses and handles an admitted message, its admission slot is freed
+        once the message and any async middleware or handler it scheduled
+        are done
+
+        :param datagram: raw message
+        :param client: RequestContext
+        :return:
+        """
+        if self.admission is None:
+            self._server_run(SipMessage(datagram), client)
+            return
+        slot = self.admission.slot()
+        token = _admission_slot.set(slot)
+        try:
+            self._server_run(SipMessage(datagram), client)
+        finally:
+            _admission_slot.reset(token)
+            slot.done()
 
     def _server_run(self, message, client):
-        message, client = self.run_middleware_request(message, client)
-        if message.sip_type == "REGISTER":
-            try:
-                self.logger.info(
-                    "Received REGISTER request from {} ".format(client[0])
-                )
-                self.logger.debug("\n\n" + message.export())
-                self.method_endpoint_register["REGISTER"](message, client)
-            except Exception as err:
-                self.logger.error(err)
-        elif message.sip_type == "INVITE":
-            try:
-                self.logger.info("Received INVITE from {} ".format(client[0]))
-                self.logger.debug("\n\n" + message.export())
-                self.method_endpoint_register["INVITE"](message, client)
-            except Exception as err:
-                self.logger.error(err)
-        elif message.sip_type == "OPTIONS":
-            try:
-                self.logger.info("Received OPTIONS from {} ".format(client[0]))
-                self.logger.debug("\n\n" + message.export())
-                self.method_endpoint_register["OPTIONS"](message, client)
-            except Exception as err:
-                self.logger.error(err)
-        elif message.sip_type == "CANCEL":
-            try:
-                self.logger.info("Received CANCEL from {} ".format(client[0]))
-                self.logger.debug("\n\n" + message.export())
-                self.method_endpoint_register["CANCEL"](message, client)
-            except Exception as err:
-                self.logger.error(err)
-        elif message.sip_type == "ACK":
-            self.logger.info("Received Ack from {} ".format(client[0]))
+        if self.transactions is not None and self.transactions.receive(message, client, self._socket(client)):
+            return
+        try:
+            result = self.middleware.request(message, client)
+        except StopProcessing as stop:
+            if self.metrics is not None:
+                self.metrics.inc("katari_middleware_stopped_total")
+            self._stopped(stop, client)
+            return
+        if result.__class__ is not tuple:
+            # An async middleware hook, the rest runs on the event loop
+            self._schedule(self._dispatch_async(result, client))
+            return
+        self._dispatch(*result)
+
+    async def _dispatch_async(self, pending, client):
+        try:
+            message, client = await pending
+        except StopProcessing as stop:
+            if self.metrics is not None:
+                self.metrics.inc("katari_middleware_stopped_total")
+            self._stopped(stop, client)
+            return
+        self._dispatch(message, client)
+
+    def _stopped(self, stop, client):
+        if stop.response is not None:
+            self.send(stop.response, client)
+
+    def _dispatch(self, message, client):
+        sip_type = getattr(message, "sip_type", None)
+        if sip_type is None:
+            if self.metrics is not None:
+                self.metrics.inc("katari_parse_errors_total")
+            self.logger.error("Unable to parse message from {}".format(client[0]))
+            return
+        try:
+            handler = self.method_endpoint_register[sip_type]
+        except KeyError:
+            if sip_type.startswith("SIP/"):
+                handler = self.method_endpoint_register["RESPONSE"]
+            else:
+                handler = self.not_implemented
+        if self.logger.isEnabledFor(DEBUG):
+            self.logger.debug("Received {} from {}\n\n{}".format(
+                sip_type, client[0], message.export()))
+        elif self.logger.isEnabledFor(INFO):
+            self.logger.info("Received {} from {} ".format(sip_type, client[0]))
+        if self.access_log is not None:
+            via = top_via(message)
+            self.access_log.record("in", message, client, via.transport if via is not None else None)
+        if self.metrics is not None:
+            self._call_measured(handler, message, client, sip_type)
+            return
+        try:
+            self._call_handler(handler, message, client)
+        except Exception as err:
+            self.logger.error(err)
+
+    def _call_measured(self, handler, message, client, sip_type):
+        if sip_type.startswith("SIP/"):
+            sip_type = "RESPONSE"
+        elif handler == self.not_implemented:
+            # Keeps unknown method names out of the label values
+            sip_type = "OTHER"
+        labels = (("method", sip_type),)
+        metrics = self.metrics
+        metrics.inc("katari_messages_received_total", labels)
+        start = time.perf_counter()
+        try:
+            result = handler(message, client)
+        except Exception as err:
+            metrics.inc("katari_handler_errors_total", labels)
+            self.logger.error(err)
+            return
+        if inspect.isawaitable(result):
+            self._schedule(self._measure_async(result, labels, start))
+            return
+        metrics.observe("katari_handler_seconds", labels, time.perf_counter() - start)
+
+    async def _measure_async(self, coroutine, labels, start):
+        try:
+            await coroutine
+        except Exception:
+            self.metrics.inc("katari_handler_errors_total", labels)
+            raise
+        finally:
+            self.metrics.observe("katari_handler_seconds", labels, time.perf_counter() - start)
+
+    def start_metrics(self):
+        """
+        Serves metrics over HTTP, or on a Unix socket, when METRICS is enabled
+
+        :return:
+        """
+        if self.metrics is None or self.metrics_server is not None:
+            return
+        config = self.settings.METRICS
+        self.metrics_server = start_metrics_server(
+            self.metrics, config.get("HOST", "127.0.0.1"), config.get("PORT", 9091), config.get("SOCKET")
+        )
+
+    def _transaction_metrics(self):
+        return [
+            ("katari_transactions", "gauge", (), len(self.transactions)),
+            ("katari_retransmissions_absorbed_total", "counter", (), self.transactions.absorbed),
+        ]
+
+    def configure_responses(self):
+        """
+        Renders USER_AGENT and the methods with a handler into the
+        response templates
+
+        :return:
+        """
+        ResponseFactory.configure(
+            user_agent=getattr(self.settings, "USER_AGENT", None),
+            allow=[
+                method for method, handler in self.method_endpoint_register.items()
+                if method != "RESPONSE" and handler != self.default_response
+            ],
+        )
+
+    def _call_handler(self, handler, message, client):
+        """
+        Calls the handler, coroutines returned by async def handlers are
+        scheduled on the application event loop
+
+        :param handler:
+        :param message:
+        :param client:
+        :return:
+        """
+        result = handler(message, client)
+        if inspect.isawaitable(result):
+            self._schedule(result)
+
+    def _schedule(self, coroutine):
+        slot = _admission_slot.get()
+        if slot is not None:
+            # The message stays in flight until the task is done
+            slot.hold()
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if running is not None:
+            running.create_task(self._guard(coroutine, slot))
+        elif self.loop is None:
+            asyncio.run(self._guard(coroutine, slot))
         else:
-            try:
-                self.logger.info("Received response from {} ".format(client[0]))
-                self.logger.debug("\n\n" + message.export())
-                self.method_endpoint_register["RESPONSE"](message, client)
-            except Exception as err:
-                self.logger.error(err)
+            asyncio.run_coroutine_threadsafe(self._guard(coroutine, slot), self.loop)
+
+    async def _guard(self, coroutine, slot=None):
+        try:
+            await coroutine
+        except Exception as err:
+            self.logger.error(err)
+        finally:
+            if slot is not None:
+                slot.done()
 
     def default_response(self, request, client):
         self.send(request.create_response(MethodNotAllowed405()), client)
 
-    def null_response(self, request):
-        return request.create_response(NullMessage())
+    def null_response(self, request, client):
+        """ ACK has no response """
+        pass
+
+    def drop_response(self, response, client):
+        """ A response is never answered, without a RESPONSE handler it is dropped """
+        self.logger.debug("Dropping response from {}, no RESPONSE handler".format(client[0]))
 
-    def send(self, message, client):
-        """ Middleware execution """
-        message, client = self.run_middleware_response(message, client)
-        self.logger.info("Sending response to {} ".format(client[0]))
-        self.logger.debug("\n\n" + message.export())
-        self.socket[1].sendto(message.export().encode(), client)
+    def cancel_response(self, request, client):
+        """ No transaction to cancel without a CANCEL handler """
+        self.send(request.create_response(ResponseFactory.build(481)), client)
+
+    def not_implemented(self, request, client):
+        self.send(request.create_response(ResponseFactory.build(501)), client)
+
+    def send(self, message, client, transport=None):
+        """
+        Sends a message to client. A response goes back on the socket its
+        request came in on, otherwise the message goes over the transport
+        named in its top Via unless transport is given
+
+        :param message:
+        :param client: RequestContext handed to the handler, or (host, port)
+        :param transport: "UDP", "TCP" or "TLS"
+        :return:
+        """
+        try:
+            result = self.middleware.response(message, client)
+        except StopProcessing:
+            return
+        if result.__class__ is not tuple:
+            self._schedule(self._send_async(result, transport))
+            return
+        self._transmit(result[0], result[1], transport)
+
+    async def _send_async(self, pending, transport):
+        try:
+            message, client = await pending
+        except StopProcessing:
+            return
+        self._transmit(message, client, transport)
+
+    def _socket(self, client):
+        """ Socket a message from client arrived on """
+        sock = getattr(client, "socket", None)
+        return sock if sock is not None else self.transports.get("UDP")
+
+    def _transmit(self, message, client, transport=None):
+        data = message.export_bytes()
+        sock = None
+        if transport is None:
+            # Back on the socket the request came in on
+            sock = getattr(client, "socket", None)
+            transport = getattr(client, "transport", None)
+        if sock is None:
+            if transport is None:
+                via = top_via(message)
+                transport = via.transport if via is not None else None
+            if transport:
+                sock = self.transports.get(transport.upper())
+        if sock is None:
+            sock = self.transports.get("UDP")
+        if self.logger.isEnabledFor(DEBUG):
+            self.logger.debug("Sending response to {}\n\n{}".format(
+                client[0], data.decode("utf-8", "replace")))
+        elif self.logger.isEnabledFor(INFO):
+            self.logger.info("Sending response to {} ".format(client[0]))
+        sock.sendto(data, client)
+        if self.access_log is not None:
+            self.access_log.record("out", message, client, transport, len(data))
+        if self.metrics is not None:
+            method_line = getattr(message, "method_line", None) or ""
+            if method_line.startswith("SIP/"):
+                self.metrics.inc("katari_responses_sent_total", (("status", method_line[8:11]),))
+            else:
+                self.metrics.inc("katari_requests_sent_total", (("method", getattr(message, "sip_type", None)),))
+        if self.transactions is not None:
+            self.transactions.send(message, data, client, sock)
 
     def receive(self):
         return SipMessage(self.rfile.read())
 
     def run_middleware_request(self, message, client):
-        for _m in self.middleware_array:
-            self.logger.debug("running request middleware layer {}".format(_m))
-            message, client = _m.process_request(message, client)
-        return message , client
+        return self.middleware.request(message, client)
 
     def run_middleware_response(self, message, client):
-        for _m in self.middleware_array:
-            self.logger.debug("running response middleware layer {}".format(_m))
-            message, client = _m.process_response(message, client)
-        return message, client
+        return self.middleware.response(message, client)
+
+    def middleware_timings(self):
+        """
+        Calls, total, mean and max seconds spent in each middleware hook,
+        recorded when KATARI_MIDDLEWARE_TIMING is on
+
+        :return: dict
+        """
+        return self.middleware.report()
 
     def load_middleware(self):
         try:
-            self.middleware_array = MiddlewareLoader(self.settings.KATARI_MIDDLEWARE).load()
+            self.middleware_array = MiddlewareLoader(self.settings.KATARI_MIDDLEWARE, self.settings).load()
         except ModuleNotFoundError as err:
             self.logger.error("No middleware called {}".format(str(err).split(" ")[3]))
             sys.exit(1)
+        self.middleware = MiddlewareChain(
+            self.middleware_array, timing=getattr(self.settings, "KATARI_MIDDLEWARE_TIMING", False)
+        )
            
         
 
@@ -0,0 +1,296 @@
+"""
+Digest authentication, RFC 3261 section 22.4 with RFC 2617 and RFC 7616
+
+Nonces are stateless, the issue time and the issuing process signed with
+HMAC, so they are checked without a lookup. Nonce counts are kept per
+nonce in a bounded LRU to refuse replayed requests. The counts live in one
+process, so a nonce is only accepted by the process that issued it, any
+other answers it as stale and the client retries with a fresh one.
+"""
+import os
+import re
+import time
+import hmac
+import struct
+import base64
+import hashlib
+import threading
+from collections import OrderedDict
+from functools import lru_cache
+from Katari.interfaces import CredentialStoreInterface
+
+
+NONCE_LIFETIME = 300
+
+# Nonces whose count is remembered for replay checks
+NONCE_CACHE_SIZE = 100000
+
+HA1_CACHE_SIZE = 10000
+
+HASHES = {
+    "MD5": hashlib.md5,
+    "SHA-256": hashlib.sha256,
+}
+
+PARAMETER = re.compile(r'([\w-]+)\s*=\s*(?:"([^"]*)"|([^\s,]+))')
+
+# Results of verify()
+VALID = "valid"
+MISSING = "missing"
+INVALID = "invalid"
+STALE = "stale"
+REPLAYED = "replayed"
+
+
+def digest(algorithm, value):
+    return HASHES[algorithm](value.encode()).hexdigest()
+
+
+def parse_authorization(value):
+    """
+    Parameters of a Digest Authorization header
+
+    :param value: header value
+    :return: dict, None for other schemes
+    """
+    scheme, _, parameters = value.strip().partition(" ")
+    if scheme.lower() != "digest":
+        return None
+    return {name.lower(): quoted or unquoted for name, quoted, unquoted in PARAMETER.findall(parameters)}
+
+
+def request_uri(request):
+    """ Request-URI from the request line, None when there is none """
+    parts = request.method_line.split(" ", 2)
+    return parts[1] if len(parts) == 3 else None
+
+
+class DictCredentialStore(CredentialStoreInterface):
+    """
+    Passwords by username from the AUTH setting's USERS
+    """
+
+    def __init__(self, users):
+        self.users = dict(users)
+
+    def get_ha1(self, username, realm, algorithm="MD5"):
+        password = self.users.get(username)
+        if password is None:
+            return None
+        return digest(algorithm, "{}:{}:{}".format(username, realm, password))
+
+
+class NonceManager:
+    """
+    Issues nonces signed with secret and checks them, a nonce carries a
+    random id of the process that issued it and is stale anywhere else
+
+    :param secret: signing key bytes
+    :param lifetime: seconds before a nonce is stale
+    """
+
+    def __init__(self, secret=None, lifetime=NONCE_LIFETIME, cache_size=NONCE_CACHE_SIZE):
+        self.secret = secret or os.urandom(32)
+        if isinstance(self.secret, str):
+            self.secret = self.secret.encode()
+        self.lifetime = lifetime
+        self.cache_size = cache_size
+        # Issue time of nonces whose signature has been checked
+        self._issued = {}
+        self._pid = None
+        self._issuer = None
+
+    def issuer(self):
+        """ Random id of this process, drawn again in a forked worker """
+        pid = os.getpid()
+        if pid != self._pid:
+            self._pid = pid
+            self._issuer = os.urandom(8)
+            self._issued = {}
+        return self._issuer
+
+    def issue(self, now=None):
+        signed = struct.pack("!d", time.time() if now is None else now) + self.issuer()
+        signature = hmac.digest(self.secret, signed, "sha256")[:16]
+        return base64.urlsafe_b64encode(signed + signature).decode().rstrip("=")
+
+    def check(self, nonce, now=None):
+        """
+        :param nonce:
+        :param now:
+        :return: VALID, STALE or INVALID
+        """
+        issuer = self.issuer()
+        issued = self._issued.get(nonce)
+        if issued is None:
+            issued = self._verify(nonce)
+            if issued is None:
+                return INVALID
+            if nonce_issuer(nonce) != issuer:
+                # Issued by another worker, whose nonce counts this one can't see
+                return STALE
+            if len(self._issued) >= self.cache_size:
+                self._issued.clear()
+            self._issued[nonce] = issued
+        if (time.time() if now is None else now) - issued > self.lifetime:
+            return STALE
+        return VALID
+
+    def _verify(self, nonce):
+        """ Issue time of a nonce with a good signature, None otherwise """
+        try:
+            raw = base64.urlsafe_b64decode(nonce + "=" * (-len(nonce) % 4))
+        except (ValueError, TypeError):
+            return None
+        if len(raw) != 32:
+            return None
+        expected = hmac.digest(self.secret, raw[:16], "sha256")[:16]
+        if not hmac.compare_digest(expected, raw[16:]):
+            return None
+        return struct.unpack("!d", raw[:8])[0]
+
+
+def nonce_issuer(nonce):
+    """ Process id bytes of a nonce whose signature has been checked """
+    return base64.urlsafe_b64decode(nonce + "=" * (-len(nonce) % 4))[8:16]
+
+
+class DigestAuthenticator:
+    """
+    Checks Authorization headers against a credential store and builds
+    the challenge for requests that fail
+
+    :param realm:
+    :param store: CredentialStoreInterface
+    :param secret: nonce signing key, random when None
+    :param algorithm: "MD5" or "SHA-256"
+    :param lifetime: nonce lifetime in seconds
+    :param proxy: challenge with 407 and Proxy-Authenticate
+    """
+
+    def __init__(self, realm, store, secret=None, algorithm="MD5", lifetime=NONCE_LIFETIME,
+                 nonce_cache_size=NONCE_CACHE_SIZE, ha1_cache_size=HA1_CACHE_SIZE, proxy=False):
+        if algorithm not in HASHES:
+            raise ValueError("Unknown digest algorithm {}, please check settings.py".format(algorithm))
+        self.realm = realm
+        self.store = store
+        self.algorithm = algorithm
+        self.nonces = NonceManager(secret, lifetime, nonce_cache_size)
+        self.proxy = proxy
+        self.request_header = "proxy-authorization" if proxy else "authorization"
+        self.challenge_header = "proxy-authenticate" if proxy else "www-authenticate"
+        self.status_code = 407 if proxy else 401
+        self.nonce_cache_size = nonce_cache_size
+        self._counts = OrderedDict()
+        self._lock = threading.Lock()
+        self.ha1 = lru_cache(maxsize=ha1_cache_size)(store.get_ha1)
+
+    def clear_cache(self):
+        """ Forgets cached HA1 values, after a password changes """
+        self.ha1.cache_clear()
+
+    def challenge(self, stale=False):
+        """
+        :param stale: the client's nonce was good but too old
+        :return: WWW-Authenticate / Proxy-Authenticate value
+        """
+        return 'Digest realm="{}", nonce="{}", algorithm={}, qop="auth"{}'.format(
+            self.realm, self.nonces.issue(), self.algorithm, ", stale=TRUE" if stale else "")
+
+    def credentials(self, request):
+        """ Digest parameters for this realm from the request, None when there are none """
+        for value in request.get_header_values(self.request_header):
+            parameters = parse_authorization(value)
+            if parameters is not None and parameters.get("realm") == self.realm:
+                return parameters
+        return None
+
+    def verify(self, request, now=None):
+        """
+        :param request:
+        :param now:
+        :return: (result, username), result is VALID, MISSING, INVALID, STALE or REPLAYED
+        """
+        parameters = self.credentials(request)
+        if parameters is None:
+            return MISSING, None
+        username = parameters.get("username")
+        nonce = parameters.get("nonce")
+        response = parameters.get("response")
+        uri = parameters.get("uri")
+        algorithm = parameters.get("algorithm", "MD5").upper()
+        qop = parameters.get("qop")
+        nc = parameters.get("nc")
+        cnonce = parameters.get("cnonce")
+        if not (username and nonce and response and uri and nc and cnonce) or algorithm != self.algorithm:
+            return INVALID, username
+        if qop != "auth":
+            # The challenge offers qop="auth", without it nonce counts can't stop replays
+            return INVALID, username
+        if uri != request_uri(request):
+            return INVALID, username
+        result = self.nonces.check(nonce, now)
+        if result is not VALID:
+            return result, username
+        if not self._fresh(nonce, nc):
+            # Refused before any hashing, the count is recorded only once the response checks out
+            return REPLAYED, username
+        ha1 = self.ha1(username, self.realm, algorithm)
+        if ha1 is None:
+            return INVALID, username
+        method = getattr(request, "sip_type", None) or request.get_cseq().method
+        ha2 = digest(algorithm, "{}:{}".format(method, uri))
+        expected = digest(algorithm, "{}:{}:{}:{}:{}:{}".format(ha1, nonce, nc, cnonce, qop, ha2))
+        if not hmac.compare_digest(expected.encode(), response.lower().encode()):
+            return INVALID, username
+        if not self._count(nonce, nc):
+            return REPLAYED, username
+        return VALID, username
+
+    def _fresh(self, nonce, nc):
+        """ False when nc isn't higher than the last count seen with the nonce """
+        try:
+            count = int(nc, 16)
+        except ValueError:
+            return False
+        with self._lock:
+            last = self._counts.get(nonce)
+        return last is None or count > last
+
+    def _count(self, nonce, nc):
+        """ Records the nonce count, False when it isn't higher than the last one """
+        try:
+            count = int(nc, 16)
+        except ValueError:
+            return False
+        with self._lock:
+            last = self._counts.get(nonce)
+            if last is not None and count <= last:
+                return False
+            self._counts[nonce] = count
+            self._counts.move_to_end(nonce)
+            if len(self._counts) > self.nonce_cache_size:
+                self._counts.popitem(last=False)
+        return True
+
+
+def get_authenticator(settings):
+    """
+    DigestAuthenticator configured from AUTH in settings, STORE is a
+    CredentialStoreInterface, otherwise USERS maps usernames to passwords
+
+    :param settings:
+    :return:
+    """
+    config = getattr(settings, "AUTH", None) or {}
+    store = config.get("STORE") or DictCredentialStore(config.get("USERS", {}))
+    return DigestAuthenticator(
+        config.get("REALM", getattr(settings, "HOST", "katari")),
+        store,
+        secret=config.get("SECRET"),
+        algorithm=config.get("ALGORITHM", "MD5"),
+        lifetime=config.get("NONCE_LIFETIME", NONCE_LIFETIME),
+        nonce_cache_size=config.get("NONCE_CACHE_SIZE", NONCE_CACHE_SIZE),
+        ha1_cache_size=config.get("HA1_CACHE_SIZE", HA1_CACHE_SIZE),
+        proxy=config.get("PROXY", False),
+    )
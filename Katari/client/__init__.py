@@ -1,2 +1,479 @@
+"""
+Asynchronous SIP client, RFC 3261 section 17.1 client transactions
+
+Every request is a client transaction keyed by its Via branch, so any
+number of requests can be outstanding on one socket (or one connection per
+destination over TCP/TLS) and each response is matched back to the request
+that caused it.
+"""
+import os
+import socket
+import asyncio
+import itertools
+from Katari.sip import SipMessage
+from Katari.sip.utils import header_prefix
+from Katari.sip.transaction import T1, T2, MAGIC_COOKIE, top_via
+from Katari.server.tcp import message_length, MAX_MESSAGE_SIZE
+
+
+# Outstanding requests per client, further requests wait for a slot
+MAX_IN_FLIGHT = 256
+
+# Socket buffer asked for so bursts of responses aren't dropped, the kernel may cap it
+SOCKET_BUFFER = 4 * 1024 * 1024
+
+
+class ClientTransaction:
+    """
+    One outstanding request
+    """
+    __slots__ = (
+        "branch", "method", "data", "destination", "future", "interval",
+        "retransmit", "timeout", "timeout_given", "provisional", "on_provisional",
+    )
+
+    def __init__(self, branch, method, data, destination, future, on_provisional=None):
+        self.branch = branch
+        self.method = method
+        self.data = data
+        self.destination = destination
+        self.future = future
+        self.interval = T1
+        self.retransmit = None
+        self.timeout = None
+        # The caller's timeout also applies once an INVITE is ringing
+        self.timeout_given = False
+        self.provisional = None
+        self.on_provisional = on_provisional
+
+    def cancel_timers(self):
+        if self.retransmit is not None:
+            self.retransmit.cancel()
+        if self.timeout is not None:
+            self.timeout.cancel()
+
+
+class ClientDatagramProtocol(asyncio.DatagramProtocol):
+
+    def __init__(self, client):
+        self.client = client
+
+    def datagram_received(self, data, address):
+        self.client._receive(data, address)
+
+    def error_received(self, exc):
+        # ICMP errors on UDP surface here, the transaction times out instead
+        pass
+
+
+class ClientStreamProtocol(asyncio.Protocol):
+    """
+    Connection to one destination, split into messages with the framing
+    used by the TCP server
+    """
+
+    def __init__(self, client, destination):
+        self.client = client
+        self.destination = destination
+        self.transport = None
+        self.buffer = bytearray()
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def connection_lost(self, exc):
+        self.client._connection_lost(self.destination, self)
+
+    def data_received(self, data):
+        buffer = self.buffer
+        buffer += data
+        while buffer:
+            if buffer[:2] == b"\r\n":
+                del buffer[:2]
+                continue
+            try:
+                total = message_length(buffer, MAX_MESSAGE_SIZE)
+            except ValueError:
+                self.transport.abort()
+                return
+            if total is None:
+                return
+            message = bytes(buffer[:total])
+            del buffer[:total]
+            self.client._receive(message, self.destination)
+
+
 class KatariSIPClient:
-    pass
+    """
+    Sends requests and resolves each with its final response
+
+        async with KatariSIPClient() as client:
+            response = await client.options(("10.0.0.5", 5060))
+    """
+
+    def __init__(self, local_address=("0.0.0.0", 0), transport="UDP", user_agent="Katari Client",
+                 max_in_flight=MAX_IN_FLIGHT, t1=T1, t2=T2, ssl=None, on_request=None):
+        """
+        :param local_address: address the UDP socket binds to
+        :param transport: "UDP", "TCP" or "TLS"
+        :param user_agent: User-Agent header value
+        :param max_in_flight: outstanding requests before request() waits, None for no limit
+        :param t1: retransmission interval, doubled on every retransmission
+        :param t2: longest retransmission interval for non-INVITE requests
+        :param ssl: ssl.SSLContext for TLS connections
+        :param on_request: called with (request, address) for requests the far end sends
+        """
+        self.local_address = local_address
+        self.transport = transport.upper()
+        self.user_agent = user_agent
+        self.max_in_flight = max_in_flight
+        self.t1 = t1
+        self.t2 = t2
+        self.ssl = ssl
+        self.on_request = on_request
+        self.loop = None
+        self.socket = None
+        self.local = None
+        self.transactions = {}
+        self.retransmissions = 0
+        self._acks = {}
+        self._connections = {}
+        self._window = None
+        self._prefix = os.urandom(4).hex()
+        self._sequence = itertools.count(1)
+
+    async def start(self):
+        self.loop = asyncio.get_running_loop()
+        if self.max_in_flight:
+            self._window = asyncio.Semaphore(self.max_in_flight)
+        if self.transport == "UDP":
+            self.socket, _ = await self.loop.create_datagram_endpoint(
+                lambda: ClientDatagramProtocol(self), local_addr=self.local_address
+            )
+            self.local = "{}:{}".format(*self.socket.get_extra_info("sockname")[:2])
+            sock = self.socket.get_extra_info("socket")
+            for option in (socket.SO_RCVBUF, socket.SO_SNDBUF):
+                try:
+                    sock.setsockopt(socket.SOL_SOCKET, option, SOCKET_BUFFER)
+                except OSError:
+                    pass
+        return self
+
+    async def close(self):
+        for transaction in list(self.transactions.values()):
+            transaction.cancel_timers()
+            if not transaction.future.done():
+                transaction.future.cancel()
+        self.transactions.clear()
+        for connection in list(self._connections.values()):
+            if isinstance(connection, asyncio.Future):
+                connection.cancel()
+            else:
+                connection.transport.close()
+        self._connections.clear()
+        if self.socket is not None:
+            self.socket.close()
+            self.socket = None
+
+    async def __aenter__(self):
+        return await self.start()
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    def new_branch(self):
+        return "{}-{}{}".format(MAGIC_COOKIE, self._prefix, next(self._sequence))
+
+    def new_tag(self):
+        return "{}{}".format(self._prefix, next(self._sequence))
+
+    def new_call_id(self):
+        return "{}-{}@katari".format(self._prefix, next(self._sequence))
+
+    def build_request(self, method, uri, branch, local, to=None, from_=None, call_id=None, cseq=1,
+                      headers=None, body=b""):
+        """
+        Encodes a request
+
+        :return: bytes
+        """
+        if isinstance(body, str):
+            body = body.encode()
+        lines = [
+            "{} {} SIP/2.0\r\n".format(method, uri),
+            "Via: SIP/2.0/{} {};branch={};rport\r\n".format(self.transport, local, branch),
+            "Max-Forwards: 70\r\n",
+            "To: {}\r\n".format(to or "<{}>".format(uri)),
+            "From: {}\r\n".format(from_ or "<sip:katari@{}>;tag={}".format(local, self.new_tag())),
+            "Call-ID: {}\r\n".format(call_id or self.new_call_id()),
+            "CSeq: {} {}\r\n".format(cseq, method),
+        ]
+        if self.user_agent:
+            lines.append("User-Agent: {}\r\n".format(self.user_agent))
+        if headers:
+            for name, value in headers.items():
+                for item in value if isinstance(value, (list, tuple)) else (value,):
+                    lines.append(header_prefix(name) + str(item) + "\r\n")
+        lines.append("Content-Length: {}\r\n\r\n".format(len(body)))
+        return "".join(lines).encode() + body
+
+    async def request(self, method, destination, uri=None, to=None, from_=None, call_id=None,
+                      cseq=1, headers=None, body=b"", timeout=None, on_provisional=None):
+        """
+        Sends a request and waits for its final response
+
+        :param method: SIP method
+        :param destination: (host, port)
+        :param uri: Request-URI, sip:host:port of the destination by default
+        :param to: To header value
+        :param from_: From header value, a tag is added by default
+        :param call_id:
+        :param cseq: CSeq number
+        :param headers: extra headers, dict of name to value or list of values
+        :param body:
+        :param timeout: seconds, 64 * T1 by default (Timer B/F). Timer B stops when
+            an INVITE gets a 1xx, a timeout given here keeps running
+        :param on_provisional: called with each 1xx response
+        :return: final response SipMessage
+        :raises asyncio.TimeoutError: when no final response arrives in time
+        """
+        if self.loop is None:
+            await self.start()
+        destination = (destination[0], int(destination[1]))
+        uri = uri or "sip:{}:{}".format(*destination)
+        if self._window is not None:
+            await self._window.acquire()
+        try:
+            sender = await self._sender(destination)
+            local = self.local if self.transport == "UDP" else self._stream_local(sender)
+            branch = self.new_branch()
+            data = self.build_request(method, uri, branch, local, to, from_, call_id, cseq, headers, body)
+            future = self.loop.create_future()
+            transaction = ClientTransaction(branch, method, data, destination, future, on_provisional)
+            self.transactions[branch] = transaction
+            sender(data, destination)
+            if self.transport == "UDP":
+                transaction.retransmit = self.loop.call_later(self.t1, self._retransmit, transaction)
+            transaction.timeout = self.loop.call_later(
+                timeout or 64 * self.t1, self._timeout, transaction
+            )
+            transaction.timeout_given = bool(timeout)
+            try:
+                return await future
+            finally:
+                transaction.cancel_timers()
+                self.transactions.pop(branch, None)
+        finally:
+            if self._window is not None:
+                self._window.release()
+
+    async def options(self, destination, uri=None, **kwargs):
+        return await self.request("OPTIONS", destination, uri, **kwargs)
+
+    async def register(self, destination, aor, contact=None, expires=3600, **kwargs):
+        """
+        Registers contact (this client by default) for aor
+
+        :param destination: registrar (host, port)
+        :param aor: sip:user@domain
+        :param contact:
+        :param expires:
+        :return: final response
+        """
+        headers = dict(kwargs.pop("headers", None) or {})
+        headers.setdefault("contact", contact or "<sip:{}@{}>".format(
+            aor.split(":", 1)[-1].split("@")[0], self.local or "{}:{}".format(*self.local_address)))
+        headers.setdefault("expires", str(expires))
+        domain = aor.split("@")[-1]
+        return await self.request(
+            "REGISTER", destination, "sip:{}".format(domain),
+            to="<{}>".format(aor), from_="<{}>;tag={}".format(aor, self.new_tag()),
+            headers=headers, **kwargs
+        )
+
+    async def message(self, destination, uri, text, content_type="text/plain", **kwargs):
+        headers = dict(kwargs.pop("headers", None) or {})
+        headers["content-type"] = content_type
+        return await self.request("MESSAGE", destination, uri, headers=headers, body=text, **kwargs)
+
+    async def invite(self, destination, uri, sdp=b"", ack=True, **kwargs):
+        """
+        Sends an INVITE, a 2xx is acknowledged unless ack is False
+
+        :param destination:
+        :param uri:
+        :param sdp: offer sent as application/sdp
+        :param ack:
+        :return: final response
+        """
+        headers = dict(kwargs.pop("headers", None) or {})
+        if sdp:
+            headers.setdefault("content-type", "application/sdp")
+        headers.setdefault("contact", "<sip:katari@{}>".format(self.local or "{}:{}".format(*self.local_address)))
+        response = await self.request("INVITE", destination, uri, headers=headers, body=sdp, **kwargs)
+        status = response.method_line[8:11]
+        if ack and status.startswith("2"):
+            await self.ack(destination, uri, response)
+        return response
+
+    async def ack(self, destination, uri, response):
+        """
+        ACK for a 2xx to INVITE, a new transaction with its own branch
+
+        :param destination:
+        :param uri: Request-URI, the Contact of the response when it has one
+        :param response: 2xx response
+        :return:
+        """
+        destination = (destination[0], int(destination[1]))
+        sender = await self._sender(destination)
+        local = self.local if self.transport == "UDP" else self._stream_local(sender)
+        contact = response.get_contact()
+        if isinstance(contact, list):
+            contact = contact[0]
+        if contact is not None and getattr(contact, "address", None):
+            uri = str(contact).split("<")[-1].split(">")[0]
+        cseq = response.get_cseq()
+        data = self.build_request(
+            "ACK", uri, self.new_branch(), local,
+            to=response["to"], from_=response["from"], call_id=response.get_call_id(),
+            cseq=cseq.number if cseq is not None else 1,
+        )
+        sender(data, destination)
+        via = top_via(response)
+        if via is not None and via.branch:
+            # Retransmitted 2xx responses are answered with the same ACK
+            self._remember_ack(via.branch, data, destination)
+
+    def _stream_local(self, sender):
+        connection = self._connections.get(sender.destination)
+        if connection is None or isinstance(connection, asyncio.Future):
+            return "{}:{}".format(*self.local_address)
+        return "{}:{}".format(*connection.transport.get_extra_info("sockname")[:2])
+
+    async def _sender(self, destination):
+        """
+        Callable (data, destination) for the transport, TCP and TLS connect
+        once per destination and reuse the connection
+        """
+        if self.transport == "UDP":
+            return self.socket.sendto
+        connection = self._connections.get(destination)
+        if connection is None:
+            connection = self.loop.create_future()
+            self._connections[destination] = connection
+            try:
+                _, protocol = await self.loop.create_connection(
+                    lambda: ClientStreamProtocol(self, destination), destination[0], destination[1],
+                    ssl=self.ssl if self.transport == "TLS" else None,
+                    server_hostname=destination[0] if self.transport == "TLS" else None,
+                )
+            except BaseException as err:
+                self._connections.pop(destination, None)
+                connection.set_exception(err)
+                # Retrieved here so an unawaited future doesn't log it again
+                connection.exception()
+                raise
+            self._connections[destination] = protocol
+            connection.set_result(protocol)
+        elif isinstance(connection, asyncio.Future):
+            protocol = await asyncio.shield(connection)
+        else:
+            protocol = connection
+
+        def send(data, _destination, protocol=protocol):
+            protocol.transport.write(data)
+        send.destination = destination
+        return send
+
+    def _connection_lost(self, destination, protocol):
+        if self._connections.get(destination) is protocol:
+            del self._connections[destination]
+
+    def _retransmit(self, transaction):
+        """ Timers A and E """
+        if transaction.future.done():
+            return
+        if transaction.method == "INVITE" and transaction.provisional is not None:
+            return
+        self.retransmissions += 1
+        self.socket.sendto(transaction.data, transaction.destination)
+        if transaction.method == "INVITE":
+            transaction.interval *= 2
+        elif transaction.provisional is not None:
+            transaction.interval = self.t2
+        else:
+            transaction.interval = min(transaction.interval * 2, self.t2)
+        transaction.retransmit = self.loop.call_later(
+            transaction.interval, self._retransmit, transaction
+        )
+
+    def _timeout(self, transaction):
+        """ Timers B and F """
+        if not transaction.future.done():
+            transaction.future.set_exception(asyncio.TimeoutError(
+                "No final response to {} {}".format(transaction.method, transaction.branch)
+            ))
+
+    def _remember_ack(self, branch, data, destination):
+        self._acks[branch] = (data, destination)
+        self.loop.call_later(64 * self.t1, self._acks.pop, branch, None)
+
+    def _receive(self, data, address):
+        if data[:4] != b"SIP/":
+            if self.on_request is not None:
+                self.on_request(SipMessage(data), address)
+            return
+        message = SipMessage(data)
+        via = top_via(message)
+        branch = via.branch if via is not None else None
+        transaction = self.transactions.get(branch)
+        if transaction is None:
+            ack = self._acks.get(branch)
+            if ack is not None:
+                self._send_raw(*ack)
+            return
+        try:
+            code = int(data[8:11])
+        except ValueError:
+            return
+        if code < 200:
+            if transaction.method == "INVITE" and not transaction.timeout_given \
+                    and transaction.timeout is not None:
+                # Timer B only runs in the Calling state, 17.1.1.2, a ringing call waits for its final response
+                transaction.timeout.cancel()
+                transaction.timeout = None
+            transaction.provisional = message
+            if transaction.on_provisional is not None:
+                transaction.on_provisional(message)
+            return
+        if transaction.method == "INVITE" and code >= 300:
+            # The transaction acknowledges failures itself, 17.1.1.3
+            ack = self._failure_ack(transaction, message)
+            self._send_raw(ack, transaction.destination)
+            self._remember_ack(branch, ack, transaction.destination)
+        if not transaction.future.done():
+            transaction.future.set_result(message)
+
+    def _failure_ack(self, transaction, response):
+        request = SipMessage(transaction.data)
+        uri = request.method_line.split(" ")[1]
+        lines = [
+            "ACK {} SIP/2.0\r\n".format(uri),
+            "Via: {}\r\n".format(request["via"]),
+            "Max-Forwards: 70\r\n",
+            "To: {}\r\n".format(response["to"]),
+            "From: {}\r\n".format(request["from"]),
+            "Call-ID: {}\r\n".format(request.get_call_id()),
+            "CSeq: {} ACK\r\n".format(request.get_cseq().number),
+            "Content-Length: 0\r\n\r\n",
+        ]
+        return "".join(lines).encode()
+
+    def _send_raw(self, data, destination):
+        if self.transport == "UDP":
+            self.socket.sendto(data, destination)
+            return
+        connection = self._connections.get(destination)
+        if connection is not None and not isinstance(connection, asyncio.Future):
+            connection.transport.write(data)
@@ -11,3 +11,14 @@ class UnKnownOutputMode(Exception):
         super().__init__("Unknown output mode {}, please check settings.py".format(output_mode))
 
 
+
+
+class StopProcessing(Exception):
+    """
+    Raised by middleware to stop a message going any further, the response
+    is sent when one is given and the message is dropped otherwise
+    """
+
+    def __init__(self, response=None):
+        super().__init__("Message stopped by middleware")
+        self.response = response
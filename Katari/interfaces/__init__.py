@@ -4,4 +4,41 @@ class MiddlewareInterface:
         return message, client
 
     def process_response(self, message, client):
-        return message, client
\ No newline at end of file
+        return message, client
+
+
+class DialogBackendInterface:
+    """
+    Storage for dialog records, see Katari.sip.dialog
+    """
+
+    def get(self, key):
+        """ Record for key or None, counts as use for LRU eviction """
+        raise NotImplementedError
+
+    def set(self, key, record):
+        raise NotImplementedError
+
+    def delete(self, key):
+        raise NotImplementedError
+
+    def expire(self, now):
+        """ Drops records idle past their TTL, returns how many """
+        return 0
+
+    def __len__(self):
+        raise NotImplementedError
+
+
+class CredentialStoreInterface:
+    """
+    Credentials for digest authentication, see Katari.auth
+    """
+
+    def get_ha1(self, username, realm, algorithm="MD5"):
+        """
+        H(username:realm:password) as lowercase hex, None for an unknown user.
+        Results are cached by the caller, call clear_cache() on the
+        middleware after changing a password
+        """
+        raise NotImplementedError
@@ -1,24 +1,345 @@
+import os
 import sys
+import json
+import time
+import queue
+import atexit
+import socket
+import struct
 import logging
 from Katari.errors import UnKnownOutputMode
-from logging.handlers import RotatingFileHandler
+from logging.handlers import RotatingFileHandler, QueueHandler, QueueListener
+
+
+# Records handled by the listener thread before the handlers are flushed
+BATCH_SIZE = 256
+
+# Binary access log record, time, direction, transport, host, port, status,
+# then the method and Call-ID each prefixed with their length
+ACCESS_RECORD = struct.Struct("!dBB16sHHI")
+ACCESS_FORMATS = ("json", "binary")
+TRANSPORTS = ("", "UDP", "TCP", "TLS")
+
+# KatariLogging and AccessLog instances whose listener threads are running
+_running = []
+
+
+def log_level(level):
+    """
+    Level number from a number or a name like "INFO"
+
+    :param level:
+    :return: int
+    """
+    if isinstance(level, int):
+        return level
+    number = logging.getLevelName(str(level).upper())
+    if not isinstance(number, int):
+        raise ValueError("Unknown log level {}, please check settings.py".format(level))
+    return number
+
+
+class BatchFlush:
+    """
+    Handler mixin leaving the flush to the listener, once per batch of
+    records instead of once per record
+    """
+    batched = True
+
+    def flush(self):
+        if not self.batched:
+            super().flush()
+
+    def flush_batch(self):
+        self.acquire()
+        try:
+            if self.stream and hasattr(self.stream, "flush"):
+                self.stream.flush()
+        finally:
+            self.release()
+
+
+class BatchRotatingFileHandler(BatchFlush, RotatingFileHandler):
+    pass
+
+
+class BatchStreamHandler(BatchFlush, logging.StreamHandler):
+    pass
+
+
+class RecordQueueHandler(QueueHandler):
+    """
+    Queues the record as it is, formatting happens on the listener thread
+    """
+
+    def prepare(self, record):
+        return record
+
+
+class BatchQueueListener(QueueListener):
+    """
+    Drains whatever is queued after each wakeup and flushes the handlers
+    once for the whole batch
+    """
+
+    def __init__(self, queue_, *handlers, batch_size=BATCH_SIZE):
+        super().__init__(queue_, *handlers, respect_handler_level=True)
+        self.batch_size = batch_size
+
+    def _monitor(self):
+        get, get_nowait = self.queue.get, self.queue.get_nowait
+        while True:
+            batch = [get()]
+            try:
+                while len(batch) < self.batch_size:
+                    batch.append(get_nowait())
+            except queue.Empty:
+                pass
+            stop = False
+            for record in batch:
+                if record is self._sentinel:
+                    stop = True
+                    continue
+                self.handle(record)
+            for handler in self.handlers:
+                if hasattr(handler, "flush_batch"):
+                    handler.flush_batch()
+            if stop:
+                return
+
+
+def _restart_after_fork():
+    # The listener thread is not copied into a forked worker
+    for log in list(_running):
+        log.restart()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_restart_after_fork)
 
 
 class KatariLogging:
-    def __init__(self, filename="Katari.log", output_mode="file", level=logging.DEBUG):
+    """
+    Logging for the 'Katari' logger. With queued=True records are put on a
+    queue and written by a background thread, the request path never
+    waits on the file
+    """
+
+    def __init__(self, filename="Katari.log", output_mode="file", level=logging.DEBUG, queued=False):
         self.log = logging.getLogger('Katari')
-        self.log.setLevel(level)
+        self.log.setLevel(log_level(level))
+        self.queued = queued
+        self.listener = None
         if output_mode == 'file':
-            self.handler = RotatingFileHandler(
+            handler_class = BatchRotatingFileHandler if queued else RotatingFileHandler
+            self.handler = handler_class(
                 filename, maxBytes=50 * 100000, backupCount=15
             )
         elif output_mode == "stdout":
-            self.handler = logging.StreamHandler(sys.stdout)
+            handler_class = BatchStreamHandler if queued else logging.StreamHandler
+            self.handler = handler_class(sys.stdout)
         else:
             raise UnKnownOutputMode(output_mode)
         self.format_ = logging.Formatter("%(asctime)s | %(levelname)s | %(message)s")
         self.handler.setFormatter(fmt=self.format_)
-        self.log.addHandler(self.handler)
+        if queued:
+            self.queue = queue.SimpleQueue()
+            self.queue_handler = RecordQueueHandler(self.queue)
+            self.log.addHandler(self.queue_handler)
+            self.start()
+            atexit.register(self.stop)
+        else:
+            self.log.addHandler(self.handler)
 
     def get_logger(self):
         return self.log
+
+    def start(self):
+        """ Starts the listener thread writing queued records """
+        if self.listener is None:
+            self.listener = BatchQueueListener(self.queue, self.handler)
+            self.listener.start()
+            _running.append(self)
+
+    def stop(self):
+        """ Writes out whatever is queued and stops the listener thread """
+        if self.listener is not None:
+            self.listener.stop()
+            self.listener = None
+            if self in _running:
+                _running.remove(self)
+
+    def restart(self):
+        # A fresh queue, the old one may have been locked by another thread at fork
+        self.queue = queue.SimpleQueue()
+        self.queue_handler.queue = self.queue
+        self.listener = None
+        _running.remove(self)
+        self.start()
+
+
+class AccessLogHandler(BatchFlush, logging.Handler):
+    """
+    Writes access records, record.msg is the tuple built by AccessLog.record
+    """
+
+    def __init__(self, filename, format_="json"):
+        super().__init__()
+        self.filename = filename
+        self.encode = self.encode_binary if format_ == "binary" else self.encode_json
+        self.stream = open(filename, "ab")
+
+    def emit(self, record):
+        try:
+            data = self.encode(record.msg)
+        except Exception:
+            self.handleError(record)
+            return
+        self.acquire()
+        try:
+            self.stream.write(data)
+            self.flush()
+        finally:
+            self.release()
+
+    def close(self):
+        self.acquire()
+        try:
+            if self.stream:
+                self.stream.close()
+                self.stream = None
+        finally:
+            self.release()
+        super().close()
+
+    @staticmethod
+    def encode_json(fields):
+        received_at, direction, transport, host, port, status, method, call_id, size = fields
+        return json.dumps({
+            "time": received_at, "direction": direction, "transport": transport, "host": host,
+            "port": port, "status": status, "method": method, "call_id": call_id, "size": size,
+        }, separators=(",", ":")).encode() + b"\n"
+
+    @staticmethod
+    def encode_binary(fields):
+        received_at, direction, transport, host, port, status, method, call_id, size = fields
+        if ":" in host:
+            address = socket.inet_pton(socket.AF_INET6, host)
+        else:
+            address = b"\x00" * 10 + b"\xff\xff" + socket.inet_pton(socket.AF_INET, host)
+        method = method.encode()[:255]
+        call_id = call_id.encode()[:65535]
+        return b"".join((
+            ACCESS_RECORD.pack(
+                received_at, direction == "out", TRANSPORTS.index(transport) if transport in TRANSPORTS else 0,
+                address, port, status, size,
+            ),
+            struct.pack("!B", len(method)), method,
+            struct.pack("!H", len(call_id)), call_id,
+        ))
+
+
+class AccessLog:
+    """
+    One record per message received or sent, as JSON lines or packed binary
+    records (see read_access_log). Records go through their own queue and
+    listener when queued
+    """
+
+    def __init__(self, filename, format_="json", queued=True):
+        if format_ not in ACCESS_FORMATS:
+            raise ValueError("Unknown access log format {}, please check settings.py".format(format_))
+        self.format = format_
+        self.log = logging.getLogger("Katari.access")
+        self.log.setLevel(logging.INFO)
+        self.log.propagate = False
+        for handler in list(self.log.handlers):
+            self.log.removeHandler(handler)
+        self.handler = AccessLogHandler(filename, format_)
+        self.handler.batched = queued
+        self.listener = None
+        if queued:
+            self.queue = queue.SimpleQueue()
+            self.queue_handler = RecordQueueHandler(self.queue)
+            self.log.addHandler(self.queue_handler)
+            self.start()
+            atexit.register(self.stop)
+        else:
+            self.log.addHandler(self.handler)
+
+    def start(self):
+        if self.listener is None:
+            self.listener = BatchQueueListener(self.queue, self.handler)
+            self.listener.start()
+            _running.append(self)
+
+    def stop(self):
+        if self.listener is not None:
+            self.listener.stop()
+            self.listener = None
+            if self in _running:
+                _running.remove(self)
+        self.handler.flush_batch()
+
+    restart = KatariLogging.restart
+
+    def record(self, direction, message, client, transport=None, size=0):
+        """
+        Logs a message
+
+        :param direction: "in" or "out"
+        :param message: SipMessage
+        :param client: (host, port)
+        :param transport: "UDP", "TCP" or "TLS"
+        :param size: bytes on the wire
+        :return:
+        """
+        method_line = getattr(message, "method_line", "") or ""
+        status = 0
+        if method_line.startswith("SIP/"):
+            try:
+                status = int(method_line[8:11])
+            except ValueError:
+                pass
+            cseq = message.get_cseq()
+            method = cseq.method if cseq is not None and not isinstance(cseq, list) else ""
+        else:
+            method = getattr(message, "sip_type", None) or ""
+        self.log.info((
+            time.time(), direction, (transport or "").upper(), client[0], client[1],
+            status, method, message.get_call_id() or "", size,
+        ))
+
+
+def read_access_log(filename, format_="json"):
+    """
+    Reads back an access log
+
+    :param filename:
+    :param format_: "json" or "binary"
+    :return: generator of dicts
+    """
+    with open(filename, "rb") as log:
+        if format_ == "json":
+            for line in log:
+                yield json.loads(line)
+            return
+        data = log.read()
+    offset = 0
+    while offset < len(data):
+        received_at, out, transport, address, port, status, size = ACCESS_RECORD.unpack_from(data, offset)
+        offset += ACCESS_RECORD.size
+        length = data[offset]
+        method = data[offset + 1:offset + 1 + length].decode()
+        offset += 1 + length
+        length, = struct.unpack_from("!H", data, offset)
+        call_id = data[offset + 2:offset + 2 + length].decode()
+        offset += 2 + length
+        if address[:12] == b"\x00" * 10 + b"\xff\xff":
+            host = socket.inet_ntop(socket.AF_INET, address[12:])
+        else:
+            host = socket.inet_ntop(socket.AF_INET6, address)
+        yield {
+            "time": received_at, "direction": "out" if out else "in", "transport": TRANSPORTS[transport],
+            "host": host, "port": port, "status": status, "method": method, "call_id": call_id, "size": size,
+        }
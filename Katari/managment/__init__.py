@@ -7,6 +7,7 @@ import argparse
 #from Katari.logging import KatariLogging
 #from Katari.errors import NoBaseCommandClass
 from Katari.managment.commands.build_app import BuildApp
+from Katari.managment.commands.client import SipClient
 
 
 #class CommandParser:
@@ -66,6 +67,12 @@ class CommandInterface:
         self.parser.add_argument(
             "--build-app", help="builds project template"
         )
+        self.parser.add_argument(
+            "--client", metavar="HOST:PORT", help="sends a request and prints the response"
+        )
+        self.parser.add_argument("--method", default="OPTIONS", help="request method for --client")
+        self.parser.add_argument("--uri", help="Request-URI for --client")
+        self.parser.add_argument("--transport", default="UDP", help="UDP, TCP or TLS for --client")
         self.args = vars(self.parser.parse_args())
 
 
@@ -73,3 +80,9 @@ class CommandInterface:
         if self.args['build_app']:
             build = BuildApp(directory=self.args['build_app'])
             build.execute()
+        elif self.args['client']:
+            client = SipClient(
+                destination=self.args['client'], method=self.args['method'],
+                uri=self.args['uri'], transport=self.args['transport']
+            )
+            client.execute()
@@ -1,2 +1,36 @@
-class SipClient:
-    pass
\ No newline at end of file
+import sys
+import asyncio
+from Katari.client import KatariSIPClient
+from Katari.managment.commands import BaseCommand
+
+
+class SipClient(BaseCommand):
+    help = "Sends a SIP request and prints the final response"
+    command = "client"
+
+    def __init__(self, destination=None, method="OPTIONS", uri=None, transport="UDP", timeout=5.0):
+        self.bash_red = "\033[91m"
+        self.end_bash_colour = "\033[0m"
+        host, _, port = destination.rpartition(":")
+        if not host:
+            host, port = port, 5060
+        self.destination = (host, int(port))
+        self.method = method.upper()
+        self.uri = uri
+        self.transport = transport
+        self.timeout = timeout
+
+    def execute(self):
+        try:
+            response = asyncio.run(self.send())
+        except asyncio.TimeoutError:
+            print(self.bash_red + "No response from {}:{}".format(*self.destination) + self.end_bash_colour)
+            sys.exit(1)
+        print(response.export())
+
+    async def send(self):
+        async with KatariSIPClient(transport=self.transport) as client:
+            return await client.request(
+                self.method, self.destination, self.uri, timeout=self.timeout,
+                on_provisional=lambda response: print(response.method_line.strip()),
+            )
@@ -0,0 +1,271 @@
+"""
+Counters and latency histograms in the Prometheus text format
+
+Every thread counts into a shard only it holds, so counting never takes a
+lock. A thread takes a shard from a free pool the first time it counts and
+puts it back when it exits, so with a thread per datagram the shards are
+reused and nothing is merged or locked per message. The shards are summed
+when the metrics are read.
+"""
+import os
+import socket
+import threading
+import socketserver
+import multiprocessing
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+# Upper bounds in seconds of the latency histogram buckets
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+HELP = {
+    "katari_messages_received_total": "SIP messages received by method",
+    "katari_responses_sent_total": "SIP responses sent by status code",
+    "katari_requests_sent_total": "SIP requests sent by method",
+    "katari_parse_errors_total": "Datagrams which could not be parsed as SIP",
+    "katari_acl_rejected_total": "Messages refused by ALLOWED_HOSTS and DENIED_HOSTS",
+    "katari_handler_errors_total": "Exceptions raised by handlers by method",
+    "katari_middleware_stopped_total": "Requests stopped by middleware",
+    "katari_handler_seconds": "Handler latency by method",
+}
+
+
+class _Shard:
+    __slots__ = ("counters", "histograms")
+
+    def __init__(self):
+        self.counters = {}
+        self.histograms = {}
+
+
+class _Lease:
+    """ A thread's shard, back in the free pool when the thread exits and its locals are dropped """
+    __slots__ = ("shard", "pool")
+
+    def __init__(self, shard, pool):
+        self.shard = shard
+        self.pool = pool
+
+    def __del__(self):
+        self.pool.append(self.shard)
+
+
+class Metrics:
+    """
+    Counters and histograms keyed by name and a tuple of (label, value) pairs
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self._local = threading.local()
+        # Every shard made, as many as threads have counted at the same time
+        self._shards = []
+        # Shards no live thread holds, list pop and append are atomic
+        self._free = []
+        self._lock = threading.Lock()
+        self._collectors = []
+
+    def _shard(self):
+        try:
+            return self._local.lease.shard
+        except AttributeError:
+            pass
+        try:
+            shard = self._free.pop()
+        except IndexError:
+            shard = _Shard()
+            with self._lock:
+                self._shards.append(shard)
+        self._local.lease = _Lease(shard, self._free)
+        return shard
+
+    @staticmethod
+    def _merge(into, counters, histograms):
+        total_counters, total_histograms = into
+        for key, value in counters.items():
+            total_counters[key] = total_counters.get(key, 0) + value
+        for key, values in histograms.items():
+            total = total_histograms.get(key)
+            if total is None:
+                total_histograms[key] = list(values)
+            else:
+                for i, value in enumerate(values):
+                    total[i] += value
+
+    def inc(self, name, labels=(), value=1):
+        """
+        Adds to a counter
+
+        :param name:
+        :param labels: tuple of (label, value) pairs
+        :param value:
+        :return:
+        """
+        counters = self._shard().counters
+        key = (name, labels)
+        counters[key] = counters.get(key, 0) + value
+
+    def observe(self, name, labels, seconds):
+        """
+        Adds a sample to a histogram
+
+        :param name:
+        :param labels: tuple of (label, value) pairs
+        :param seconds:
+        :return:
+        """
+        histograms = self._shard().histograms
+        key = (name, labels)
+        values = histograms.get(key)
+        if values is None:
+            # one count per bucket, +Inf, then sum and count
+            values = histograms[key] = [0] * (len(self.buckets) + 1) + [0.0, 0]
+        values[bisect_left(self.buckets, seconds)] += 1
+        values[-2] += seconds
+        values[-1] += 1
+
+    def add_collector(self, collector):
+        """
+        Adds a function called on every read, returning (name, type, labels,
+        value) tuples for values kept elsewhere
+
+        :param collector:
+        :return:
+        """
+        self._collectors.append(collector)
+
+    def collect(self):
+        """
+        Sum of every shard
+
+        :return: (counters, histograms)
+        """
+        total = ({}, {})
+        with self._lock:
+            shards = list(self._shards)
+        for shard in shards:
+            # dict() copies in one step, the holding thread may be adding keys
+            self._merge(total, dict(shard.counters), dict(shard.histograms))
+        return total
+
+    def get(self, name, labels=()):
+        """ Current value of a counter """
+        return self.collect()[0].get((name, labels), 0)
+
+    def render(self):
+        """
+        Prometheus text exposition of every metric
+
+        :return: str
+        """
+        counters, histograms = self.collect()
+        lines = []
+        described = set()
+
+        def describe(name, type_):
+            if name not in described:
+                described.add(name)
+                if name in HELP:
+                    lines.append("# HELP {} {}".format(name, HELP[name]))
+                lines.append("# TYPE {} {}".format(name, type_))
+
+        for (name, labels), value in sorted(counters.items()):
+            describe(name, "counter")
+            lines.append("{}{} {}".format(name, format_labels(labels), value))
+        for (name, labels), values in sorted(histograms.items()):
+            describe(name, "histogram")
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), values):
+                cumulative += count
+                lines.append("{}_bucket{} {}".format(name, format_labels(labels + (("le", str(bound)),)), cumulative))
+            lines.append("{}_sum{} {}".format(name, format_labels(labels), values[-2]))
+            lines.append("{}_count{} {}".format(name, format_labels(labels), values[-1]))
+        for collector in self._collectors:
+            for name, type_, labels, value in collector():
+                describe(name, type_)
+                lines.append("{}{} {}".format(name, format_labels(labels), value))
+        return "\n".join(lines) + "\n"
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(
+        '{}="{}"'.format(label, str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for label, value in labels
+    ) + "}"
+
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        body = self.server.metrics.render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self):
+        return str(self.client_address[0]) if self.client_address else "unix"
+
+    def log_message(self, format_, *args):
+        pass
+
+
+class MetricsHTTPServer6(ThreadingHTTPServer):
+    address_family = socket.AF_INET6
+
+
+class UnixHTTPServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+    def server_bind(self):
+        if os.path.exists(self.server_address):
+            os.unlink(self.server_address)
+        super().server_bind()
+
+
+def worker_index():
+    """ Slot of this worker process under WorkerSupervisor, 0 otherwise """
+    name = multiprocessing.current_process().name
+    if name.startswith("katari-worker-"):
+        return int(name.rsplit("-", 1)[1])
+    return 0
+
+
+def start_metrics_server(metrics, host="127.0.0.1", port=9091, path=None):
+    """
+    Serves metrics over HTTP on a daemon thread, on the Unix socket path
+    when given. Worker processes each serve their own, on port plus the
+    worker index or on path with {worker} replaced by it
+
+    :param metrics:
+    :param host:
+    :param port:
+    :param path:
+    :return: server
+    """
+    worker = worker_index()
+    if path:
+        server = UnixHTTPServer(path.format(worker=worker), MetricsRequestHandler)
+    else:
+        server_class = MetricsHTTPServer6 if ":" in host else ThreadingHTTPServer
+        server = server_class((host, port + worker if port else 0), MetricsRequestHandler)
+    server.metrics = metrics
+    threading.Thread(target=server.serve_forever, name="katari-metrics", daemon=True).start()
+    return server
+
+
+_metrics = None
+
+
+def get_metrics():
+    """ Process wide Metrics """
+    global _metrics
+    if _metrics is None:
+        _metrics = Metrics()
+    return _metrics
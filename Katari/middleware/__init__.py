@@ -1,12 +1,16 @@
 import sys
+import time
 import importlib
 import logging
 import inspect
+from Katari.errors import StopProcessing
+from Katari.interfaces import MiddlewareInterface
 
 class MiddlewareLoader:
 
-    def __init__(self, middleware=None):
+    def __init__(self, middleware=None, settings=None):
         self.middleware = middleware
+        self.settings = settings
         self.log = logging.getLogger(__name__)
         
 
@@ -17,8 +21,125 @@ class MiddlewareLoader:
 
         for _module in self.middleware:
             mod = importlib.import_module(_module)
-            _class = getattr(mod, str(inspect.getmembers(sys.modules[_module], inspect.isclass)[0][0]))
-            middleware_array.append(_class())
+            _class = self.find_class(_module)
+            if "settings" in inspect.signature(_class).parameters:
+                middleware_array.append(_class(settings=self.settings))
+            else:
+                middleware_array.append(_class())
             self.log.info("Middleware {} Loaded".format(mod.__name__))
         return middleware_array
-            
\ No newline at end of file
+
+    def find_class(self, _module):
+        """
+        Middleware class defined in the module, imported names such as
+        MiddlewareInterface itself are skipped
+        """
+        classes = inspect.getmembers(sys.modules[_module], inspect.isclass)
+        for _, _class in classes:
+            if (_class.__module__ == _module and issubclass(_class, MiddlewareInterface)
+                    and _class is not MiddlewareInterface):
+                return _class
+        return classes[0][1]
+
+
+class MiddlewareChain:
+    """
+    Request and response hooks of the loaded middleware, hooks inherited
+    unchanged from MiddlewareInterface are left out. A hook returning None
+    or raising StopProcessing stops the message, async hooks turn the rest
+    of the chain into a coroutine
+    """
+
+    def __init__(self, middleware_array, timing=False):
+        self.timings = {}
+        self.request_hooks = self._hooks(middleware_array, "process_request", timing)
+        self.response_hooks = self._hooks(middleware_array, "process_response", timing)
+
+    def _hooks(self, middleware_array, name, timing):
+        hooks = []
+        for middleware in middleware_array:
+            hook = getattr(middleware, name, None)
+            if hook is None or getattr(type(middleware), name, None) is getattr(MiddlewareInterface, name):
+                continue
+            if timing:
+                hook = self._timed(hook, "{}.{}".format(type(middleware).__name__, name))
+            hooks.append(hook)
+        return hooks
+
+    def _timed(self, hook, name):
+        counters = self.timings[name] = [0, 0.0, 0.0]
+
+        def record(elapsed):
+            counters[0] += 1
+            counters[1] += elapsed
+            if elapsed > counters[2]:
+                counters[2] = elapsed
+
+        if inspect.iscoroutinefunction(hook):
+            async def timed(message, client):
+                start = time.perf_counter()
+                try:
+                    return await hook(message, client)
+                finally:
+                    record(time.perf_counter() - start)
+        else:
+            def timed(message, client):
+                start = time.perf_counter()
+                try:
+                    return hook(message, client)
+                finally:
+                    record(time.perf_counter() - start)
+        return timed
+
+    def request(self, message, client):
+        return self._run(self.request_hooks, message, client)
+
+    def response(self, message, client):
+        return self._run(self.response_hooks, message, client)
+
+    def _run(self, hooks, message, client, start=0):
+        """
+        :return: (message, client) or a coroutine returning it
+        :raises StopProcessing:
+        """
+        for index in range(start, len(hooks)):
+            result = hooks[index](message, client)
+            if result.__class__ is tuple:
+                message, client = result
+            elif result is None:
+                raise StopProcessing()
+            elif inspect.isawaitable(result):
+                return self._run_async(hooks, result, index + 1)
+            else:
+                message, client = result
+        return message, client
+
+    async def _run_async(self, hooks, pending, start):
+        result = await pending
+        if result is None:
+            raise StopProcessing()
+        message, client = result
+        for index in range(start, len(hooks)):
+            result = hooks[index](message, client)
+            if inspect.isawaitable(result):
+                result = await result
+            if result is None:
+                raise StopProcessing()
+            message, client = result
+        return message, client
+
+    def report(self):
+        """
+        Calls, total, mean and max seconds per hook, empty unless timing is on
+
+        :return: dict
+        """
+        return {
+            name: {
+                "calls": calls,
+                "total": total,
+                "mean": total / calls if calls else 0.0,
+                "max": longest,
+            }
+            for name, (calls, total, longest) in self.timings.items()
+        }
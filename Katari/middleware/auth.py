@@ -0,0 +1,37 @@
+from Katari.auth import get_authenticator, VALID, STALE
+from Katari.errors import StopProcessing
+from Katari.interfaces import MiddlewareInterface
+from Katari.sip.response import ResponseFactory
+
+
+# Methods challenged when AUTH has no METHODS
+METHODS = ("REGISTER", "INVITE", "MESSAGE", "SUBSCRIBE", "PUBLISH", "REFER")
+
+
+class DigestAuthMiddleware(MiddlewareInterface):
+    """
+    Challenges requests without valid digest credentials before the handler
+    runs, the authenticated username is left on the request as
+    request.auth_user
+    """
+
+    def __init__(self, settings=None):
+        self.authenticator = get_authenticator(settings)
+        config = getattr(settings, "AUTH", None) or {}
+        self.methods = frozenset(config.get("METHODS", METHODS))
+
+    def clear_cache(self):
+        self.authenticator.clear_cache()
+
+    def process_request(self, message, client):
+        if getattr(message, "sip_type", None) not in self.methods:
+            return message, client
+        result, username = self.authenticator.verify(message)
+        if result is VALID:
+            message.auth_user = username
+            return message, client
+        response = message.create_response(ResponseFactory.build(self.authenticator.status_code))
+        response.set_header(
+            self.authenticator.challenge_header, self.authenticator.challenge(stale=result is STALE)
+        )
+        raise StopProcessing(response)
@@ -0,0 +1,23 @@
+from Katari.errors import StopProcessing
+from Katari.interfaces import MiddlewareInterface
+from Katari.registrar import get_registrar
+
+
+class RegistrarMiddleware(MiddlewareInterface):
+    """
+    Applies every REGISTER to the shared registrar, the response is left
+    on the request as request.registration for the register handler to send.
+    With REGISTRAR["RESPOND"] set the response is sent straight away and the
+    handler is not called
+    """
+
+    def __init__(self, settings=None):
+        self.registrar = get_registrar(settings)
+        self.respond = (getattr(settings, "REGISTRAR", None) or {}).get("RESPOND", False)
+
+    def process_request(self, message, client):
+        if getattr(message, "sip_type", None) == "REGISTER":
+            message.registration = self.registrar.register(message)
+            if self.respond:
+                raise StopProcessing(message.registration)
+        return message, client
@@ -1,16 +1,32 @@
 from Katari.interfaces import MiddlewareInterface
+from Katari.sip.dialog import get_dialog_store, TERMINATED
 
 
 class SessionHandler(MiddlewareInterface):
+    """
+    Tracks dialogs, requests inside a dialog arrive with request.dialog set
+    (None when it is unknown or has expired)
+    """
 
-    def __init__(self):
-        pass
-        
-    def process_request(self, message):
-        return message
-
-    def process_response(self, response):
-        return response
-        
+    def __init__(self, settings=None):
+        self.store = get_dialog_store(settings)
 
+    def process_request(self, message, client):
+        sip_type = getattr(message, "sip_type", None)
+        if sip_type is None or sip_type.startswith("SIP/"):
+            return message, client
+        to = message.get_to()
+        if to is not None and to.tag is not None:
+            message.dialog = self.store.lookup(message)
+            if sip_type == "BYE" and message.dialog is not None:
+                # Removed once the response to the BYE is sent
+                message.dialog.state = TERMINATED
+                self.store.save(message.dialog)
+        else:
+            message.dialog = None
+        return message, client
 
+    def process_response(self, message, client):
+        if message.method_line.startswith("SIP/"):
+            self.store.update(message)
+        return message, client
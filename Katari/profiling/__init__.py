@@ -0,0 +1,222 @@
+"""
+Sampling profiler for a running server
+
+A background thread reads the stack of every other thread with
+sys._current_frames() at a fixed interval and counts each distinct stack.
+The counts are written to a directory in the collapsed stack format read
+by flamegraph.pl and speedscope, one file per dump interval. Nothing is
+added to the request path, the cost is the sampling thread alone.
+"""
+import os
+import sys
+import time
+import sysconfig
+import threading
+
+
+# Seconds between samples
+SAMPLE_INTERVAL = 0.01
+
+# Seconds between files written to the profile directory
+DUMP_INTERVAL = 60.0
+
+MAX_DEPTH = 128
+
+# Loops of server and background threads waiting for work, as (file path
+# suffix, function). A thread is idle, and left out unless include_idle, when
+# one of these is reached from the leaf through standard library frames only,
+# so a handler blocked in Event.wait or Queue.get is still sampled
+IDLE_LOOPS = frozenset((
+    ("socketserver.py", "serve_forever"),
+    ("concurrent/futures/thread.py", "_worker"),
+    ("asyncio/base_events.py", "_run_once"),
+    ("logging/handlers.py", "_monitor"),
+    ("Katari/logging/__init__.py", "_monitor"),
+    ("Katari/sip/transaction/__init__.py", "_run_timers"),
+    ("Katari/registrar/__init__.py", "run"),
+    ("Katari/server/udp/mmsg.py", "recv_batch"),
+    ("Katari/server/udp/mmsg.py", "_recv_loop"),
+))
+
+STDLIB = sysconfig.get_paths()["stdlib"].replace(os.sep, "/")
+
+# Kinds of frame for the idle check
+IDLE = "idle"
+LIBRARY = "library"
+CODE = "code"
+
+
+def frame_kind(code):
+    """
+    :param code: code object of a frame
+    :return: IDLE for an idle loop, LIBRARY for the standard library, CODE otherwise
+    """
+    filename = code.co_filename.replace(os.sep, "/")
+    for suffix, name in IDLE_LOOPS:
+        if code.co_name == name and filename.endswith("/" + suffix):
+            return IDLE
+    if filename.startswith("<") or (
+            filename.startswith(STDLIB) and "-packages/" not in filename):
+        return LIBRARY
+    return CODE
+
+
+class SamplingProfiler:
+    """
+    Samples every thread's stack and dumps collapsed stacks to directory
+
+    :param directory: created when missing
+    :param interval: seconds between samples
+    :param dump_interval: seconds between files
+    :param include_idle: keep stacks of threads blocked waiting for work
+    """
+
+    def __init__(self, directory, interval=SAMPLE_INTERVAL, dump_interval=DUMP_INTERVAL, include_idle=False):
+        self.directory = directory
+        self.interval = interval
+        self.dump_interval = dump_interval
+        self.include_idle = include_idle
+        self.samples = 0
+        self.files = []
+        self._stacks = {}
+        self._labels = {}
+        self._kinds = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        os.makedirs(self.directory, exist_ok=True)
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="katari-profiler", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """ Stops sampling and writes out what was collected since the last dump """
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+        self.dump()
+
+    def _run(self):
+        own = threading.get_ident()
+        next_dump = time.monotonic() + self.dump_interval
+        while not self._stop.wait(self.interval):
+            self.sample(own)
+            if time.monotonic() >= next_dump:
+                next_dump += self.dump_interval
+                self.dump()
+
+    def sample(self, skip=None):
+        """
+        Counts the current stack of every thread but skip
+
+        :param skip: thread ident
+        :return:
+        """
+        stacks = self._stacks
+        label = self._label
+        with self._lock:
+            for ident, frame in sys._current_frames().items():
+                if ident == skip:
+                    continue
+                if not self.include_idle and self._idle(frame):
+                    continue
+                names = []
+                while frame is not None and len(names) < MAX_DEPTH:
+                    names.append(label(frame.f_code))
+                    frame = frame.f_back
+                names.reverse()
+                stack = ";".join(names)
+                stacks[stack] = stacks.get(stack, 0) + 1
+            self.samples += 1
+
+    def _idle(self, frame):
+        """ True when the thread is waiting for work in one of IDLE_LOOPS """
+        kinds = self._kinds
+        while frame is not None:
+            code = frame.f_code
+            kind = kinds.get(code)
+            if kind is None:
+                kind = kinds[code] = frame_kind(code)
+            if kind is IDLE:
+                return True
+            if kind is CODE:
+                return False
+            frame = frame.f_back
+        return False
+
+    def _label(self, code):
+        try:
+            return self._labels[code]
+        except KeyError:
+            label = self._labels[code] = "{}:{}".format(os.path.basename(code.co_filename), code.co_name)
+            return label
+
+    def collapsed(self):
+        """
+        Stacks counted since the last dump, one "frame;frame;frame count" per line
+
+        :return: str
+        """
+        with self._lock:
+            stacks = dict(self._stacks)
+        return "".join("{} {}\n".format(stack, count) for stack, count in sorted(stacks.items()))
+
+    def dump(self):
+        """
+        Writes the collapsed stacks to a new file and starts counting again
+
+        :return: path, None when nothing was sampled
+        """
+        with self._lock:
+            stacks, self._stacks = self._stacks, {}
+        if not stacks:
+            return None
+        path = os.path.join(self.directory, "katari-{}-{}.folded".format(
+            os.getpid(), time.strftime("%Y%m%d-%H%M%S")))
+        if path in self.files:
+            path = "{}-{}.folded".format(path[:-len(".folded")], len(self.files))
+        temporary = path + ".tmp"
+        with open(temporary, "w") as profile:
+            for stack, count in sorted(stacks.items()):
+                profile.write("{} {}\n".format(stack, count))
+        os.replace(temporary, path)
+        self.files.append(path)
+        return path
+
+
+def profile_settings(settings, profile=None):
+    """
+    Profiler options from run(profile=...), the KATARI_PROFILE environment
+    variable or KATARI_PROFILE in settings, in that order. Each may be a
+    directory or a dict of DIRECTORY, INTERVAL, DUMP_INTERVAL and INCLUDE_IDLE
+
+    :param settings:
+    :param profile:
+    :return: dict, None when profiling is off
+    """
+    for config in (profile, os.environ.get("KATARI_PROFILE"), getattr(settings, "KATARI_PROFILE", None)):
+        if not config:
+            continue
+        if isinstance(config, str):
+            config = {"DIRECTORY": config}
+        if config.get("DIRECTORY"):
+            return config
+    return None
+
+
+def start_profiler(config):
+    """
+    :param config: dict from profile_settings
+    :return: running SamplingProfiler
+    """
+    return SamplingProfiler(
+        config["DIRECTORY"],
+        interval=config.get("INTERVAL", SAMPLE_INTERVAL),
+        dump_interval=config.get("DUMP_INTERVAL", DUMP_INTERVAL),
+        include_idle=config.get("INCLUDE_IDLE", False),
+    ).start()
@@ -0,0 +1,475 @@
+"""
+In-memory registrar / location service, RFC 3261 section 10.3
+
+Bindings are indexed by address of record and by Call-ID, expiry runs off
+a heap ordered by expiry time so only bindings that are actually due are
+touched.
+"""
+import gc
+import os
+import time
+import heapq
+import atexit
+import pickle
+import logging
+import threading
+import itertools
+import multiprocessing
+from Katari.sip.utils import URI
+from Katari.sip.response import ResponseFactory
+
+
+DEFAULT_EXPIRES = 3600
+MIN_EXPIRES = 60
+MAX_EXPIRES = 86400
+
+# Expired bindings removed per call, keeps a burst of expiries off one request
+EXPIRE_BATCH = 1000
+
+
+class Binding:
+    """
+    One AOR -> Contact binding
+    """
+    __slots__ = ("aor", "contact", "uri", "call_id", "cseq", "expires_at", "q")
+
+    def __init__(self, aor, contact, uri, call_id, cseq, expires_at, q=None):
+        self.aor = aor
+        self.contact = contact
+        self.uri = uri
+        self.call_id = call_id
+        self.cseq = cseq
+        self.expires_at = expires_at
+        self.q = q
+
+    def __repr__(self):
+        return "Binding({}, {})".format(self.aor, self.contact)
+
+    def expires_in(self, now=None):
+        return max(0, int(self.expires_at - (now or time.time())))
+
+    def header(self, now=None):
+        """
+        Contact header value for the 200 OK to a REGISTER
+        """
+        return "{};expires={}".format(self.contact, self.expires_in(now))
+
+
+def address_of_record(uri):
+    """
+    Canonical AOR (sip:user@host) for a To/From/Request URI
+
+    :param uri: URI or header string
+    :return:
+    """
+    if isinstance(uri, str):
+        uri = URI(uri)
+    if uri is None or uri.address is None:
+        return None
+    scheme = "sips" if "sips:" in str(uri) else "sip"
+    if uri.user:
+        return "{}:{}@{}".format(scheme, uri.user, uri.address.lower())
+    return "{}:{}".format(scheme, uri.address.lower())
+
+
+def split_contacts(value):
+    """
+    Splits a Contact header value on the commas between contacts
+
+    :param value:
+    :return:
+    """
+    contacts = []
+    start = 0
+    depth = 0
+    quoted = False
+    for index, char in enumerate(value):
+        if char == '"':
+            quoted = not quoted
+        elif quoted:
+            continue
+        elif char == "<":
+            depth += 1
+        elif char == ">":
+            depth -= 1
+        elif char == "," and depth == 0:
+            contacts.append(value[start:index].strip())
+            start = index + 1
+    contacts.append(value[start:].strip())
+    return [contact for contact in contacts if contact]
+
+
+def parse_contact(contact):
+    """
+    Returns (contact, uri, params) with the binding parameters split off
+
+    :param contact:
+    :return:
+    """
+    if "<" in contact:
+        end = contact.index(">") + 1
+        address, rest = contact[:end], contact[end:]
+        uri = address[address.index("<") + 1:-1]
+    else:
+        address, _, rest = contact.partition(";")
+        rest = ";" + rest if rest else ""
+        uri = address = address.strip()
+    params = {}
+    for param in rest.split(";"):
+        key, sep, value = param.partition("=")
+        if key.strip():
+            params[key.strip().lower()] = value.strip() if sep else None
+    return address.strip(), uri, params
+
+
+class Registrar:
+    """
+    AOR -> Contact bindings with O(1) lookup by AOR and by Call-ID
+    """
+
+    def __init__(self, default_expires=DEFAULT_EXPIRES, min_expires=MIN_EXPIRES,
+                 max_expires=MAX_EXPIRES):
+        self.default_expires = default_expires
+        self.min_expires = min_expires
+        self.max_expires = max_expires
+        self.log = logging.getLogger('Katari')
+        self._aors = {}
+        self._call_ids = {}
+        self._expiry = []
+        self._count = 0
+        self._sequence = itertools.count()
+        self._lock = threading.RLock()
+        # (path, interval) from settings, started per process by start_snapshots()
+        self.snapshot_config = None
+        self._snapshot_pid = None
+
+    def __len__(self):
+        return self._count
+
+    def lookup(self, aor):
+        """
+        Current bindings for an AOR, highest q first
+
+        :param aor: AOR string, URI or To header
+        :return: list of Binding
+        """
+        if not isinstance(aor, str) or not aor.startswith(("sip:", "sips:")):
+            aor = address_of_record(aor)
+        now = time.time()
+        with self._lock:
+            self.expire(now)
+            bindings = [b for b in self._aors.get(aor, {}).values() if b.expires_at > now]
+        if len(bindings) > 1:
+            bindings.sort(key=lambda b: -(b.q if b.q is not None else 1.0))
+        return bindings
+
+    def lookup_call_id(self, call_id):
+        """
+        Bindings created by a Call-ID
+
+        :param call_id:
+        :return: list of Binding
+        """
+        now = time.time()
+        with self._lock:
+            return [b for b in self._call_ids.get(call_id, {}).values() if b.expires_at > now]
+
+    def add(self, aor, contact, call_id, cseq, expires, q=None, uri=None, now=None):
+        """
+        Adds or refreshes a binding, expires of 0 removes it
+
+        :return: the Binding or None when removed
+        """
+        now = now or time.time()
+        contact_address, contact_uri, _ = parse_contact(contact)
+        uri = uri or contact_uri
+        with self._lock:
+            bindings = self._aors.setdefault(aor, {})
+            binding = bindings.get(uri)
+            if expires <= 0:
+                if binding is not None:
+                    self._remove(binding)
+                return None
+            if binding is None:
+                binding = Binding(aor, contact_address, uri, call_id, cseq, now + expires, q)
+                bindings[uri] = binding
+                self._count += 1
+            else:
+                if binding.call_id != call_id:
+                    self._unindex_call_id(binding)
+                binding.contact = contact_address
+                binding.call_id = call_id
+                binding.cseq = cseq
+                binding.expires_at = now + expires
+                binding.q = q
+            self._call_ids.setdefault(call_id, {})[(aor, uri)] = binding
+            heapq.heappush(self._expiry, (binding.expires_at, next(self._sequence), binding))
+            return binding
+
+    def remove(self, aor, uri=None):
+        """
+        Removes one binding, or every binding of the AOR
+
+        :param aor:
+        :param uri: contact URI
+        :return:
+        """
+        with self._lock:
+            bindings = list(self._aors.get(aor, {}).values())
+            for binding in bindings:
+                if uri is None or binding.uri == uri:
+                    self._remove(binding)
+
+    def _remove(self, binding):
+        bindings = self._aors.get(binding.aor)
+        if bindings is not None and bindings.get(binding.uri) is binding:
+            del bindings[binding.uri]
+            self._count -= 1
+            if not bindings:
+                del self._aors[binding.aor]
+        self._unindex_call_id(binding)
+        # Leaves any heap entry stale, expire() skips it
+        binding.expires_at = 0
+
+    def _unindex_call_id(self, binding):
+        by_call_id = self._call_ids.get(binding.call_id)
+        if by_call_id is not None:
+            if by_call_id.get((binding.aor, binding.uri)) is binding:
+                del by_call_id[(binding.aor, binding.uri)]
+            if not by_call_id:
+                del self._call_ids[binding.call_id]
+
+    def expire(self, now=None, limit=EXPIRE_BATCH):
+        """
+        Removes bindings whose expiry time has passed
+
+        :param now:
+        :param limit: most heap entries handled in one call
+        :return: number of bindings removed
+        """
+        now = now or time.time()
+        removed = 0
+        with self._lock:
+            expiry = self._expiry
+            while expiry and expiry[0][0] <= now and limit > 0:
+                expires_at, _, binding = heapq.heappop(expiry)
+                limit -= 1
+                # Refreshed bindings leave their old heap entry behind
+                if binding.expires_at == expires_at:
+                    self._remove(binding)
+                    removed += 1
+            if len(expiry) > 2 * self._count + 1024:
+                self._compact()
+        return removed
+
+    def _compact(self):
+        self._expiry = [entry for entry in self._expiry if entry[2].expires_at == entry[0]]
+        heapq.heapify(self._expiry)
+
+    def register(self, request):
+        """
+        Applies a REGISTER request and builds its response, 200 OK with the
+        current bindings, 400 or 423 Interval Too Brief
+
+        :param request:
+        :return: response ready to send
+        """
+        aor = address_of_record(request.get_to())
+        call_id = request.get_call_id()
+        cseq = request.get_cseq()
+        if aor is None or call_id is None or cseq is None or cseq.number is None:
+            return request.create_response(ResponseFactory.build(400))
+        try:
+            default = int(request["expires"] or self.default_expires)
+        except ValueError:
+            default = self.default_expires
+
+        contacts = []
+        for value in request.get_header_values("contact"):
+            contacts.extend(split_contacts(str(value)))
+
+        now = time.time()
+        with self._lock:
+            if contacts == ["*"]:
+                if default != 0:
+                    return request.create_response(ResponseFactory.build(400))
+                for binding in list(self._aors.get(aor, {}).values()):
+                    if binding.call_id != call_id or binding.cseq < cseq.number:
+                        self._remove(binding)
+            else:
+                updates = []
+                for contact in contacts:
+                    address, uri, params = parse_contact(contact)
+                    try:
+                        expires = int(params.get("expires") or default)
+                    except ValueError:
+                        expires = default
+                    if 0 < expires < self.min_expires:
+                        response = request.create_response(ResponseFactory.build(423))
+                        response._data.pop("contact", None)
+                        response._data["min-expires"] = str(self.min_expires)
+                        return response
+                    try:
+                        q = float(params["q"]) if params.get("q") else None
+                    except ValueError:
+                        q = None
+                    updates.append((contact, uri, min(expires, self.max_expires), q))
+                for contact, uri, expires, q in updates:
+                    current = self._aors.get(aor, {}).get(uri)
+                    if (current is not None and current.call_id == call_id
+                            and current.cseq >= cseq.number):
+                        # Out of order or replayed REGISTER
+                        continue
+                    self.add(aor, contact, call_id, cseq.number, expires, q, uri, now)
+            bindings = self.lookup(aor)
+
+        response = request.create_response(ResponseFactory.build(200))
+        response._data.pop("contact", None)
+        if bindings:
+            response._data["contact"] = [binding.header(now) for binding in bindings]
+        return response
+
+    def snapshot(self, path):
+        """
+        Writes every binding to disk, the file is replaced atomically
+
+        :param path:
+        :return: number of bindings written
+        """
+        with self._lock:
+            records = [
+                (b.aor, b.contact, b.uri, b.call_id, b.cseq, b.expires_at, b.q)
+                for bindings in self._aors.values() for b in bindings.values()
+            ]
+        temporary = "{}.{}.tmp".format(path, os.getpid())
+        with open(temporary, "wb") as f:
+            pickle.dump(records, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temporary, path)
+        return len(records)
+
+    def restore(self, path):
+        """
+        Loads bindings written by snapshot(), already expired ones are skipped
+
+        :param path:
+        :return: number of bindings restored
+        """
+        # Millions of small objects would otherwise trigger repeated full collections
+        collecting = gc.isenabled()
+        gc.disable()
+        try:
+            with open(path, "rb") as f:
+                records = pickle.load(f)
+            return self._restore(records)
+        finally:
+            if collecting:
+                gc.enable()
+
+    def _restore(self, records):
+        now = time.time()
+        restored = 0
+        with self._lock:
+            for aor, contact, uri, call_id, cseq, expires_at, q in records:
+                if expires_at > now:
+                    binding = Binding(aor, contact, uri, call_id, cseq, expires_at, q)
+                    bindings = self._aors.setdefault(aor, {})
+                    if uri not in bindings:
+                        self._count += 1
+                    bindings[uri] = binding
+                    self._call_ids.setdefault(call_id, {})[(aor, uri)] = binding
+                    self._expiry.append((expires_at, next(self._sequence), binding))
+                    restored += 1
+            heapq.heapify(self._expiry)
+        return restored
+
+    def start_snapshots(self, path, interval=60):
+        """
+        Restores path when it exists, then snapshots to it every interval
+        seconds on a daemon thread and once more at exit. The thread doesn't
+        survive fork, so worker processes each start their own
+
+        :param path:
+        :param interval:
+        :return:
+        """
+        if self._snapshot_pid == os.getpid():
+            return
+        self._snapshot_pid = os.getpid()
+        if os.path.exists(path):
+            self.log.info("Restored {} bindings from {}".format(self.restore(path), path))
+
+        def run():
+            while True:
+                time.sleep(interval)
+                self._snapshot_safely(path)
+
+        threading.Thread(target=run, name="katari-registrar-snapshot", daemon=True).start()
+        atexit.register(self._snapshot_at_exit, path, self._snapshot_pid)
+
+    def _snapshot_safely(self, path):
+        try:
+            self.snapshot(path)
+        except OSError as err:
+            self.log.error("Registrar snapshot failed: {}".format(err))
+
+    def _snapshot_at_exit(self, path, pid):
+        # Registrations inherited across fork belong to the process that made them
+        if pid == os.getpid():
+            self._snapshot_safely(path)
+
+
+_registrar = None
+
+
+def get_registrar(settings=None):
+    """
+    Process wide registrar shared by RegistrarMiddleware and handlers,
+    created from REGISTRAR in settings on first use
+
+    :param settings:
+    :return:
+    """
+    global _registrar
+    if _registrar is None:
+        config = getattr(settings, "REGISTRAR", None) or {}
+        _registrar = Registrar(
+            default_expires=config.get("DEFAULT_EXPIRES", DEFAULT_EXPIRES),
+            min_expires=config.get("MIN_EXPIRES", MIN_EXPIRES),
+            max_expires=config.get("MAX_EXPIRES", MAX_EXPIRES),
+        )
+        if config.get("SNAPSHOT"):
+            _registrar.snapshot_config = (config["SNAPSHOT"], config.get("SNAPSHOT_INTERVAL", 60))
+    return _registrar
+
+
+def snapshot_path(path):
+    """
+    Snapshot file of this process, worker processes each keep their own
+    bindings so each gets its own file, path with {worker} replaced by the
+    worker index, or path.<index> when it has no {worker}
+
+    :param path:
+    :return:
+    """
+    name = multiprocessing.current_process().name
+    if not name.startswith("katari-worker-"):
+        return path.replace("{worker}", "0")
+    index = name.rsplit("-", 1)[1]
+    if "{worker}" in path:
+        return path.replace("{worker}", index)
+    return "{}.{}".format(path, index)
+
+
+def start_snapshots():
+    """
+    Starts snapshots of the registrar from get_registrar when SNAPSHOT is
+    set, called by KatariApplication in each worker process once it starts
+
+    :return: snapshot path, None when snapshots are off
+    """
+    if _registrar is None or _registrar.snapshot_config is None:
+        return None
+    path, interval = _registrar.snapshot_config
+    path = snapshot_path(path)
+    _registrar.start_snapshots(path, interval)
+    return path
@@ -1,26 +1,138 @@
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
+import time
+import atexit
+import signal
+import logging
+import threading
+import multiprocessing
+from multiprocessing.connection import wait
+
+
+class RequestContext(tuple):
+    """
+    Address of the peer a message came from, with the transport name, the
+    socket it arrived on and when it arrived. Handlers get it as client,
+    it is still the address tuple so it can go straight to sendto
+    """
+
+    def __new__(cls, peer, socket, transport="UDP", received_at=None):
+        context = tuple.__new__(cls, peer)
+        context.socket = socket
+        context.transport = transport
+        context.received_at = received_at if received_at is not None else time.time()
+        return context
+
+    @property
+    def peer(self):
+        return tuple(self)
+
+    def __repr__(self):
+        return "RequestContext({}, {})".format(tuple(self), self.transport)
+
+
+class WorkerSupervisor:
+    """
+    Forks worker processes which each bind the same address with
+    SO_REUSEPORT, restarts workers that exit and stops them all on shutdown
+    """
+
+    def __init__(self, target, workers, restart_delay=1.0, max_restart_delay=30.0):
+        self.target = target
+        self.workers = workers
+        self.restart_delay = restart_delay
+        self.max_restart_delay = max_restart_delay
+        self.log = logging.getLogger('Katari')
+        self._context = multiprocessing.get_context("fork")
+        self._processes = [None] * workers
+        self._started = [0.0] * workers
+        self._delays = [restart_delay] * workers
+        self._stopping = False
+        # Set by SIGINT/SIGTERM, ends a restart backoff early
+        self._stopped = threading.Event()
+
+    def run(self):
+        """
+        Blocks supervising the workers until SIGINT or SIGTERM
+
+        :return:
+        """
+        previous = {
+            sig: signal.signal(sig, self._stop) for sig in (signal.SIGINT, signal.SIGTERM)
+        }
+        try:
+            for slot in range(self.workers):
+                self._spawn(slot)
+            while not self._stopping:
+                sentinels = [p.sentinel for p in self._processes if p is not None]
+                wait(sentinels, timeout=1.0)
+                for slot, process in enumerate(self._processes):
+                    if self._stopping:
+                        break
+                    if process is not None and not process.is_alive():
+                        self._restart(slot, process)
+        finally:
+            self.shutdown()
+            for sig, handler in previous.items():
+                signal.signal(sig, handler)
+
+    def shutdown(self, timeout=5.0):
+        self._stopping = True
+        for process in self._processes:
+            if process is not None and process.is_alive():
+                process.terminate()
+        deadline = time.monotonic() + timeout
+        for process in self._processes:
+            if process is None:
+                continue
+            process.join(max(0.0, deadline - time.monotonic()))
+            if process.is_alive():
+                self.log.error("Worker {} did not stop, killing it".format(process.pid))
+                process.kill()
+                process.join()
+        self._processes = [None] * self.workers
+
+    def _spawn(self, slot):
+        process = self._context.Process(
+            target=self._worker, name="katari-worker-{}".format(slot), daemon=True
+        )
+        process.start()
+        self._processes[slot] = process
+        self._started[slot] = time.monotonic()
+        self.log.info("Started worker {} (pid {})".format(slot, process.pid))
+
+    def _restart(self, slot, process):
+        self.log.error(
+            "Worker {} (pid {}) exited with code {}, restarting".format(
+                slot, process.pid, process.exitcode
+            )
+        )
+        # Back off when a worker keeps dying straight after starting
+        if time.monotonic() - self._started[slot] < self._delays[slot]:
+            delay = self._delays[slot]
+            self._delays[slot] = min(delay * 2, self.max_restart_delay)
+            if self._stopped.wait(delay):
+                return
+        else:
+            self._delays[slot] = self.restart_delay
+        if not self._stopping:
+            self._spawn(slot)
+
+    def _worker(self):
+        signal.signal(signal.SIGINT, signal.default_int_handler)
+        signal.signal(signal.SIGTERM, _terminate)
+        try:
+            self.target()
+        finally:
+            signal.signal(signal.SIGTERM, signal.SIG_IGN)
+            # multiprocessing ends the child with os._exit, which skips atexit,
+            # the log listener and profiler flush from there
+            atexit._run_exitfuncs()
+
+    def _stop(self, signum, frame):
+        self.log.info("Stopping workers")
+        self._stopping = True
+        self._stopped.set()
+
+
+def _terminate(signum, frame):
+    """ SIGTERM in a worker, unwinds so finally blocks and atexit run """
+    raise SystemExit(0)
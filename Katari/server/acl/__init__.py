@@ -0,0 +1,144 @@
+"""
+Access lists for ALLOWED_HOSTS and DENIED_HOSTS
+
+Entries are addresses or CIDR ranges, IPv4 or IPv6. Single addresses go
+in a set of address strings, so the common case is one hash lookup on the
+string the socket returned. Ranges are merged into sorted, non-overlapping
+intervals of integers searched with bisect, O(log n) in the number of ranges.
+"""
+import socket
+import ipaddress
+import threading
+from bisect import bisect_right
+
+
+# Lookup results kept per address string before the cache is cleared
+CACHE_SIZE = 65536
+
+
+class AddressSet:
+    """
+    Compiled set of addresses and ranges
+
+    :param entries: address strings, CIDR strings or ipaddress networks
+    """
+
+    def __init__(self, entries=()):
+        self.exact = set()
+        self.names = set()
+        networks = {4: [], 6: []}
+        for entry in entries:
+            try:
+                network = ipaddress.ip_network(entry, strict=False)
+            except ValueError:
+                # Hostnames and anything else are matched as given, like before
+                self.names.add(entry)
+                continue
+            if network.num_addresses == 1:
+                self.exact.add(str(network.network_address))
+            networks[network.version].append(network)
+        self.entries = len(self.exact) + len(self.names) + sum(len(n) for n in networks.values())
+        self.intervals = {version: merge(networks[version]) for version in networks}
+
+    def __len__(self):
+        return self.entries
+
+    def __bool__(self):
+        return self.entries > 0
+
+    def __contains__(self, address):
+        if address in self.exact or address in self.names:
+            return True
+        parsed = parse_address(address)
+        if parsed is None:
+            return False
+        version, number = parsed
+        starts, ends = self.intervals[version]
+        index = bisect_right(starts, number) - 1
+        return index >= 0 and number <= ends[index]
+
+
+def merge(networks):
+    """
+    Networks as sorted, non-overlapping (start, end) integer intervals
+
+    :param networks:
+    :return: (starts, ends) lists
+    """
+    intervals = sorted((int(n.network_address), int(n.broadcast_address)) for n in networks)
+    starts, ends = [], []
+    for start, end in intervals:
+        if ends and start <= ends[-1] + 1:
+            if end > ends[-1]:
+                ends[-1] = end
+            continue
+        starts.append(start)
+        ends.append(end)
+    return starts, ends
+
+
+def parse_address(address):
+    """
+    :param address: address string as returned by recvfrom
+    :return: (version, integer), None when it isn't an IP address
+    """
+    try:
+        if ":" not in address:
+            return 4, int.from_bytes(socket.inet_pton(socket.AF_INET, address), "big")
+        number = int.from_bytes(socket.inet_pton(socket.AF_INET6, address.split("%", 1)[0]), "big")
+    except (OSError, ValueError, TypeError):
+        return None
+    if number >> 32 == 0xFFFF:
+        # IPv4 mapped, as seen on a dual stack socket
+        return 4, number & 0xFFFFFFFF
+    return 6, number
+
+
+class AccessList:
+    """
+    Allows an address when no deny entry matches it and the allow list is
+    empty or matches it. reload() swaps in new lists while lookups go on
+    """
+
+    def __init__(self, allow=(), deny=(), cache_size=CACHE_SIZE):
+        self.cache_size = cache_size
+        self._lock = threading.Lock()
+        self.reload(allow, deny)
+
+    @classmethod
+    def from_settings(cls, settings):
+        return cls(getattr(settings, "ALLOWED_HOSTS", ()), getattr(settings, "DENIED_HOSTS", ()))
+
+    def reload(self, allow=(), deny=()):
+        """
+        Compiles new lists and replaces the current ones
+
+        :param allow:
+        :param deny:
+        :return:
+        """
+        rules = (AddressSet(allow), AddressSet(deny))
+        with self._lock:
+            self._rules = rules
+            self._cache = {}
+
+    def allows(self, address):
+        """
+        :param address: host string
+        :return: bool
+        """
+        cache = self._cache
+        try:
+            return cache[address]
+        except KeyError:
+            pass
+        allow, deny = self._rules
+        allowed = address not in deny and (not allow or address in allow)
+        if len(cache) >= self.cache_size:
+            cache.clear()
+        cache[address] = allowed
+        return allowed
+
+    def stats(self):
+        allow, deny = self._rules
+        return {"allow": len(allow), "deny": len(deny), "cached": len(self._cache)}
@@ -0,0 +1,223 @@
+"""
+Admission control, caps the messages queued or being handled and rate
+limits each source address
+
+Messages over the limits are answered with a pre-rendered 503 carrying
+Retry-After, built straight from the request bytes, or dropped. Either way
+they are turned away before they are parsed or handed to a thread.
+"""
+import time
+import threading
+from collections import OrderedDict
+from Katari.sip.response import render_prefix, fast_response
+
+
+MAX_IN_FLIGHT = 1024
+RETRY_AFTER = 5
+BURST = 50
+
+# Buckets kept, the least recently seen source is forgotten past this
+MAX_SOURCES = 100000
+
+REJECT = "503"
+DROP = "drop"
+
+
+class RateLimiter:
+    """
+    Token bucket per source address, rate messages a second with bursts
+    of up to burst messages, for at most max_sources sources
+    """
+
+    def __init__(self, rate, burst=BURST, max_sources=MAX_SOURCES):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.max_sources = max_sources
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._buckets)
+
+    def allow(self, source, now=None):
+        """
+        Takes a token from the source's bucket
+
+        :param source: host
+        :param now: time.monotonic()
+        :return: False when the bucket is empty
+        """
+        if now is None:
+            now = time.monotonic()
+        with self._lock:
+            buckets = self._buckets
+            bucket = buckets.get(source)
+            if bucket is None:
+                if len(buckets) >= self.max_sources:
+                    buckets.popitem(last=False)
+                buckets[source] = [self.burst - 1.0, now]
+                return True
+            buckets.move_to_end(source)
+            tokens = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+            if tokens < 1.0:
+                bucket[0] = tokens
+                return False
+            bucket[0] = tokens - 1.0
+            return True
+
+
+class Slot:
+    """
+    In-flight place of one admitted message, held by the message and by
+    every task scheduled while handling it, freed when the last is done.
+    Once freed the slot is closed, later hold() and done() calls do nothing
+    """
+    __slots__ = ("admission", "holders", "closed")
+
+    def __init__(self, admission):
+        self.admission = admission
+        self.holders = 1
+        self.closed = False
+
+    def hold(self):
+        with self.admission._lock:
+            if not self.closed:
+                self.holders += 1
+
+    def done(self):
+        admission = self.admission
+        with admission._lock:
+            if self.closed:
+                return
+            self.holders -= 1
+            if self.holders == 0:
+                self.closed = True
+                admission.in_flight -= 1
+
+
+class AdmissionControl:
+    """
+    Counts the messages admitted and not yet released, a message is
+    admitted while fewer than max_in_flight are and its source is within
+    its rate
+
+    :param max_in_flight: messages queued or being handled at once
+    :param action: "503" to answer turned away requests, "drop" to ignore them
+    :param retry_after: seconds sent in Retry-After
+    :param rate: messages a second from one source, None for no limit
+    :param burst: messages one source can send at once
+    """
+
+    def __init__(self, max_in_flight=MAX_IN_FLIGHT, action=REJECT, retry_after=RETRY_AFTER, rate=None,
+                 burst=BURST, max_sources=MAX_SOURCES):
+        if action not in (REJECT, DROP):
+            raise ValueError("Unknown admission action {}, please check settings.py".format(action))
+        self.max_in_flight = max_in_flight
+        self.action = action
+        self.retry_after = retry_after
+        self.limiter = RateLimiter(rate, burst, max_sources) if rate else None
+        self.in_flight = 0
+        self.peak = 0
+        self.admitted = 0
+        self.shed_overload = 0
+        self.shed_rate = 0
+        self.rejected = 0
+        self._prefix = None
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_settings(cls, settings):
+        """
+        :param settings:
+        :return: AdmissionControl, None when ADMISSION is not set
+        """
+        config = getattr(settings, "ADMISSION", None)
+        if not config:
+            return None
+        return cls(
+            max_in_flight=config.get("MAX_IN_FLIGHT", MAX_IN_FLIGHT),
+            action=config.get("ACTION", REJECT),
+            retry_after=config.get("RETRY_AFTER", RETRY_AFTER),
+            rate=config.get("RATE"),
+            burst=config.get("BURST", BURST),
+            max_sources=config.get("MAX_SOURCES", MAX_SOURCES),
+        )
+
+    def admit(self, datagram, context):
+        """
+        Admits a message or turns it away, every admitted message must be
+        freed once handled, by the Slot from slot() or by release()
+
+        :param datagram: raw message
+        :param context: RequestContext it arrived with
+        :return: True when admitted
+        """
+        if self.limiter is not None and not self.limiter.allow(context[0]):
+            with self._lock:
+                self.shed_rate += 1
+            self.reject(datagram, context)
+            return False
+        with self._lock:
+            if self.in_flight >= self.max_in_flight:
+                self.shed_overload += 1
+                overloaded = True
+            else:
+                overloaded = False
+                self.in_flight += 1
+                self.admitted += 1
+                if self.in_flight > self.peak:
+                    self.peak = self.in_flight
+        if overloaded:
+            self.reject(datagram, context)
+            return False
+        return True
+
+    def release(self):
+        with self._lock:
+            self.in_flight -= 1
+
+    def slot(self):
+        """ Slot freeing an admitted message once it and its tasks are done """
+        return Slot(self)
+
+    def reject(self, datagram, context):
+        if self.action != REJECT:
+            return
+        if self._prefix is None:
+            # Rendered on first use, after the Server header is configured
+            self._prefix = render_prefix(503, (("Retry-After", self.retry_after),))
+        response = fast_response(datagram, self._prefix)
+        if response is None:
+            return
+        try:
+            context.socket.sendto(response, context)
+        except OSError:
+            return
+        with self._lock:
+            self.rejected += 1
+
+    def stats(self):
+        """
+        :return: dict of the limits and counters
+        """
+        return {
+            "in_flight": self.in_flight,
+            "peak": self.peak,
+            "max_in_flight": self.max_in_flight,
+            "admitted": self.admitted,
+            "shed_overload": self.shed_overload,
+            "shed_rate": self.shed_rate,
+            "rejected": self.rejected,
+            "sources": len(self.limiter) if self.limiter is not None else 0,
+        }
+
+    def metrics(self):
+        """ Collector for Katari.metrics """
+        return [
+            ("katari_admission_in_flight", "gauge", (), self.in_flight),
+            ("katari_admission_max_in_flight", "gauge", (), self.max_in_flight),
+            ("katari_admission_shed_total", "counter", (("reason", "overload"),), self.shed_overload),
+            ("katari_admission_shed_total", "counter", (("reason", "rate"),), self.shed_rate),
+            ("katari_admission_rejected_total", "counter", (), self.rejected),
+        ]
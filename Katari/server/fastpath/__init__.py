@@ -0,0 +1,68 @@
+"""
+Fast path for OPTIONS pings and CRLF keepalives on UDP
+
+Recognised with a prefix check on the raw datagram and answered from a
+pre-rendered 200, copying only Via, From, To, Call-ID and CSeq, so no
+SipMessage is built and neither middleware nor the handler runs.
+"""
+import threading
+from Katari.sip.response import render_prefix, fast_response
+
+
+class FastPath:
+    """
+    :param options: answer OPTIONS with 200 without calling the handler
+    """
+
+    def __init__(self, options=False):
+        self.options = options
+        self.options_answered = 0
+        self.keepalives = 0
+        self._prefix = None
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_settings(cls, settings):
+        config = getattr(settings, "FAST_PATH", None) or {}
+        return cls(options=config.get("OPTIONS", False))
+
+    def handle(self, datagram, sock, address):
+        """
+        Answers or drops the datagram when it takes the fast path
+
+        :param datagram: raw datagram
+        :param sock: sender to answer on
+        :param address: peer address
+        :return: True when the datagram was handled here
+        """
+        first = datagram[:1]
+        if first in (b"\r", b"\n", b"") and not datagram.strip():
+            # Keepalive, or a stray empty datagram, nothing to answer over UDP
+            with self._lock:
+                self.keepalives += 1
+            return True
+        if not self.options or first != b"O" or datagram[:8] != b"OPTIONS ":
+            return False
+        if self._prefix is None:
+            # Rendered on first use, after the Server and Allow headers are configured
+            self._prefix = render_prefix(200, (("Accept", "application/sdp"),))
+        response = fast_response(datagram, self._prefix)
+        if response is None:
+            return False
+        try:
+            sock.sendto(response, address)
+        except OSError:
+            return True
+        with self._lock:
+            self.options_answered += 1
+        return True
+
+    def stats(self):
+        return {"options": self.options_answered, "keepalives": self.keepalives}
+
+    def metrics(self):
+        """ Collector for Katari.metrics """
+        return [
+            ("katari_fast_path_total", "counter", (("kind", "options"),), self.options_answered),
+            ("katari_fast_path_total", "counter", (("kind", "keepalive"),), self.keepalives),
+        ]
@@ -0,0 +1,272 @@
+"""
+SIP over TCP, RFC 3261 section 18.3
+
+Messages are framed on the blank line after the headers and the
+Content-Length header. Connections are kept per peer so responses and
+later requests to the same peer reuse the connection they arrived on.
+"""
+import re
+import time
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from Katari.server import RequestContext
+from Katari.server.udp import UDPSipServer
+
+
+# Largest message accepted on a connection, the connection is closed past this
+MAX_MESSAGE_SIZE = 65536
+
+# Connections with no traffic for this many seconds are closed
+IDLE_TIMEOUT = 300.0
+
+CONTENT_LENGTH = re.compile(rb"\r\n(?:content-length|l)[ \t]*:[ \t]*(\d+)", re.IGNORECASE)
+
+
+def message_length(buffer, max_message_size=MAX_MESSAGE_SIZE):
+    """
+    Length of the message at the start of buffer, None until all of it has
+    arrived
+
+    :param buffer: bytes or bytearray starting with a message
+    :param max_message_size:
+    :return:
+    :raises ValueError: when the message is larger than max_message_size
+    """
+    end = buffer.find(b"\r\n\r\n")
+    if end < 0:
+        if len(buffer) > max_message_size:
+            raise ValueError("headers larger than {} bytes".format(max_message_size))
+        return None
+    match = CONTENT_LENGTH.search(buffer, 0, end + 2)
+    total = end + 4 + (int(match.group(1)) if match else 0)
+    if total > max_message_size:
+        raise ValueError("message of {} bytes".format(total))
+    if len(buffer) < total:
+        return None
+    return total
+
+
+class SipStreamProtocol(asyncio.Protocol):
+    """
+    One TCP connection, splits the byte stream into SIP messages and feeds
+    them to the application
+    """
+
+    def __init__(self, registry, peer=None):
+        self.registry = registry
+        self.application = registry.application
+        self.transport = None
+        self.peer = peer
+        self.buffer = bytearray()
+        self.last_activity = time.monotonic()
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.peer = self.peer or transport.get_extra_info("peername")[:2]
+        # Stop reading from a peer that doesn't read its responses
+        transport.set_write_buffer_limits(high=self.registry.max_message_size * 4)
+        self.registry.add(self.peer, self)
+
+    def connection_lost(self, exc):
+        self.registry.remove(self.peer, self)
+
+    def pause_writing(self):
+        self.transport.pause_reading()
+
+    def resume_writing(self):
+        self.transport.resume_reading()
+
+    def data_received(self, data):
+        self.last_activity = time.monotonic()
+        buffer = self.buffer
+        buffer += data
+        while buffer:
+            if buffer[:2] == b"\r\n":
+                # RFC 5626 keepalive, a double CRLF ping is answered with one CRLF
+                if buffer[:4] == b"\r\n\r\n":
+                    del buffer[:4]
+                    self.transport.write(b"\r\n")
+                else:
+                    del buffer[:2]
+                continue
+            try:
+                total = message_length(buffer, self.registry.max_message_size)
+            except ValueError as err:
+                self.abort(str(err))
+                return
+            if total is None:
+                return
+            datagram = bytes(buffer[:total])
+            del buffer[:total]
+            self.dispatch(datagram)
+
+    def dispatch(self, datagram):
+        if not UDPSipServer.check_allowed(self.peer[0]):
+            return
+        context = RequestContext(self.peer, self.registry, self.registry.transport)
+        if not self.application.admit(datagram, context):
+            return
+        if self.registry.executor is not None:
+            self.registry.loop.run_in_executor(
+                self.registry.executor, self.application._run_admitted, datagram, context
+            )
+        else:
+            self.application._run_admitted(datagram, context)
+
+    def abort(self, reason):
+        self.application.logger.error("Closing TCP connection from {}, {}".format(self.peer[0], reason))
+        self.buffer.clear()
+        self.transport.abort()
+
+
+class TCPConnections:
+    """
+    Connections by peer address, sendto writes on the peer's connection
+    and opens one when there is none so it can stand in for a UDP socket
+    """
+
+    transport = "TCP"
+
+    # ssl.SSLContext for outbound connections, set by the TLS transport
+    ssl = None
+
+    def __init__(self, application, loop, executor=None, max_message_size=MAX_MESSAGE_SIZE,
+                 idle_timeout=IDLE_TIMEOUT):
+        self.application = application
+        self.loop = loop
+        self.executor = executor
+        self.max_message_size = max_message_size
+        self.idle_timeout = idle_timeout
+        self.connections = {}
+        self._pending = {}
+        self._loop_thread = threading.get_ident()
+
+    def __len__(self):
+        return len(self.connections)
+
+    def add(self, peer, protocol):
+        self.connections[peer] = protocol
+
+    def remove(self, peer, protocol):
+        if self.connections.get(peer) is protocol:
+            del self.connections[peer]
+
+    def sendto(self, data, address):
+        """
+        Mirrors socket.sendto so KatariApplication.send works unchanged
+
+        :param data:
+        :param address:
+        :return:
+        """
+        if threading.get_ident() != self._loop_thread:
+            self.loop.call_soon_threadsafe(self.sendto, data, address)
+            return
+        address = tuple(address[:2])
+        protocol = self.connections.get(address)
+        if protocol is not None and not protocol.transport.is_closing():
+            protocol.transport.write(data)
+            return
+        queued = self._pending.get(address)
+        if queued is not None:
+            queued.append(data)
+            return
+        self._pending[address] = [data]
+        self.loop.create_task(self._connect(address))
+
+    async def _connect(self, address):
+        try:
+            _, protocol = await self.loop.create_connection(
+                lambda: SipStreamProtocol(self, address), address[0], address[1],
+                ssl=self.ssl, server_hostname=address[0] if self.ssl else None,
+            )
+        except OSError as err:
+            self._pending.pop(address, None)
+            self.application.logger.error("{} connection to {}:{} failed, {}".format(
+                "TLS" if self.ssl else "TCP", address[0], address[1], err))
+            return
+        for data in self._pending.pop(address, ()):
+            protocol.transport.write(data)
+
+    async def close_idle(self):
+        while True:
+            await asyncio.sleep(min(self.idle_timeout, 30.0))
+            expired = time.monotonic() - self.idle_timeout
+            for protocol in list(self.connections.values()):
+                if protocol.last_activity < expired:
+                    protocol.transport.close()
+
+
+class TCPSipServer:
+    """
+    asyncio TCP server, enabled with TCP = True in settings
+    """
+    transport = "TCP"
+
+    @classmethod
+    def start(cls, ServerAddress, application):
+        """
+        Runs the event loop until interrupted
+
+        :param ServerAddress:
+        :param application:
+        :return:
+        """
+        workers = getattr(UDPSipServer.settings, "HANDLER_EXECUTOR_WORKERS", 0)
+        executor = ThreadPoolExecutor(max_workers=workers) if workers else None
+        try:
+            asyncio.run(cls.serve(ServerAddress, application, executor))
+        finally:
+            if executor is not None:
+                executor.shutdown(wait=False)
+
+    @classmethod
+    def start_background(cls, ServerAddress, application):
+        """
+        Runs the server on a daemon thread next to the UDP server
+
+        :param ServerAddress:
+        :param application:
+        :return: thread
+        """
+        thread = threading.Thread(
+            target=cls.start, args=(ServerAddress, application),
+            name="katari-{}".format(cls.transport.lower()), daemon=True
+        )
+        thread.start()
+        return thread
+
+    @classmethod
+    def create_registry(cls, application, loop, executor=None):
+        settings = UDPSipServer.settings
+        return TCPConnections(
+            application, loop, executor,
+            max_message_size=getattr(settings, "TCP_MAX_MESSAGE_SIZE", MAX_MESSAGE_SIZE),
+            idle_timeout=getattr(settings, "TCP_IDLE_TIMEOUT", IDLE_TIMEOUT),
+        )
+
+    @classmethod
+    def server_context(cls, application):
+        """ ssl.SSLContext for accepted connections, None for plain TCP """
+        return None
+
+    @classmethod
+    async def serve(cls, ServerAddress, application, executor=None, ready=None):
+        loop = asyncio.get_running_loop()
+        registry = cls.create_registry(application, loop, executor)
+        application.transports[cls.transport] = registry
+        server = await loop.create_server(
+            lambda: SipStreamProtocol(registry),
+            ServerAddress[0], ServerAddress[1],
+            ssl=cls.server_context(application),
+            reuse_port=UDPSipServer.reuse_port or None,
+        )
+        if ready is not None:
+            ready(server)
+        idle = loop.create_task(registry.close_idle())
+        try:
+            await server.serve_forever()
+        finally:
+            idle.cancel()
+            server.close()
@@ -0,0 +1,144 @@
+"""
+SIP over TLS, RFC 3261 section 26.2
+
+Runs the TCP stream transport over TLS. Accepted connections can resume
+sessions from tickets issued by the server context, outbound connections
+are kept per destination and resume the last session to the same host.
+"""
+import ssl
+from Katari.server.udp import UDPSipServer
+from Katari.server.tcp import TCPSipServer, TCPConnections, MAX_MESSAGE_SIZE, IDLE_TIMEOUT
+
+
+# TLS 1.3 tickets sent after each full handshake
+SESSION_TICKETS = 2
+
+
+class ResumingContext(ssl.SSLContext):
+    """
+    Client context which hands the last session to each host back to
+    OpenSSL, asyncio has no other way to pass session= for a connection
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__()
+        self.sessions = {}
+
+    def wrap_bio(self, incoming, outgoing, server_side=False, server_hostname=None, session=None):
+        if session is None and not server_side:
+            session = self.sessions.get(server_hostname)
+        return super().wrap_bio(incoming, outgoing, server_side, server_hostname, session)
+
+
+def create_server_context(settings):
+    """
+    SSLContext for accepted connections from TLS_* settings, TLS_CONTEXT is
+    used as is when set
+
+    :param settings:
+    :return:
+    """
+    context = getattr(settings, "TLS_CONTEXT", None)
+    if context is not None:
+        return context
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.load_cert_chain(settings.TLS_CERTFILE, getattr(settings, "TLS_KEYFILE", None))
+    cafile = getattr(settings, "TLS_CAFILE", None)
+    if cafile:
+        context.load_verify_locations(cafile)
+    if getattr(settings, "TLS_VERIFY_CLIENT", False):
+        context.verify_mode = ssl.CERT_REQUIRED
+    tickets = getattr(settings, "TLS_SESSION_TICKETS", SESSION_TICKETS)
+    if tickets:
+        context.options &= ~ssl.OP_NO_TICKET
+        context.num_tickets = tickets
+    else:
+        context.options |= ssl.OP_NO_TICKET
+        context.num_tickets = 0
+    return context
+
+
+def create_client_context(settings):
+    """
+    ResumingContext for outbound connections, TLS_CLIENT_CONTEXT is used as
+    is when set
+
+    :param settings:
+    :return:
+    """
+    context = getattr(settings, "TLS_CLIENT_CONTEXT", None)
+    if context is not None:
+        return context
+    context = ResumingContext(ssl.PROTOCOL_TLS_CLIENT)
+    cafile = getattr(settings, "TLS_CAFILE", None)
+    if cafile:
+        context.load_verify_locations(cafile)
+    else:
+        context.load_default_certs()
+    if not getattr(settings, "TLS_VERIFY_SERVER", True):
+        context.check_hostname = False
+        context.verify_mode = ssl.CERT_NONE
+    certfile = getattr(settings, "TLS_CERTFILE", None)
+    if certfile:
+        # Presented when the far end asks for a client certificate
+        context.load_cert_chain(certfile, getattr(settings, "TLS_KEYFILE", None))
+    return context
+
+
+class TLSConnections(TCPConnections):
+    """
+    TCPConnections over TLS, counts handshakes and remembers the session of
+    every outbound connection for the next connection to that host
+    """
+    transport = "TLS"
+
+    def __init__(self, application, loop, client_context, executor=None, **kwargs):
+        super().__init__(application, loop, executor, **kwargs)
+        self.ssl = client_context
+        self.handshakes = 0
+        self.resumed = 0
+
+    def add(self, peer, protocol):
+        super().add(peer, protocol)
+        ssl_object = protocol.transport.get_extra_info("ssl_object")
+        if ssl_object is None:
+            return
+        self.handshakes += 1
+        if ssl_object.session_reused:
+            self.resumed += 1
+        self._save_session(peer, ssl_object)
+
+    def remove(self, peer, protocol):
+        super().remove(peer, protocol)
+        ssl_object = protocol.transport.get_extra_info("ssl_object")
+        if ssl_object is not None:
+            # TLS 1.3 tickets arrive after the handshake
+            self._save_session(peer, ssl_object)
+
+    def _save_session(self, peer, ssl_object):
+        sessions = getattr(self.ssl, "sessions", None)
+        if sessions is not None and not ssl_object.server_side and ssl_object.session is not None:
+            sessions[peer[0]] = ssl_object.session
+
+
+class TLSSipServer(TCPSipServer):
+    """
+    asyncio TLS server, enabled with TLS = True in settings
+    """
+    transport = "TLS"
+
+    @classmethod
+    def create_registry(cls, application, loop, executor=None):
+        settings = UDPSipServer.settings
+        return TLSConnections(
+            application, loop, create_client_context(settings), executor,
+            max_message_size=getattr(settings, "TCP_MAX_MESSAGE_SIZE", MAX_MESSAGE_SIZE),
+            idle_timeout=getattr(settings, "TCP_IDLE_TIMEOUT", IDLE_TIMEOUT),
+        )
+
+    @classmethod
+    def server_context(cls, application):
+        # Created before workers are forked so they share the ticket keys
+        if getattr(application, "tls_context", None) is None:
+            application.tls_context = create_server_context(UDPSipServer.settings)
+        return application.tls_context
@@ -1,32 +1,41 @@
+import socket
+import asyncio
 import threading
 import socketserver
-from Katari.sip import SipMessage
+from concurrent.futures import ThreadPoolExecutor
+from Katari.server import RequestContext
+from Katari.server.acl import AccessList
+from Katari.server.udp.mmsg import BatchSocket
 
 
 class UDPSipServer(socketserver.DatagramRequestHandler):
 
     application = None
     settings = None
+    reuse_port = False
+    # AccessList compiled from ALLOWED_HOSTS and DENIED_HOSTS of acl_settings
+    acl = None
+    acl_settings = None
 
     def handle(self):
         """
+        Allowed, fast path checked and admitted by ThreadingUDPServer.verify_request
 
         :return:
         """
+        UDPSipServer.application._run_admitted(self.rfile.read(), RequestContext(self.client_address, self.request[1]))
 
-        if not UDPSipServer.check_allowed(self.client_address[0]):
-            return
-
-        datagram = self.rfile.read()
-        message = SipMessage(datagram)
-        UDPSipServer.application.socket = self.request
-        UDPSipServer.application.client = self.client_address
-        UDPSipServer.application._server_run(message, self.client_address)
+    def finish(self):
+        # Responses are sent through application.send, only flush wfile when
+        # something was written to it instead of sending an empty datagram
+        if self.wfile.getvalue():
+            super().finish()
 
     @staticmethod
     def start(ServerAddress, applcation):
         """
-        Forks application to handle request
+        Forks application to handle request, SERVER_MODE in settings
+        selects between the threaded, asyncio and batch servers
 
         :param ServerAddress:
         :param applcation:
@@ -34,15 +43,229 @@ class UDPSipServer(socketserver.DatagramRequestHandler):
         """
 
         UDPSipServer.application = applcation
-        UDPServerObject = socketserver.ThreadingUDPServer(ServerAddress, UDPSipServer)
+        mode = getattr(UDPSipServer.settings, "SERVER_MODE", "threaded")
+        if mode == "asyncio":
+            AsyncUDPSipServer.start(ServerAddress, applcation)
+            return
+        if mode == "batch":
+            BatchUDPSipServer.start(ServerAddress, applcation)
+            return
+        UDPServerObject = ThreadingUDPServer(ServerAddress, UDPSipServer)
+        applcation.transports["UDP"] = UDPServerObject.socket
         UDPServerObject.serve_forever()
 
 
+    @staticmethod
+    def compile_acl():
+        """
+        Compiles the access list from the current settings
+
+        :return: AccessList
+        """
+        settings = UDPSipServer.settings
+        UDPSipServer.acl = AccessList.from_settings(settings)
+        UDPSipServer.acl_settings = settings
+        return UDPSipServer.acl
+
     @staticmethod
     def check_allowed(address):
-        if len(UDPSipServer.settings.ALLOWED_HOSTS) <= 0:
-            return True
-        elif address in UDPSipServer.settings.ALLOWED_HOSTS:
+        acl = UDPSipServer.acl
+        if acl is None or UDPSipServer.acl_settings is not UDPSipServer.settings:
+            # Settings were replaced since the list was compiled
+            acl = UDPSipServer.compile_acl()
+        if acl.allows(address):
             return True
+        metrics = getattr(UDPSipServer.application, "metrics", None)
+        if metrics is not None:
+            metrics.inc("katari_acl_rejected_total")
         return False
 
+
+class ThreadingUDPServer(socketserver.ThreadingUDPServer):
+    """
+    ThreadingUDPServer which sets SO_REUSEPORT for multi-worker mode, and
+    turns datagrams away before a thread is started for them
+    """
+
+    def verify_request(self, request, client_address):
+        if not UDPSipServer.check_allowed(client_address[0]):
+            return False
+        application = UDPSipServer.application
+        if application.fast_path.handle(request[0], request[1], client_address):
+            return False
+        return application.admit(request[0], RequestContext(client_address, request[1]))
+
+    def server_bind(self):
+        if UDPSipServer.reuse_port:
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        super().server_bind()
+
+
+class SipDatagramProtocol(asyncio.DatagramProtocol):
+    """
+    Receives datagrams on the event loop and feeds them to the application,
+    sync handlers are run on the executor when one is configured
+    """
+
+    def __init__(self, application, executor=None):
+        self.application = application
+        self.executor = executor
+        self.transport = None
+        self.loop = None
+        self._loop_thread = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.loop = asyncio.get_running_loop()
+        self._loop_thread = threading.get_ident()
+
+    def datagram_received(self, datagram, client_address):
+        if not UDPSipServer.check_allowed(client_address[0]):
+            return
+        if self.application.fast_path.handle(datagram, self, client_address):
+            return
+
+        context = RequestContext(client_address, self)
+        if not self.application.admit(datagram, context):
+            return
+        if self.executor is not None:
+            self.loop.run_in_executor(
+                self.executor, self.application._run_admitted, datagram, context
+            )
+        else:
+            self.application._run_admitted(datagram, context)
+
+    def sendto(self, data, address):
+        """
+        Mirrors socket.sendto so KatariApplication.send works unchanged,
+        calls from executor threads are handed back to the loop
+
+        :param data:
+        :param address:
+        :return:
+        """
+        if threading.get_ident() == self._loop_thread:
+            self.transport.sendto(data, address)
+        else:
+            self.loop.call_soon_threadsafe(self.transport.sendto, data, address)
+
+    def error_received(self, exc):
+        self.application.logger.error(exc)
+
+
+class AsyncUDPSipServer:
+    """
+    Single event loop UDP server, selected with SERVER_MODE = "asyncio"
+    """
+
+    @staticmethod
+    def start(ServerAddress, application):
+        """
+        Runs the event loop until interrupted
+
+        :param ServerAddress:
+        :param application:
+        :return:
+        """
+        workers = getattr(UDPSipServer.settings, "HANDLER_EXECUTOR_WORKERS", 0)
+        executor = ThreadPoolExecutor(max_workers=workers) if workers else None
+        try:
+            asyncio.run(AsyncUDPSipServer.serve(ServerAddress, application, executor))
+        finally:
+            if executor is not None:
+                executor.shutdown(wait=False)
+
+    @staticmethod
+    async def serve(ServerAddress, application, executor=None):
+        loop = asyncio.get_running_loop()
+        application.loop = loop
+        transport, protocol = await loop.create_datagram_endpoint(
+            lambda: SipDatagramProtocol(application, executor),
+            local_addr=ServerAddress,
+            reuse_port=UDPSipServer.reuse_port or None,
+        )
+        application.transports["UDP"] = protocol
+        try:
+            await loop.create_future()
+        finally:
+            transport.close()
+
+
+
+class BatchSender:
+    """
+    Queues responses sent while a batch is processed so they go out in one
+    send_batch call, sends from other threads (transaction timers, executor)
+    go straight to the socket
+    """
+
+    def __init__(self, batch_socket):
+        self.batch_socket = batch_socket
+        self.pending = []
+        self._loop_thread = threading.get_ident()
+
+    def sendto(self, data, address):
+        if threading.get_ident() == self._loop_thread:
+            self.pending.append((data, address))
+        else:
+            self.batch_socket.sock.sendto(data, address)
+
+    def flush(self):
+        if self.pending:
+            pending, self.pending = self.pending, []
+            self.batch_socket.send_batch(pending)
+
+
+class BatchUDPSipServer:
+    """
+    Single thread UDP server reading and writing many datagrams per system
+    call with recvmmsg/sendmmsg, selected with SERVER_MODE = "batch"
+    """
+
+    @staticmethod
+    def start(ServerAddress, application):
+        sock = BatchUDPSipServer.bind(ServerAddress)
+        try:
+            BatchUDPSipServer.serve(sock, application)
+        finally:
+            sock.close()
+
+    @staticmethod
+    def bind(ServerAddress):
+        family = socket.AF_INET6 if ":" in ServerAddress[0] else socket.AF_INET
+        sock = socket.socket(family, socket.SOCK_DGRAM)
+        if UDPSipServer.reuse_port:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        sock.bind(ServerAddress)
+        return sock
+
+    @staticmethod
+    def serve(sock, application):
+        """
+        Receives a batch, runs every message through the application and
+        flushes the responses, until interrupted
+
+        :param sock: bound UDP socket
+        :param application:
+        :return:
+        """
+        batch_size = getattr(UDPSipServer.settings, "BATCH_SIZE", 64)
+        batch_socket = BatchSocket(sock, batch_size)
+        sender = BatchSender(batch_socket)
+        application.transports["UDP"] = sender
+        check_allowed = UDPSipServer.check_allowed
+        fast_path = application.fast_path.handle
+        while True:
+            for datagram, client_address in batch_socket.recv_batch():
+                if not check_allowed(client_address[0]):
+                    continue
+                if fast_path(datagram, sender, client_address):
+                    continue
+                context = RequestContext(client_address, sender)
+                if not application.admit(datagram, context):
+                    continue
+                application._run_admitted(datagram, context)
+            try:
+                sender.flush()
+            except OSError as err:
+                application.logger.error(err)
@@ -0,0 +1,209 @@
+"""
+recvmmsg/sendmmsg through ctypes, many datagrams per system call on Linux
+
+BatchSocket falls back to a recvfrom/sendto loop where the calls are not
+available, so the batch server still runs (one call per datagram) on other
+platforms.
+"""
+import sys
+import errno
+import socket
+import struct
+import ctypes
+import ctypes.util
+
+
+MSG_DONTWAIT = 0x40
+MSG_WAITFORONE = 0x10000
+
+SOCKADDR_SIZE = 128
+
+
+class iovec(ctypes.Structure):
+    _fields_ = [("iov_base", ctypes.c_void_p), ("iov_len", ctypes.c_size_t)]
+
+
+class msghdr(ctypes.Structure):
+    _fields_ = [
+        ("msg_name", ctypes.c_void_p),
+        ("msg_namelen", ctypes.c_uint32),
+        ("msg_iov", ctypes.POINTER(iovec)),
+        ("msg_iovlen", ctypes.c_size_t),
+        ("msg_control", ctypes.c_void_p),
+        ("msg_controllen", ctypes.c_size_t),
+        ("msg_flags", ctypes.c_int),
+    ]
+
+
+class mmsghdr(ctypes.Structure):
+    _fields_ = [("msg_hdr", msghdr), ("msg_len", ctypes.c_uint)]
+
+
+def _load_libc():
+    if not sys.platform.startswith("linux"):
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        recvmmsg, sendmmsg = libc.recvmmsg, libc.sendmmsg
+    except (OSError, AttributeError):
+        return None
+    recvmmsg.argtypes = [
+        ctypes.c_int, ctypes.POINTER(mmsghdr), ctypes.c_uint, ctypes.c_int, ctypes.c_void_p
+    ]
+    recvmmsg.restype = ctypes.c_int
+    sendmmsg.argtypes = [ctypes.c_int, ctypes.POINTER(mmsghdr), ctypes.c_uint, ctypes.c_int]
+    sendmmsg.restype = ctypes.c_int
+    return libc
+
+
+libc = _load_libc()
+AVAILABLE = libc is not None
+
+
+def decode_address(buffer):
+    """
+    sockaddr_in / sockaddr_in6 -> (host, port) like recvfrom returns
+
+    :param buffer: ctypes char buffer
+    :return:
+    """
+    raw = ctypes.string_at(ctypes.addressof(buffer), 28)
+    family = struct.unpack_from("=H", raw)[0]
+    port = struct.unpack_from("!H", raw, 2)[0]
+    if family == socket.AF_INET6:
+        flowinfo, = struct.unpack_from("!I", raw, 4)
+        scope_id, = struct.unpack_from("=I", raw, 24)
+        return socket.inet_ntop(socket.AF_INET6, raw[8:24]), port, flowinfo, scope_id
+    return socket.inet_ntop(socket.AF_INET, raw[4:8]), port
+
+
+def encode_address(address, family):
+    """
+    (host, port) -> packed sockaddr
+
+    :param address:
+    :param family: socket family of the sending socket
+    :return: bytes
+    """
+    if family == socket.AF_INET6:
+        host, port = address[0], address[1]
+        flowinfo = address[2] if len(address) > 2 else 0
+        scope_id = address[3] if len(address) > 3 else 0
+        if ":" not in host:
+            host = "::ffff:" + host
+        return (struct.pack("=H", socket.AF_INET6) + struct.pack("!HI", port, flowinfo)
+                + socket.inet_pton(socket.AF_INET6, host) + struct.pack("=I", scope_id))
+    return (struct.pack("=H", socket.AF_INET) + struct.pack("!H", address[1])
+            + socket.inet_pton(socket.AF_INET, address[0]) + bytes(8))
+
+
+class BatchSocket:
+    """
+    Wraps a bound UDP socket with recv_batch/send_batch, the receive
+    buffers are allocated once and reused for every batch
+    """
+
+    def __init__(self, sock, batch_size=64, buffer_size=65535):
+        self.sock = sock
+        self.family = sock.family
+        self.batch_size = batch_size
+        self.buffer_size = buffer_size
+        self.mmsg = AVAILABLE
+        if self.mmsg:
+            self._buffers = [ctypes.create_string_buffer(buffer_size) for _ in range(batch_size)]
+            self._names = [ctypes.create_string_buffer(SOCKADDR_SIZE) for _ in range(batch_size)]
+            self._addresses = [ctypes.addressof(buffer) for buffer in self._buffers]
+            self._iovecs = (iovec * batch_size)()
+            self._messages = (mmsghdr * batch_size)()
+            for i in range(batch_size):
+                self._iovecs[i].iov_base = self._addresses[i]
+                self._iovecs[i].iov_len = buffer_size
+                header = self._messages[i].msg_hdr
+                header.msg_iov = ctypes.pointer(self._iovecs[i])
+                header.msg_iovlen = 1
+                header.msg_name = ctypes.addressof(self._names[i])
+
+    def recv_batch(self):
+        """
+        Blocks until at least one datagram arrives, then returns it with
+        whatever else is already queued, up to batch_size
+
+        :return: list of (bytes, address)
+        """
+        if not self.mmsg:
+            return self._recv_loop()
+        messages = self._messages
+        for i in range(self.batch_size):
+            messages[i].msg_hdr.msg_namelen = SOCKADDR_SIZE
+        count = libc.recvmmsg(
+            self.sock.fileno(), messages, self.batch_size, MSG_WAITFORONE, None
+        )
+        if count < 0:
+            error = ctypes.get_errno()
+            if error in (errno.EINTR, errno.EAGAIN):
+                return []
+            raise OSError(error, "recvmmsg: " + errno.errorcode.get(error, str(error)))
+        string_at = ctypes.string_at
+        return [
+            (string_at(self._addresses[i], messages[i].msg_len), decode_address(self._names[i]))
+            for i in range(count)
+        ]
+
+    def _recv_loop(self):
+        """ recvfrom until the socket is empty, for platforms without recvmmsg """
+        datagrams = [self.sock.recvfrom(self.buffer_size)]
+        try:
+            while len(datagrams) < self.batch_size:
+                datagrams.append(self.sock.recvfrom(self.buffer_size, MSG_DONTWAIT))
+        except (BlockingIOError, InterruptedError):
+            pass
+        return datagrams
+
+    def send_batch(self, datagrams):
+        """
+        Sends every (data, address) pair, batch_size per system call
+
+        :param datagrams: list of (bytes, address)
+        :return:
+        """
+        if not self.mmsg:
+            for data, address in datagrams:
+                self.sock.sendto(data, address)
+            return
+        for start in range(0, len(datagrams), self.batch_size):
+            self._sendmmsg(datagrams[start:start + self.batch_size])
+
+    def _sendmmsg(self, datagrams):
+        count = len(datagrams)
+        messages = (mmsghdr * count)()
+        iovecs = (iovec * count)()
+        keep = []
+        for i, (data, address) in enumerate(datagrams):
+            data = (ctypes.c_char * len(data)).from_buffer_copy(data)
+            name = encode_address(address, self.family)
+            name_buffer = ctypes.create_string_buffer(name, len(name))
+            keep.append((data, name_buffer))
+            iovecs[i].iov_base = ctypes.addressof(data)
+            iovecs[i].iov_len = len(data)
+            header = messages[i].msg_hdr
+            header.msg_iov = ctypes.pointer(iovecs[i])
+            header.msg_iovlen = 1
+            header.msg_name = ctypes.addressof(name_buffer)
+            header.msg_namelen = len(name)
+        sent = 0
+        failure = None
+        while sent < count:
+            result = libc.sendmmsg(
+                self.sock.fileno(), ctypes.byref(messages[sent]), count - sent, 0
+            )
+            if result < 0:
+                error = ctypes.get_errno()
+                if error == errno.EINTR:
+                    continue
+                # The datagram at sent failed, skip it and carry on with the rest
+                failure = failure or OSError(error, "sendmmsg: " + errno.errorcode.get(error, str(error)))
+                sent += 1
+                continue
+            sent += result
+        if failure is not None:
+            raise failure
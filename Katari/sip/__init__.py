@@ -1,36 +1,26 @@
-import logging
-from Katari.sip.utils import Message, URI
+from Katari.sip.utils import Message, header_prefix, _header_prefixes
+
+
+# Headers copied from a request into its response
+DIALOG_HEADERS = ("via", "from", "to", "call-id", "cseq")
 
 
 class SipMessage(Message):
     def __init__(self, message=None):
         super().__init__(message=message)
         self._payload = None
-        self.log = logging.getLogger('Katari')
 
     def get_to(self):
-        try:
-            return self._data["to"]
-        except KeyError:
-            return None
+        return self._header("to")
 
     def get_from(self):
-        try:
-            return self._data["from"]
-        except KeyError:
-            return None
+        return self._header("from")
 
     def get_via(self):
-        try:
-            return self._data["via"]
-        except KeyError:
-            return None
+        return self._header("via")
         
     def get_contact(self):
-        try:
-            return self._data['contact']
-        except:
-            return None
+        return self._header("contact")
     
     def get_call_id(self):
         try:
@@ -45,10 +35,7 @@ class SipMessage(Message):
             return None
     
     def get_cseq(self):
-        try:
-            return self._data['cseq']
-        except KeyError:
-            return None
+        return self._header("cseq")
 
     def get_message_type(self):
         try:
@@ -58,8 +45,8 @@ class SipMessage(Message):
 
     def get_content_length(self):
         try:
-            self._data["content-length"]
-        except:
+            return self._data["content-length"]
+        except KeyError:
             return None
 
     def set_via(self, via):
@@ -90,44 +77,54 @@ class SipMessage(Message):
         self._data["content-length"] = content_length
 
     def export(self):
-        message = ""
-        message = message + self.method_line
-        for k, v in self._data.items():
-            value = str(v).replace('\r\n','')
-            value = value.replace('\r','')
-            line = k.capitalize() + ": " + value + "\r\n"
-            message = message + line 
-        message = message + "\r\n\r\n"
-        return message
+        return self.export_bytes().decode("utf-8", "replace")
+
+    def export_bytes(self):
+        """
+        Serialises the message to wire format in one pass
+
+        :return: bytes
+        """
+        lines = [self.method_line]
+        self._header_lines(lines)
+        lines.append("\r\n")
+        data = "".join(lines).encode()
+        body = self.body
+        if body:
+            if isinstance(body, str):
+                body = body.encode()
+            data = data + body
+        return data
+
+    def _header_lines(self, lines, skip=None):
+        prefixes = _header_prefixes
+        for k, values in self._data.items():
+            if k == skip:
+                continue
+            prefix = prefixes.get(k) or header_prefix(k)
+            if not isinstance(values, list):
+                values = (values,)
+            for v in values:
+                value = str(v)
+                if "\r" in value or "\n" in value:
+                    value = value.replace("\r", "").replace("\n", "")
+                lines.append(prefix + value + "\r\n")
+        return lines
 
     def create_response(self, message=None):
-        try:
-            message.set_via(self._data['via'])
-        except KeyError:
-            self.log.debug("Via Header not in request")
-        try:
-            message.set_from(self._data['from'])
-        except KeyError:
-            self.log.debug("From Header not in request")
-        try:
-            message.set_to(self._data['to'])
-        except KeyError :
-            self.log.debug("To Header not in request")
-        try:
-            message.set_contact(self._data['contact'])
-        except KeyError:
-            self.log.debug("Contact Header not in request")
-        try:
-            message.set_call_id(self._data['call-id'])
-        except KeyError:
-            self.log.debug("Call-ID Header not in request")
-        try:
-            message.set_cseq(self._data['cseq'])
-        except KeyError:
-            self.log.exception("CSeq Header not in request")
-        try:
-            message.set_content_length(self._data['content-length'])
-        except KeyError:
-            self.log.exception("Content-Length Header not in request")
+        """
+        Copies the dialog headers (Via, From, To, Call-ID, CSeq) from this
+        request into the response, Contact is copied for REGISTER
+
+        :param message: response
+        :return:
+        """
+        data = self._data
+        response = message._data
+        for name in DIALOG_HEADERS:
+            value = data.get(name)
+            if value is not None:
+                response[name] = value[:] if isinstance(value, list) else value
+        if getattr(self, "sip_type", None) == "REGISTER" and "contact" in data:
+            message.set_contact(data["contact"])
         return message
-        
\ No newline at end of file
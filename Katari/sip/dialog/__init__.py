@@ -0,0 +1,360 @@
+"""
+Dialog state, RFC 3261 section 12
+
+Dialogs are keyed on the Call-ID and both tags, the tags sorted so a
+request from either side finds the same dialog. Records are evicted after
+TTL seconds without use, or least recently used first once the store is
+over its memory cap.
+"""
+import os
+import time
+import pickle
+import sqlite3
+import threading
+from collections import OrderedDict
+from Katari.interfaces import DialogBackendInterface
+
+
+EARLY = "early"
+CONFIRMED = "confirmed"
+TERMINATED = "terminated"
+
+# Seconds a dialog is kept without any request or response on it
+DIALOG_TTL = 3600
+
+MAX_MEMORY = 64 * 1024 * 1024
+
+# Fixed part of Dialog.size(), a slotted instance plus the OrderedDict entry
+RECORD_OVERHEAD = 240
+
+# Backend expiry runs at most this often
+SWEEP_INTERVAL = 1.0
+
+
+def dialog_key(call_id, tag, other_tag):
+    """
+    Key for the dialog, the same whichever side the tags come from
+
+    :param call_id:
+    :param tag:
+    :param other_tag:
+    :return: str
+    """
+    if (tag or "") > (other_tag or ""):
+        tag, other_tag = other_tag, tag
+    return "{};{};{}".format(call_id, tag or "", other_tag or "")
+
+
+def message_key(message):
+    """
+    dialog_key for a request or response, None without Call-ID
+
+    :param message:
+    :return:
+    """
+    call_id = message.get_call_id()
+    if call_id is None:
+        return None
+    to, from_ = message.get_to(), message.get_from()
+    return dialog_key(
+        call_id,
+        from_.tag if from_ is not None else None,
+        to.tag if to is not None else None,
+    )
+
+
+class Dialog:
+    """
+    Compact dialog record, data holds whatever the application keeps per dialog
+    """
+    __slots__ = (
+        "call_id", "local_tag", "remote_tag", "state", "remote_cseq", "created", "last_seen", "data",
+    )
+
+    def __init__(self, call_id, local_tag, remote_tag, state=EARLY, remote_cseq=None,
+                 created=None, last_seen=None, data=None):
+        self.call_id = call_id
+        self.local_tag = local_tag
+        self.remote_tag = remote_tag
+        self.state = state
+        self.remote_cseq = remote_cseq
+        self.created = created or time.time()
+        self.last_seen = last_seen or self.created
+        self.data = data
+
+    def __repr__(self):
+        return "Dialog({}, {})".format(self.call_id, self.state)
+
+    @property
+    def key(self):
+        return dialog_key(self.call_id, self.remote_tag, self.local_tag)
+
+    def size(self):
+        """ Approximate memory used by the record, for the memory cap """
+        size = RECORD_OVERHEAD + len(self.call_id) + len(self.local_tag or "") + len(self.remote_tag or "")
+        if self.data:
+            size += 64 * len(self.data)
+        return size
+
+    def to_tuple(self):
+        return (self.call_id, self.local_tag, self.remote_tag, self.state, self.remote_cseq,
+                self.created, self.last_seen, self.data)
+
+    @classmethod
+    def from_tuple(cls, record):
+        return cls(*record)
+
+
+class MemoryBackend(DialogBackendInterface):
+    """
+    Dialogs in an OrderedDict kept in use order, so both the idle ones and
+    the least recently used are at the front
+    """
+
+    def __init__(self, ttl=DIALOG_TTL, max_memory=MAX_MEMORY):
+        self.ttl = ttl
+        self.max_memory = max_memory
+        self.memory = 0
+        self.evicted = 0
+        self._records = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._records)
+
+    def get(self, key):
+        with self._lock:
+            record = self._records.get(key)
+            if record is None:
+                return None
+            now = time.time()
+            if record.last_seen < now - self.ttl:
+                self._pop(key)
+                return None
+            # Use order and last_seen order stay the same, expire() relies on it
+            record.last_seen = now
+            self._records.move_to_end(key)
+            return record
+
+    def set(self, key, record):
+        with self._lock:
+            old = self._records.get(key)
+            if old is not None:
+                self.memory -= old.size()
+            self._records[key] = record
+            self._records.move_to_end(key)
+            self.memory += record.size()
+            while self.memory > self.max_memory and len(self._records) > 1:
+                self._pop(next(iter(self._records)))
+                self.evicted += 1
+
+    def delete(self, key):
+        with self._lock:
+            if key in self._records:
+                self._pop(key)
+
+    def expire(self, now):
+        removed = 0
+        idle = now - self.ttl
+        with self._lock:
+            records = self._records
+            while records:
+                key, record = next(iter(records.items()))
+                if record.last_seen >= idle:
+                    break
+                self._pop(key)
+                removed += 1
+        return removed
+
+    def _pop(self, key):
+        """ Caller holds the lock """
+        self.memory -= self._records.pop(key).size()
+
+
+class SQLiteBackend(DialogBackendInterface):
+    """
+    Dialogs in an SQLite file, worker processes opening the same path share
+    them. Records are evicted oldest update first past max_dialogs
+    """
+
+    def __init__(self, path, ttl=DIALOG_TTL, max_dialogs=1000000):
+        self.path = path
+        self.ttl = ttl
+        self.max_dialogs = max_dialogs
+        self._lock = threading.Lock()
+        self._pid = None
+        self._db = None
+        self._connect()
+
+    @property
+    def _connection(self):
+        # A connection must not be used across fork, each worker opens its own
+        if self._pid != os.getpid():
+            self._connect()
+        return self._db
+
+    def _connect(self):
+        self._pid = os.getpid()
+        self._db = sqlite3.connect(self.path, timeout=5.0, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS dialogs (key TEXT PRIMARY KEY, record BLOB, last_seen REAL)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS dialogs_last_seen ON dialogs (last_seen)")
+
+    def __len__(self):
+        with self._lock:
+            return self._connection.execute("SELECT COUNT(*) FROM dialogs").fetchone()[0]
+
+    def get(self, key):
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT record FROM dialogs WHERE key = ? AND last_seen >= ?",
+                (key, time.time() - self.ttl),
+            ).fetchone()
+        return Dialog.from_tuple(pickle.loads(row[0])) if row else None
+
+    def set(self, key, record):
+        data = pickle.dumps(record.to_tuple(), protocol=pickle.HIGHEST_PROTOCOL)
+        with self._lock:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO dialogs (key, record, last_seen) VALUES (?, ?, ?)",
+                (key, data, record.last_seen),
+            )
+
+    def delete(self, key):
+        with self._lock:
+            self._connection.execute("DELETE FROM dialogs WHERE key = ?", (key,))
+
+    def expire(self, now):
+        with self._lock:
+            removed = self._connection.execute(
+                "DELETE FROM dialogs WHERE last_seen < ?", (now - self.ttl,)
+            ).rowcount
+            count = self._connection.execute("SELECT COUNT(*) FROM dialogs").fetchone()[0]
+            if count > self.max_dialogs:
+                removed += self._connection.execute(
+                    "DELETE FROM dialogs WHERE key IN "
+                    "(SELECT key FROM dialogs ORDER BY last_seen LIMIT ?)",
+                    (count - self.max_dialogs,),
+                ).rowcount
+        return removed
+
+
+class DialogStore:
+    """
+    Creates, finds and ends dialogs from the messages a UAS receives and sends
+    """
+
+    def __init__(self, backend=None, sweep_interval=SWEEP_INTERVAL):
+        self.backend = backend if backend is not None else MemoryBackend()
+        self.sweep_interval = sweep_interval
+        self._next_sweep = 0.0
+
+    def __len__(self):
+        return len(self.backend)
+
+    def get(self, key):
+        return self.backend.get(key)
+
+    def lookup(self, message):
+        """
+        Dialog a request or response belongs to
+
+        :param message:
+        :return: Dialog or None
+        """
+        key = message_key(message)
+        if key is None:
+            return None
+        dialog = self.backend.get(key)
+        if dialog is not None:
+            dialog.last_seen = time.time()
+            self.backend.set(key, dialog)
+        self._sweep()
+        return dialog
+
+    def save(self, dialog):
+        """ Writes back a dialog after changing it, needed for shared backends """
+        dialog.last_seen = time.time()
+        self.backend.set(dialog.key, dialog)
+
+    def update(self, response):
+        """
+        Creates or moves on the dialog for a response sent to an INVITE,
+        a dialog ends with a failure to the INVITE or a 2xx to BYE
+
+        :param response:
+        :return: Dialog or None
+        """
+        cseq = response.get_cseq()
+        if cseq is None or isinstance(cseq, list):
+            return None
+        try:
+            code = int(response.method_line[8:11])
+        except ValueError:
+            return None
+        key = message_key(response)
+        if key is None:
+            return None
+        if cseq.method == "BYE" and code >= 200:
+            self.backend.delete(key)
+            return None
+        if cseq.method != "INVITE" or code < 101:
+            return None
+        to, from_ = response.get_to(), response.get_from()
+        local_tag = to.tag if to is not None else None
+        if local_tag is None:
+            return None
+        if code >= 300:
+            self.backend.delete(key)
+            return None
+        dialog = self.backend.get(key)
+        if dialog is None:
+            dialog = Dialog(response.get_call_id(), local_tag, from_.tag if from_ is not None else None)
+        if code >= 200:
+            dialog.state = CONFIRMED
+        dialog.remote_cseq = cseq.number
+        dialog.last_seen = time.time()
+        self.backend.set(key, dialog)
+        self._sweep()
+        return dialog
+
+    def terminate(self, message):
+        """ Ends the dialog a message belongs to """
+        key = message_key(message)
+        if key is not None:
+            self.backend.delete(key)
+
+    def _sweep(self):
+        now = time.time()
+        if now >= self._next_sweep:
+            self._next_sweep = now + self.sweep_interval
+            self.backend.expire(now)
+
+
+_store = None
+
+
+def get_dialog_store(settings=None):
+    """
+    Process wide dialog store shared by SessionHandler and handlers,
+    created from DIALOGS in settings on first use
+
+    :param settings:
+    :return:
+    """
+    global _store
+    if _store is None:
+        config = getattr(settings, "DIALOGS", None) or {}
+        backend = config.get("BACKEND", "memory")
+        ttl = config.get("TTL", DIALOG_TTL)
+        if backend == "memory":
+            backend = MemoryBackend(ttl, config.get("MAX_MEMORY", MAX_MEMORY))
+        elif backend == "sqlite":
+            backend = SQLiteBackend(config["PATH"], ttl, config.get("MAX_DIALOGS", 1000000))
+        elif isinstance(backend, str):
+            raise ValueError("Unknown dialog backend {}, please check settings.py".format(backend))
+        _store = DialogStore(backend)
+    return _store
@@ -1,35 +1,25 @@
-from Katari.sip import SipMessage
+from Katari.sip.response._status import SipResponse
 
 
-class Trying100(SipMessage):
-    def __init__(self):
-        super().__init__()
-        self.method_line = "SIP/2.0 100 Trying\r\n"
+class Trying100(SipResponse):
+    status_code = 100
 
 
-class Ringing180(SipMessage):
-    def __init__(self):
-        super().__init__()
-        self.method_line = "SIP/2.0 180 Ringing\r\n"
+class Ringing180(SipResponse):
+    status_code = 180
 
 
-class CallisBeingForwarded181:
-    def __init__(self):
-        pass
+class CallisBeingForwarded181(SipResponse):
+    status_code = 181
 
 
-class Queued182(SipMessage):
-    def __init__(self):
-        super().__init__()
-        self.method_line = "SIP/2.0 182 Queued\r\n"
+class Queued182(SipResponse):
+    status_code = 182
 
 
-class SessionProgress183(SipMessage):
-    def __init__(self):
-        super().__init__()
-        self.method_line = "SIP/2.0 183 Session Progress\r\n"
+class SessionProgress183(SipResponse):
+    status_code = 183
 
 
-class EarlyDialogTerminated199:
-    def __init__(self):
-        pass
+class EarlyDialogTerminated199(SipResponse):
+    status_code = 199
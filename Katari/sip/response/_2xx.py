@@ -1,19 +1,13 @@
-from Katari.sip import SipMessage
+from Katari.sip.response._status import SipResponse
 
 
-class OK200(SipMessage):
-    def __init__(self):
-        super().__init__()
-        self.method_line = "SIP/2.0 200 OK\r\n"
+class OK200(SipResponse):
+    status_code = 200
 
 
-class Accepted202(SipMessage):
-    def __init__(self):
-        super().__init__()
-        self.method_line = "SIP/2.0 202 Accepted\r\n"
+class Accepted202(SipResponse):
+    status_code = 202
 
 
-class NoNotification204(SipMessage):
-    def __init__(self):
-        super().__init__()
-        pass
+class NoNotification204(SipResponse):
+    status_code = 204
@@ -1,41 +1,32 @@
-from Katari.sip import SipMessage
+from Katari.sip.response._status import SipResponse
 
 
-class MultipleChoices300(SipMessage):
-    def __init__(self):
-        super().__init__()
-        self.method_line = "SIP/2.0 300 Multiple Choices\r\n"
+class MultipleChoices300(SipResponse):
+    status_code = 300
 
 
-class MovedPermanently301(SipMessage):
-    def __init__(self):
-        pass
+class MovedPermanently301(SipResponse):
+    status_code = 301
 
 
-class MovedTemporarily302(SipMessage):
-    def __init__(self):
-        super().__init__()
-        self.method_line = "SIP/2.0 302 Moved Temporarily\r\n"
+class MovedTemporarily302(SipResponse):
+    status_code = 302
 
     def append_contact(self, contact, weight):
         def create_sip_uri(contact, weight):
             return "<sip:{}>;q={}".format(contact, weight)
-        if self._data["contact"]:
+        if self._data.get("contact"):
             self._data["contact"] = self._data["contact"] + "," + create_sip_uri(contact, weight)
         else:
-            self._data["contact"] = self._data["contact"] + create_sip_uri(contact, weight)
+            self._data["contact"] = create_sip_uri(contact, weight)
 
     def clean_contact(self):
         self._data["contact"] = ""
 
 
+class UseProxy305(SipResponse):
+    status_code = 305
 
 
-class UseProxy305(SipMessage):
-    def __init__(self):
-        pass
-
-
-class AlternativeService380(SipMessage):
-    def __init__(self):
-        pass
+class AlternativeService380(SipResponse):
+    status_code = 380
@@ -1,42 +1,113 @@
-from Katari.sip import SipMessage
+from Katari.sip.response._status import SipResponse
 
 
-class BadRequest400(SipMessage):
-    def __init__(self):
-        pass
+class BadRequest400(SipResponse):
+    status_code = 400
 
 
-class Unauthorized401(SipMessage):
-    def __init__(self):
-        pass
+class Unauthorized401(SipResponse):
+    status_code = 401
 
 
-class PaymentRequired402(SipMessage):
-    def __init__(self):
-        pass
+class PaymentRequired402(SipResponse):
+    status_code = 402
 
 
-class Forbidden403(SipMessage):
-    def __init__(self):
-        pass
+class Forbidden403(SipResponse):
+    status_code = 403
 
 
-class NotFound404(SipMessage):
-    def __init__(self):
-        pass
+class NotFound404(SipResponse):
+    status_code = 404
 
 
-class MethodNotAllowed405(SipMessage):
-    def __init__(self):
-        super().__init__()
-        self.method_line = "SIP/2.0 405 Method Not Allowed\r\n"
+class MethodNotAllowed405(SipResponse):
+    status_code = 405
 
 
-class NotAcceptable406(SipMessage):
-    def __init__(self):
-        pass
+class NotAcceptable406(SipResponse):
+    status_code = 406
 
 
-class ProxyAuthenticationRequired407(SipMessage):
-    def __init__(self):
-        pass
+class ProxyAuthenticationRequired407(SipResponse):
+    status_code = 407
+
+
+class RequestTimeout408(SipResponse):
+    status_code = 408
+
+
+class Gone410(SipResponse):
+    status_code = 410
+
+
+class RequestEntityTooLarge413(SipResponse):
+    status_code = 413
+
+
+class RequestURITooLong414(SipResponse):
+    status_code = 414
+
+
+class UnsupportedMediaType415(SipResponse):
+    status_code = 415
+
+
+class UnsupportedURIScheme416(SipResponse):
+    status_code = 416
+
+
+class BadExtension420(SipResponse):
+    status_code = 420
+
+
+class ExtensionRequired421(SipResponse):
+    status_code = 421
+
+
+class IntervalTooBrief423(SipResponse):
+    status_code = 423
+
+
+class TemporarilyUnavailable480(SipResponse):
+    status_code = 480
+
+
+class CallTransactionDoesNotExist481(SipResponse):
+    status_code = 481
+
+
+class LoopDetected482(SipResponse):
+    status_code = 482
+
+
+class TooManyHops483(SipResponse):
+    status_code = 483
+
+
+class AddressIncomplete484(SipResponse):
+    status_code = 484
+
+
+class Ambiguous485(SipResponse):
+    status_code = 485
+
+
+class BusyHere486(SipResponse):
+    status_code = 486
+
+
+class RequestTerminated487(SipResponse):
+    status_code = 487
+
+
+class NotAcceptableHere488(SipResponse):
+    status_code = 488
+
+
+class RequestPending491(SipResponse):
+    status_code = 491
+
+
+class Undecipherable493(SipResponse):
+    status_code = 493
@@ -0,0 +1,29 @@
+from Katari.sip.response._status import SipResponse
+
+
+class ServerInternalError500(SipResponse):
+    status_code = 500
+
+
+class NotImplemented501(SipResponse):
+    status_code = 501
+
+
+class BadGateway502(SipResponse):
+    status_code = 502
+
+
+class ServiceUnavailable503(SipResponse):
+    status_code = 503
+
+
+class ServerTimeout504(SipResponse):
+    status_code = 504
+
+
+class VersionNotSupported505(SipResponse):
+    status_code = 505
+
+
+class MessageTooLarge513(SipResponse):
+    status_code = 513
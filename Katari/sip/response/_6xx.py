@@ -0,0 +1,17 @@
+from Katari.sip.response._status import SipResponse
+
+
+class BusyEverywhere600(SipResponse):
+    status_code = 600
+
+
+class Decline603(SipResponse):
+    status_code = 603
+
+
+class DoesNotExistAnywhere604(SipResponse):
+    status_code = 604
+
+
+class NotAcceptable606(SipResponse):
+    status_code = 606
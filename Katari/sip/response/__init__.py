@@ -1,62 +1,54 @@
+import re
 from Katari.sip import SipMessage
+from Katari.sip.response._status import STATUS_CODES, SipResponse
 from Katari.sip.response._1xx import *
 from Katari.sip.response._2xx import *
 from Katari.sip.response._3xx import *
 from Katari.sip.response._4xx import *
-
+from Katari.sip.response._5xx import *
+from Katari.sip.response._6xx import *
 
 
 class ResponseFactory:
 
+    # status code -> response class, filled from the SipResponse subclasses
+    responses = {}
+
     @staticmethod
     def build(code):
-        if code == 100:
-            return Trying100()
-        elif code == 180:
-            return Ringing180()
-        elif code == 181:
-            return CallisBeingForwarded181()
-        elif code == 182:
-            return Queued182
-        elif code == 183:
-            return SessionProgress183()
-        elif code == 199:
-            return EarlyDialogTerminated199()
-        elif code == 200:
-            return OK200()
-        elif code == 202:
-            return Accepted202()
-        elif code == 204:
-            return NoNotification204()
-        elif code == 300:
-            return MultipleChoices300()
-        elif code == 301:
-            return MovedPermanently301()
-        elif code == 302:
-            return MovedTemporarily302()
-        elif code == 305:
-            return UseProxy305()
-        elif code == 380:
-            return AlternativeService380()
-        elif code == 400:
-            return BadRequest400()
-        elif code == 401:
-            return Unauthorized401()
-        elif code == 402:
-            return PaymentRequired402()
-        elif code == 403:
-            return Forbidden403()
-        elif code == 404:
-            return NotFound404()
-        elif code == 405:
-            return MethodNotAllowed405()
-        elif code == 406:
-            return NotAcceptable406()
-        elif code == 407:
-            return ProxyAuthenticationRequired407()
-        else:
+        """
+        Returns a new response for any status code in STATUS_CODES
+
+        :param code:
+        :return:
+        """
+        try:
+            return ResponseFactory.responses[code]()
+        except KeyError:
+            if code in STATUS_CODES:
+                return SipResponse(code)
             return None
-        
+
+    @staticmethod
+    def configure(user_agent=None, allow=None):
+        """
+        Sets the Server and Allow headers rendered into every response template
+
+        :param user_agent:
+        :param allow:
+        :return:
+        """
+        SipResponse.configure(user_agent=user_agent, allow=allow)
+
+
+def _register_responses(cls):
+    for subclass in cls.__subclasses__():
+        if subclass.status_code is not None:
+            ResponseFactory.responses[subclass.status_code] = subclass
+        _register_responses(subclass)
+
+
+_register_responses(SipResponse)
 
 
 class NullMessage(SipMessage):
@@ -71,3 +63,48 @@ class Ack(SipMessage):
         super().__init__()
         self.sip_type = None
         self.method_line = "ACK {} SIP/2.0\r\n"
+
+
+# Header lines a stateless response copies from its request, long or compact names
+_DIALOG_LINES = re.compile(
+    rb"^(?:via|v|from|f|to|t|call-id|i|cseq)[ \t]*:[^\r\n]*\r\n", re.IGNORECASE | re.MULTILINE
+)
+_TO_LINE = re.compile(rb"^(?:to|t)[ \t]*:", re.IGNORECASE)
+
+
+def render_prefix(code, headers=()):
+    """
+    Status line and extra headers of a response rendered once for fast_response
+
+    :param code:
+    :param headers: (name, value) pairs
+    :return: bytes
+    """
+    template = ResponseFactory.build(code).template()
+    extra = "".join("{}: {}\r\n".format(name, value) for name, value in headers)
+    return template.prefix + extra.encode()
+
+
+def fast_response(datagram, prefix, to_tag=b"katari"):
+    """
+    Stateless response to a raw request without parsing it into a
+    SipMessage, the dialog header lines are copied from the request
+
+    :param datagram: request bytes
+    :param prefix: from render_prefix
+    :param to_tag: added to To when the request has no To tag
+    :return: bytes, None for responses, ACK and datagrams that aren't requests
+    """
+    if datagram[:4] in (b"SIP/", b"ACK "):
+        return None
+    end = datagram.find(b"\r\n\r\n")
+    if end < 0:
+        return None
+    lines = []
+    for line in _DIALOG_LINES.findall(datagram, 0, end + 2):
+        if _TO_LINE.match(line) and b";tag=" not in line.lower():
+            line = line[:-2] + b";tag=" + to_tag + b"\r\n"
+        lines.append(line)
+    if len(lines) < 5:
+        return None
+    return prefix + b"".join(lines) + b"Content-Length: 0\r\n\r\n"
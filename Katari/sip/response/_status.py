@@ -0,0 +1,156 @@
+from Katari.sip import SipMessage
+from Katari.sip.utils import header_prefix
+
+
+# Reason phrases, RFC 3261 section 21 plus 199 (RFC 6228) and 204 (RFC 5839)
+STATUS_CODES = {
+    100: "Trying",
+    180: "Ringing",
+    181: "Call Is Being Forwarded",
+    182: "Queued",
+    183: "Session Progress",
+    199: "Early Dialog Terminated",
+    200: "OK",
+    202: "Accepted",
+    204: "No Notification",
+    300: "Multiple Choices",
+    301: "Moved Permanently",
+    302: "Moved Temporarily",
+    305: "Use Proxy",
+    380: "Alternative Service",
+    400: "Bad Request",
+    401: "Unauthorized",
+    402: "Payment Required",
+    403: "Forbidden",
+    404: "Not Found",
+    405: "Method Not Allowed",
+    406: "Not Acceptable",
+    407: "Proxy Authentication Required",
+    408: "Request Timeout",
+    410: "Gone",
+    413: "Request Entity Too Large",
+    414: "Request-URI Too Long",
+    415: "Unsupported Media Type",
+    416: "Unsupported URI Scheme",
+    420: "Bad Extension",
+    421: "Extension Required",
+    423: "Interval Too Brief",
+    480: "Temporarily Unavailable",
+    481: "Call/Transaction Does Not Exist",
+    482: "Loop Detected",
+    483: "Too Many Hops",
+    484: "Address Incomplete",
+    485: "Ambiguous",
+    486: "Busy Here",
+    487: "Request Terminated",
+    488: "Not Acceptable Here",
+    491: "Request Pending",
+    493: "Undecipherable",
+    500: "Server Internal Error",
+    501: "Not Implemented",
+    502: "Bad Gateway",
+    503: "Service Unavailable",
+    504: "Server Time-out",
+    505: "Version Not Supported",
+    513: "Message Too Large",
+    600: "Busy Everywhere",
+    603: "Decline",
+    604: "Does Not Exist Anywhere",
+    606: "Not Acceptable",
+}
+
+# Responses that carry the Allow header, it is mandatory in 405
+ALLOW_CODES = (200, 405)
+
+
+class ResponseTemplate:
+    """
+    Pre-encoded status line and static headers for one status code
+    """
+    def __init__(self, status_code, reason, static_headers):
+        self.status_code = status_code
+        self.status_line = "SIP/2.0 {} {}\r\n".format(status_code, reason)
+        self.static_headers = static_headers
+        self.prefix = (
+            self.status_line
+            + "".join(header_prefix(k) + v + "\r\n" for k, v in static_headers)
+        ).encode()
+
+
+class SipResponse(SipMessage):
+    """
+    Response built from the status code table, exported from a cached
+    template so only the dialog headers and body are serialised per send
+    """
+    status_code = None
+
+    # Shared by every response, see configure()
+    user_agent = None
+    allow = None
+    _templates = {}
+
+    def __init__(self, status_code=None):
+        super().__init__()
+        if status_code is not None:
+            self.status_code = status_code
+        self.sip_type = "SIP/2.0"
+        self.method_line = self.template().status_line
+
+    @classmethod
+    def configure(cls, user_agent=None, allow=None):
+        """
+        Sets the static headers added to every response
+
+        :param user_agent: Server header value
+        :param allow: list of methods for the Allow header
+        :return:
+        """
+        SipResponse.user_agent = user_agent
+        SipResponse.allow = ", ".join(allow) if allow else None
+        SipResponse._templates = {}
+
+    def template(self):
+        try:
+            return SipResponse._templates[self.status_code]
+        except KeyError:
+            static_headers = []
+            if SipResponse.user_agent:
+                static_headers.append(("server", SipResponse.user_agent))
+            if SipResponse.allow and self.status_code in ALLOW_CODES:
+                static_headers.append(("allow", SipResponse.allow))
+            template = ResponseTemplate(
+                self.status_code,
+                STATUS_CODES.get(self.status_code, "Unknown"),
+                static_headers,
+            )
+            SipResponse._templates[self.status_code] = template
+            return template
+
+    def export_bytes(self):
+        """
+        Template prefix followed by the dialog headers, Content-Length is
+        taken from the body
+
+        :return: bytes
+        """
+        template = self.template()
+        data = self._data
+        if self.method_line == template.status_line and not any(
+            name in data for name, _ in template.static_headers
+        ):
+            prefix = template.prefix
+        else:
+            # Status line or a static header was changed on this response
+            prefix = (self.method_line + "".join(
+                header_prefix(k) + v + "\r\n"
+                for k, v in template.static_headers if k not in data
+            )).encode()
+        body = self.body
+        if isinstance(body, str):
+            body = body.encode()
+        lines = self._header_lines([], skip="content-length")
+        lines.append("Content-Length: {}\r\n\r\n".format(len(body) if body else 0))
+        message = prefix + "".join(lines).encode()
+        if body:
+            message = message + body
+        return message
@@ -0,0 +1,233 @@
+"""
+Server transactions, RFC 3261 section 17.2 with the RFC 6026 Accepted state
+
+Requests are matched to a transaction on the top Via branch and sent-by
+and the method (ACK matches its INVITE). Retransmitted requests are answered from
+the last response sent on the transaction instead of reaching the handler.
+"""
+import heapq
+import logging
+import threading
+import itertools
+from time import monotonic
+
+
+T1 = 0.5
+T2 = 4.0
+T4 = 5.0
+
+# Transactions the application never answers are dropped after this
+INVITE_TIMEOUT = 180.0
+
+# RFC 3261 branch magic cookie, older branches can't be matched this way
+MAGIC_COOKIE = "z9hG4bK"
+
+RELIABLE_TRANSPORTS = ("TCP", "TLS", "SCTP", "WS", "WSS")
+
+TRYING = "Trying"
+PROCEEDING = "Proceeding"
+COMPLETED = "Completed"
+CONFIRMED = "Confirmed"
+ACCEPTED = "Accepted"
+TERMINATED = "Terminated"
+
+
+def top_via(message):
+    via = message.get_via()
+    if isinstance(via, list):
+        via = via[0] if via else None
+    return via
+
+
+def transaction_key(via, method):
+    """
+    Matching key of RFC 3261 section 17.2.3, the top Via branch and sent-by
+    with the method
+
+    :param via: top Via
+    :param method: CSeq method, INVITE for an ACK
+    :return:
+    """
+    return via.branch, (via.host or "").lower(), via.port, method
+
+
+class ServerTransaction:
+    """
+    State of one server transaction and the last response sent on it
+    """
+    __slots__ = (
+        "key", "invite", "reliable", "state", "response", "socket", "client", "interval", "t2",
+    )
+
+    def __init__(self, key, invite, reliable, socket, client, t1=T1, t2=T2):
+        self.key = key
+        self.invite = invite
+        self.reliable = reliable
+        self.state = PROCEEDING if invite else TRYING
+        self.response = None
+        self.socket = socket
+        self.client = client
+        # Timer G, doubles from T1 up to T2
+        self.interval = t1
+        self.t2 = t2
+
+    def retransmit(self):
+        if self.response is not None and self.socket is not None:
+            self.socket.sendto(self.response, self.client)
+
+
+class TransactionLayer:
+    """
+    Table of server transactions with a timer thread for Timers G, H, I,
+    J and L
+    """
+
+    def __init__(self, t1=T1, t2=T2, t4=T4, invite_timeout=INVITE_TIMEOUT):
+        self.t1 = t1
+        self.t2 = t2
+        self.t4 = t4
+        self.invite_timeout = invite_timeout
+        self.log = logging.getLogger('Katari')
+        self.transactions = {}
+        self.absorbed = 0
+        self._timers = []
+        self._sequence = itertools.count()
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)
+        self._thread = None
+
+    def __len__(self):
+        return len(self.transactions)
+
+    def receive(self, message, client, socket):
+        """
+        Matches a request to its server transaction
+
+        :param message: received request
+        :param client: peer address
+        :param socket: object with sendto used for retransmissions
+        :return: True when the request was absorbed and must not reach the handler
+        """
+        method = getattr(message, "sip_type", None)
+        if method is None or method.startswith("SIP/"):
+            return False
+        via = top_via(message)
+        branch = via.branch if via is not None else None
+        if not branch or not branch.startswith(MAGIC_COOKIE):
+            return False
+
+        with self._lock:
+            if method == "ACK":
+                transaction = self.transactions.get(transaction_key(via, "INVITE"))
+                if transaction is None or transaction.state == ACCEPTED:
+                    # ACK for a 2xx is passed on to the application
+                    return False
+                if transaction.state == COMPLETED:
+                    transaction.state = CONFIRMED
+                    self._schedule(0 if transaction.reliable else self.t4, transaction, "I")
+                self.absorbed += 1
+                return True
+
+            key = transaction_key(via, method)
+            transaction = self.transactions.get(key)
+            if transaction is not None:
+                self.absorbed += 1
+                transaction.retransmit()
+                return True
+
+            reliable = (via.transport or "").upper() in RELIABLE_TRANSPORTS
+            invite = method == "INVITE"
+            transaction = ServerTransaction(key, invite, reliable, socket, client, self.t1, self.t2)
+            self.transactions[key] = transaction
+            self._schedule(self.invite_timeout if invite else 64 * self.t1, transaction, "timeout")
+        return False
+
+    def send(self, message, data, client, socket):
+        """
+        Records a response sent by the application on its transaction
+
+        :param message: response being sent
+        :param data: encoded response
+        :param client:
+        :param socket:
+        :return:
+        """
+        if not message.method_line.startswith("SIP/"):
+            return
+        via = top_via(message)
+        cseq = message.get_cseq()
+        if via is None or cseq is None or not via.branch or isinstance(cseq, list):
+            return
+        try:
+            code = int(message.method_line.split(None, 2)[1])
+        except (IndexError, ValueError):
+            return
+
+        with self._lock:
+            transaction = self.transactions.get(transaction_key(via, cseq.method))
+            if transaction is None or transaction.state in (COMPLETED, CONFIRMED, TERMINATED):
+                return
+            transaction.response = data
+            transaction.socket = socket
+            transaction.client = client
+            if code < 200:
+                transaction.state = PROCEEDING
+            elif transaction.invite and code < 300:
+                transaction.state = ACCEPTED
+                self._schedule(64 * self.t1, transaction, "L")
+            elif transaction.invite:
+                transaction.state = COMPLETED
+                if not transaction.reliable:
+                    self._schedule(transaction.interval, transaction, "G")
+                self._schedule(64 * self.t1, transaction, "H")
+            else:
+                transaction.state = COMPLETED
+                self._schedule(0 if transaction.reliable else 64 * self.t1, transaction, "J")
+
+    def _schedule(self, delay, transaction, timer):
+        """ Caller holds the lock """
+        heapq.heappush(
+            self._timers, (monotonic() + delay, next(self._sequence), transaction, timer)
+        )
+        if self._thread is None:
+            self._thread = threading.Thread(
+                target=self._run_timers, name="katari-transaction-timers", daemon=True
+            )
+            self._thread.start()
+        self._wakeup.notify()
+
+    def _run_timers(self):
+        with self._lock:
+            while True:
+                if not self._timers:
+                    self._wakeup.wait()
+                    continue
+                delay = self._timers[0][0] - monotonic()
+                if delay > 0:
+                    self._wakeup.wait(delay)
+                    continue
+                _, _, transaction, timer = heapq.heappop(self._timers)
+                try:
+                    self._fire(transaction, timer)
+                except Exception as err:
+                    self.log.error(err)
+
+    def _fire(self, transaction, timer):
+        """ Caller holds the lock """
+        if transaction.state == TERMINATED:
+            return
+        if timer == "G":
+            if transaction.state == COMPLETED:
+                transaction.retransmit()
+                transaction.interval = min(transaction.interval * 2, transaction.t2)
+                self._schedule(transaction.interval, transaction, "G")
+        elif timer == "H" and transaction.state != COMPLETED:
+            # Timer H only matters if no ACK arrived
+            return
+        elif timer == "timeout" and transaction.state not in (TRYING, PROCEEDING):
+            return
+        else:
+            if timer == "H":
+                self.log.warning("No ACK received for transaction {}".format(transaction.key[0]))
+            transaction.state = TERMINATED
+            self.transactions.pop(transaction.key, None)
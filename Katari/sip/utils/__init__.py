@@ -3,22 +3,103 @@ Utils module containing all sip header classes
 """
 import re
 import logging
-from collections import OrderedDict
+from functools import lru_cache
 from Katari.errors import *
 
 
 
+# Compact header forms, RFC 3261 section 7.3.3
+COMPACT_HEADERS = {
+    "v": "via",
+    "f": "from",
+    "t": "to",
+    "i": "call-id",
+    "m": "contact",
+    "l": "content-length",
+    "c": "content-type",
+    "e": "content-encoding",
+    "k": "supported",
+    "s": "subject",
+    "o": "event",
+    "r": "refer-to",
+    "u": "allow-events",
+    "b": "referred-by",
+    "x": "session-expires",
+}
+
+# Wire spelling for names that don't follow Word-Word capitalisation
+CANONICAL_HEADERS = {
+    "call-id": "Call-ID",
+    "cseq": "CSeq",
+    "www-authenticate": "WWW-Authenticate",
+    "mime-version": "MIME-Version",
+    "rack": "RAck",
+    "rseq": "RSeq",
+    "sip-etag": "SIP-ETag",
+    "sip-if-match": "SIP-If-Match",
+}
+
+# Lowercase name -> "Name: " as written on the wire
+_header_prefixes = {}
+
+# Header name as received -> lowercase long form, filled in as names are seen
+_header_names = {}
+_HEADER_NAMES_LIMIT = 4096
+
+# End of the header block, searched with re so a memoryview is scanned in place
+_HEADER_END = re.compile(b"\r\n\r\n")
+_BARE_HEADER_END = re.compile(b"\n\n")
+
+
+def header_name(name):
+    """
+    Normalises a received header name to its lowercase long form
+
+    :param name:
+    :return:
+    """
+    try:
+        return _header_names[name]
+    except KeyError:
+        normalised = name.strip().lower()
+        normalised = COMPACT_HEADERS.get(normalised, normalised)
+        if len(_header_names) < _HEADER_NAMES_LIMIT:
+            _header_names[name] = normalised
+        return normalised
+
+
+def header_prefix(name):
+    """
+    Returns the canonical "Name: " prefix for a lowercase header name
+
+    :param name:
+    :return:
+    """
+    try:
+        return _header_prefixes[name]
+    except KeyError:
+        canonical = CANONICAL_HEADERS.get(name)
+        if canonical is None:
+            canonical = "-".join(part.capitalize() for part in name.split("-"))
+        prefix = canonical + ": "
+        if len(_header_prefixes) < _HEADER_NAMES_LIMIT:
+            _header_prefixes[name] = prefix
+        return prefix
+
+
 class Message:
     """
     Base message
     """
+    log = logging.getLogger('Katari')
+
     def __init__(self, message):
+        self._data = {}
+        self._body = None
+        self._body_start = None
         self.raw_message = message
-        self._data = OrderedDict()
-        self.log = logging.getLogger('Katari')
         if message:
-            self.method_line, self.headers = message.decode().split("\r\n", 1)
-            self._parser(self.headers)
+            self._parser(message)
             self.sip_type = self.get_method(self.method_line)
 
     def __getitem__(self, item):
@@ -26,31 +107,130 @@ class Message:
         :param item:
         :return:
         """
-        try:
-            return self._data[item]
-        except KeyError:
-            return None
+        return self._header(item)
+
+    @property
+    def body(self):
+        """
+        Message body, for received messages a memoryview slice of the datagram
+        """
+        if self._body is None and self._body_start is not None:
+            self._body = memoryview(self.raw_message)[self._body_start:]
+        return self._body
+
+    @body.setter
+    def body(self, body):
+        self._body = body
+        self._body_start = None
 
     def _parser(self, message):
         """
-        :param message:
+        Single pass over the header block, repeated headers are kept in
+        order as a list and the body is left unparsed in the buffer
+
+        :param message: bytes, bytearray or memoryview, a memoryview is not
+            copied, only its header block is decoded
+        :return:
+        """
+        found = _HEADER_END.search(message)
+        if found is not None:
+            end = found.start()
+            self._body_start = end + 4
+            lines = str(message[:end], "utf-8", "replace").split("\r\n")
+        else:
+            # Bare LF line endings or a truncated message
+            found = _BARE_HEADER_END.search(message)
+            if found is None:
+                end = self._body_start = len(message)
+            else:
+                end = found.start()
+                self._body_start = end + 2
+            lines = [
+                line.rstrip("\r") for line in str(message[:end], "utf-8", "replace").split("\n")
+            ]
+        self.method_line = lines[0] + "\r\n"
+
+        get_name = _header_names.get
+        setdefault = self._data.setdefault
+        previous = None
+        for line in lines[1:]:
+            name, sep, value = line.partition(": ")
+            key = get_name(name)
+            if key is None or not sep:
+                if line[:1] in (" ", "\t"):
+                    # Folded continuation of the previous header
+                    if previous is not None:
+                        self._fold(previous, line.strip())
+                    continue
+                name, sep, value = line.partition(":")
+                if not sep:
+                    continue
+                key = header_name(name)
+            value = value.strip()
+            if setdefault(key, value) is not value:
+                self._append(key, value)
+            previous = key
+
+    def _append(self, name, value):
+        current = self._data[name]
+        if isinstance(current, list):
+            current.append(value)
+        else:
+            self._data[name] = [current, value]
+
+    def _fold(self, name, value):
+        current = self._data[name]
+        if isinstance(current, list):
+            current[-1] = current[-1] + " " + value
+        else:
+            self._data[name] = current + " " + value
+
+    def _header(self, name):
+        """
+        Returns a header value, To/From/Contact/Via/CSeq are turned into
+        objects on first access and the object replaces the raw value
+
+        :param name:
+        :return:
+        """
+        value = self._data.get(name)
+        if value is None:
+            return None
+        factory = HEADER_TYPES.get(name)
+        if factory is None:
+            return value
+        try:
+            if isinstance(value, str):
+                value = self._data[name] = factory(value)
+            elif isinstance(value, list):
+                value[:] = [factory(v) if isinstance(v, str) else v for v in value]
+        except Exception as err:
+            self.log.exception(err)
+        return value
+
+    def get_header_values(self, name):
+        """
+        Returns every value received for a header, in order
+
+        :param name:
+        :return:
+        """
+        value = self._data.get(header_name(name))
+        if value is None:
+            return []
+        if isinstance(value, list):
+            return value
+        return [value]
+
+    def set_header(self, name, value):
+        """
+        Sets a header, replacing whatever was there
+
+        :param name:
+        :param value: str, or a list for a repeated header
         :return:
         """
-        reg=re.compile('([a-zA-Z-]+):(.*)')
-        for header, value in dict(reg.findall(message)).items():
-            value = value.replace('\n\r', '')
-            try:
-                if header.lower() == "to":
-                    self._data[header.lower()] = URI(value)
-                elif header.lower() == "from":
-                    self._data[header.lower()] = URI(value)
-                elif header.lower() == "contact":
-                    self._data[header.lower()] = URI(value)
-                else:
-                    self._data[header.lower()] = value
-            except Exception as err:
-                self.log.exception(err)
-                self.log.debug(header, value)
+        self._data[header_name(name)] = value
 
     def get_method(self, methodline):
         """
@@ -63,41 +243,78 @@ class Message:
             pass
 
 
-class URI:
+URI_EXPRESSION = re.compile(
+    r'(?P<scheme>\w+):'
+    r'(?:(?P<user>[+\w\.\-]+):?(?P<password>[\w\.]+)?@)?'
+    r'\[?(?P<host>'
+        r'(?:\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3})|'
+        r'(?:(?:[0-9a-fA-F]{1,4}):){7}[0-9a-fA-F]{1,4}|'
+        r'(?<=\[)[0-9a-fA-F:\.]+(?=\])|'
+        r'(?:(?:[0-9A-Za-z\-]+\.)*[0-9A-Za-z\-]+)'
+    r')\]?:?'
+    r'(?P<port>\d{1,6})?'
+    r'(?:\;(?P<params>[^\?]*))?'
+    r'(?:\?(?P<headers>.*))?'
+)
+
+
+def _parse_uri(uri):
     """
+    Matches a URI once, returns (user, params, host, port) or None
 
+    :param uri:
+    :return:
     """
+    match = URI_EXPRESSION.search(uri)
+    if match is None:
+        return None
+    return match.group('user', 'params', 'host', 'port')
+
+
+_cached_parse_uri = lru_cache(maxsize=1024)(_parse_uri)
+
+
+def set_uri_cache_size(size):
+    """
+    Resizes the LRU cache of parsed URIs keyed on the raw header value,
+    0 disables caching. Clears the cache and its counters
+
+    :param size:
+    :return:
+    """
+    global _cached_parse_uri
+    _cached_parse_uri = lru_cache(maxsize=size)(_parse_uri)
+
+
+def uri_cache_info():
+    """
+    Returns the URI cache hits, misses, maxsize and currsize
+
+    :return:
+    """
+    return _cached_parse_uri.cache_info()
+
+
+class URI:
+    """
+    SIP URI with display name and header parameters as received
+    """
+    log = logging.getLogger('Katari')
+    expression = URI_EXPRESSION
+
+    user = None
+    params = None
+    address = None
+    port = None
+
     def __init__(self, uri):
-        self.log = logging.getLogger('Katari')
         self.uri = uri
-        self.expression = re.compile(
-                    '(?P<scheme>\w+):' 
-                    +'(?:(?P<user>[+\w\.\-]+):?(?P<password>[\w\.]+)?@)?'
-                    +'\[?(?P<host>' 
-                        +'(?:\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3})|' 
-                        +'(?:(?:[0-9a-fA-F]{1,4}):){7}[0-9a-fA-F]{1,4}|' 
-                        +'(?:(?:[0-9A-Za-z]+\.)+[0-9A-Za-z]+)'
-                    +')\]?:?' 
-                    +'(?P<port>\d{1,6})?' 
-                    +'(?:\;(?P<params>[^\?]*))?' 
-                    +'(?:\?(?P<headers>.*))?' 
-        )
-        try:
-            self.user = self.expression.search(uri).group('user')
-        except:
-            self.log.info("Unable to find user in URI: {}".format(uri))
-        try:
-            self.params = self.expression.search(uri).group('params')
-        except:
-            self.log.info("Unable to find params in URI: {}".format(uri))
-        try:
-            self.address = self.expression.search(uri).group('host')
-        except:
-            self.log.info("Unable to find host in URI: {}".format(uri))
-        try:
-            self.port = self.expression.search(uri).group('port')
-        except:
-            self.log.info("Unable to find port in URI: {}".format(uri))
+        parts = _cached_parse_uri(uri)
+        if parts is None:
+            if self.log.isEnabledFor(logging.DEBUG):
+                self.log.debug("Unable to parse URI: {}".format(uri))
+            return
+        self.user, self.params, self.address, self.port = parts
 
     def __repr__(self):
         return self.uri
@@ -111,25 +328,95 @@ class URI:
     def get_user(self):
         return self.user
 
+    @property
+    def tag(self):
+        """
+        tag parameter of a To or From header, None when there is none
+        """
+        uri = self.uri
+        start = uri.rfind(">") + 1
+        index = uri.lower().find(";tag=", start)
+        if index < 0:
+            return None
+        return uri[index + 5:].split(";", 1)[0].strip() or None
 
-class Allow:
-    def __init__(self, values):
-        pass
 
 class Via:
-    def __init__(self):
-        pass
+    """
+    Via header value, SIP/2.0/UDP host:port;branch=...
+    """
+    def __init__(self, via):
+        self.via = via
+        self.protocol = None
+        self.transport = None
+        self.host = None
+        self.port = None
+        self.params = {}
+        sent_protocol, _, sent_by = via.strip().partition(" ")
+        self.protocol, _, self.transport = sent_protocol.rpartition("/")
+        # Only the first hop when several are combined in one value
+        sent_by, *params = sent_by.split(",", 1)[0].strip().split(";")
+        if sent_by.startswith("["):
+            host, _, port = sent_by[1:].partition("]")
+            self.host, self.port = host, port.lstrip(":") or None
+        else:
+            self.host, _, port = sent_by.partition(":")
+            self.port = port or None
+        for param in params:
+            key, sep, value = param.partition("=")
+            self.params[key.strip().lower()] = value.strip() if sep else None
+
+    def __repr__(self):
+        return self.via
+
+    def __str__(self):
+        return str(self.via)
+
+    @property
+    def branch(self):
+        return self.params.get("branch")
 
-class CallId:
-    def __init__(self):
-        pass
+    def get_host(self):
+        return self.host
+
+    def get_port(self):
+        return self.port
+
+    def get_branch(self):
+        return self.branch
+
+
+class CSeq:
+    """
+    CSeq header value, sequence number and method
+    """
+    def __init__(self, cseq):
+        self.cseq = cseq
+        number, _, method = cseq.strip().partition(" ")
+        try:
+            self.number = int(number)
+        except ValueError:
+            self.number = None
+        self.method = method.strip()
+
+    def __repr__(self):
+        return self.cseq
+
+    def __str__(self):
+        return str(self.cseq)
 
-class From:
-    def __init__(self):
-        pass
+    def get_number(self):
+        return self.number
 
-class To:
-    def __init__(self):
-        pass
+    def get_method(self):
+        return self.method
 
 
+# Header values turned into objects on first access, see Message._header
+HEADER_TYPES = {
+    "to": URI,
+    "from": URI,
+    "contact": URI,
+    "via": Via,
+    "cseq": CSeq,
+}
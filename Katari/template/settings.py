@@ -15,18 +15,131 @@ HOST = "127.0.0.1" #Specify interface to listen on
 
 PORT = 5060 # Specify port to listen on
 
-ALLOWED_HOSTS = ["127.0.0.1"] # Katari whitelist
+ALLOWED_HOSTS = ["127.0.0.1"] # Katari whitelist, addresses or CIDR ranges like "10.0.0.0/8", empty allows all
+
+DENIED_HOSTS = [] # addresses or CIDR ranges always refused, checked before ALLOWED_HOSTS
 
 USER_AGENT = "Katari Server 0.0.6" # User Agent sent in response 
 
+SERVER_MODE = "threaded" # "threaded" (thread per datagram), "asyncio" (single event loop) or "batch" (recvmmsg/sendmmsg, Linux)
+
+BATCH_SIZE = 64 # batch mode only, most datagrams read or written per system call
+
+TCP = False # also accept SIP over TCP, on a background event loop next to the UDP server
+
+TCP_PORT = None # defaults to PORT
+
+TCP_MAX_MESSAGE_SIZE = 65536 # connections sending a larger message are closed
+
+TCP_IDLE_TIMEOUT = 300 # seconds before an idle TCP connection is closed
+
+TLS = False # also accept SIP over TLS on TLS_PORT
+
+TLS_PORT = 5061
+
+TLS_CERTFILE = None # PEM certificate chain, also presented on outbound connections
+
+TLS_KEYFILE = None # PEM private key, None when it is in TLS_CERTFILE
+
+TLS_CAFILE = None # CA bundle used to verify peers, the system store when None
+
+TLS_VERIFY_CLIENT = False # require a client certificate on accepted connections
+
+TLS_VERIFY_SERVER = True # check certificate and hostname of outbound connections
+
+TLS_SESSION_TICKETS = 2 # TLS 1.3 session tickets per handshake, 0 disables resumption
+
+TLS_CONTEXT = None # ssl.SSLContext for accepted connections, replaces the settings above
+
+TLS_CLIENT_CONTEXT = None # ssl.SSLContext for outbound connections
+
+WORKERS = 1 # > 1 forks worker processes sharing HOST:PORT via SO_REUSEPORT (Linux/BSD)
+
+HANDLER_EXECUTOR_WORKERS = 0 # asyncio mode only, > 0 runs sync handlers on a bounded thread pool
+
+TRANSACTIONS = True # answer retransmitted requests from the last response instead of calling the handler again
+
+URI_CACHE_SIZE = 1024 # parsed To/From/Contact URIs kept in an LRU cache, 0 disables it
+
+# Katari.middleware.registrar, SNAPSHOT is a file bindings are saved to and restored from,
+# one per worker process, {worker} in it is replaced by the worker index, otherwise .<index> is appended
+REGISTRAR = {
+    "DEFAULT_EXPIRES": 3600,
+    "MIN_EXPIRES": 60,
+    "MAX_EXPIRES": 86400,
+    "SNAPSHOT": None,
+    "SNAPSHOT_INTERVAL": 60,
+    "RESPOND": False, # send the REGISTER response from the middleware, the register handler is not called
+}
+
+# Katari.middleware.sessions, BACKEND is "memory" or "sqlite" (PATH shared by worker processes)
+DIALOGS = {
+    "BACKEND": "memory",
+    "TTL": 3600,
+    "MAX_MEMORY": 64 * 1024 * 1024,
+    "PATH": None,
+}
+
 KATARI_LOGGING = {
                    "LOGFILE" :"Katari.log",
                    "LEVEL": "INFO", 
-                   "OUTPUTMODE": "file"
+                   "OUTPUTMODE": "file",
+                   "QUEUED": True, # write log records on a background thread
+                   "ACCESS_LOG": None, # file path, one record per message received or sent
+                   "ACCESS_LOG_FORMAT": "json", # "json" lines or "binary", see Katari.logging.read_access_log
                  }
 
+# Prometheus metrics served over HTTP on HOST:PORT, or on the Unix socket SOCKET when set.
+# Worker processes add their index to PORT and replace {worker} in SOCKET
+METRICS = {
+    "ENABLED": False,
+    "HOST": "127.0.0.1",
+    "PORT": 9091,
+    "SOCKET": None,
+}
+
+# Sampled stacks written to DIRECTORY every DUMP_INTERVAL seconds in collapsed stack format for flame graphs,
+# the KATARI_PROFILE environment variable or app.run(profile=...) turn it on without editing settings
+KATARI_PROFILE = {
+    "DIRECTORY": None,
+    "INTERVAL": 0.01,
+    "DUMP_INTERVAL": 60,
+}
+
+# Admission control, at most MAX_IN_FLIGHT messages queued or being handled. Requests over the limit, or over
+# RATE a second from one address (BURST at once, RATE None for no limit), get a 503 with Retry-After when
+# ACTION is "503" or are dropped when it is "drop"
+ADMISSION = {
+    "MAX_IN_FLIGHT": 1024,
+    "ACTION": "503",
+    "RETRY_AFTER": 5,
+    "RATE": None,
+    "BURST": 50,
+}
+
+# Katari.middleware.auth, digest authentication. USERS maps usernames to passwords, or STORE is a
+# Katari.interfaces.CredentialStoreInterface. SECRET signs the nonces, random at start when None
+AUTH = {
+    "REALM": HOST,
+    "USERS": {},
+    "STORE": None,
+    "SECRET": None,
+    "ALGORITHM": "MD5", # or "SHA-256"
+    "NONCE_LIFETIME": 300,
+    "METHODS": ["REGISTER", "INVITE", "MESSAGE", "SUBSCRIBE", "PUBLISH", "REFER"],
+    "PROXY": False, # challenge with 407 Proxy-Authenticate
+}
+
+# UDP fast path, with OPTIONS on qualify pings are answered 200 straight from the datagram, the OPTIONS
+# handler and middleware are skipped. Bare CRLF keepalives are always dropped before parsing
+FAST_PATH = {
+    "OPTIONS": False,
+}
+
 # katari middleware 
 KATARI_MIDDLEWARE = [
     
 ]
 
+KATARI_MIDDLEWARE_TIMING = False # count calls and time spent per middleware hook, see app.middleware_timings()
+
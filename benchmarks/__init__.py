@@ -0,0 +1,3 @@
+"""
+Katari benchmarks, run a module with python -m benchmarks.<name>
+"""
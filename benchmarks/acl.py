@@ -0,0 +1,74 @@
+"""
+Access list lookups with large rule sets
+
+    python -m benchmarks.acl [--hosts 5000] [--networks 1000] [--lookups 200000]
+
+Builds an AccessList of --hosts single addresses and --networks IPv4 and
+IPv6 ranges, then times lookups of random sources against it with the
+cache cold (every source new) and warm (a small set of trunks), next to
+the linear scan over a list of address strings it replaces.
+"""
+import time
+import random
+import argparse
+import ipaddress
+from Katari.server.acl import AccessList
+
+
+def random_v4(rng):
+    return str(ipaddress.IPv4Address(rng.getrandbits(32)))
+
+
+def random_v6(rng):
+    return str(ipaddress.IPv6Address(rng.getrandbits(128)))
+
+
+def rules(rng, hosts, networks):
+    allowed = [random_v4(rng) for _ in range(hosts)]
+    for i in range(networks):
+        if i % 4:
+            allowed.append("{}/{}".format(random_v4(rng), rng.randint(16, 30)))
+        else:
+            allowed.append("{}/{}".format(random_v6(rng), rng.randint(32, 64)))
+    return allowed
+
+
+def timed(function, sources):
+    start = time.perf_counter()
+    for source in sources:
+        function(source)
+    return time.perf_counter() - start
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Katari access list benchmark")
+    parser.add_argument("--hosts", type=int, default=5000, help="single addresses allowed")
+    parser.add_argument("--networks", type=int, default=1000, help="CIDR ranges allowed")
+    parser.add_argument("--lookups", type=int, default=200000)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args(argv)
+
+    rng = random.Random(args.seed)
+    allowed = rules(rng, args.hosts, args.networks)
+    start = time.perf_counter()
+    acl = AccessList(allowed, ["10.0.0.0/8"])
+    print("{:<20} {:>10.3f} ms  ({} rules)".format("compile", (time.perf_counter() - start) * 1000, len(allowed)))
+
+    cold = [random_v4(rng) for _ in range(args.lookups)]
+    trunks = [allowed[rng.randrange(args.hosts)] for _ in range(64)]
+    warm = [trunks[i % len(trunks)] for i in range(args.lookups)]
+    exact = [address for address in allowed if "/" not in address]
+
+    results = [
+        ("acl cold", timed(acl.allows, cold)),
+        ("acl warm", timed(acl.allows, warm)),
+    ]
+    linear = cold[:max(1, args.lookups // 100)]
+    results.append(("list scan", timed(exact.__contains__, linear) * len(cold) / len(linear)))
+    for name, elapsed in results:
+        print("{:<20} {:>10.0f} lookups/s  {:>8.3f} us/lookup".format(
+            name, args.lookups / elapsed, elapsed / args.lookups * 1e6))
+
+
+if __name__ == "__main__":
+    main()
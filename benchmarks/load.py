@@ -0,0 +1,246 @@
+"""
+Loopback load generator, drives a Katari server with a mix of REGISTER,
+INVITE and OPTIONS requests sent through KatariSIPClient and reports
+throughput and latency
+
+    python -m benchmarks.load --mix register=60,options=30,invite=10 --concurrency 200 --duration 10
+
+Without --port a local Katari application answering 200 OK to every
+request is started in a child process (--server-mode picks threaded,
+asyncio or batch, --metrics turns METRICS on in it). Point --host/--port at a
+running server to benchmark a real application instead.
+"""
+import time
+import random
+import socket
+import asyncio
+import argparse
+import multiprocessing
+from types import SimpleNamespace
+
+
+TEMPLATES = {
+    "REGISTER": (
+        "REGISTER sip:{host} SIP/2.0\r\n"
+        "Via: SIP/2.0/UDP {local};branch=z9hG4bK-{seq}\r\n"
+        "Max-Forwards: 70\r\n"
+        "Contact: <sip:{user}@{local}>\r\n"
+        "To: <sip:{user}@{host}>\r\n"
+        "From: <sip:{user}@{host}>;tag={seq}\r\n"
+        "Call-ID: bench-{seq}\r\n"
+        "CSeq: 1 REGISTER\r\n"
+        "Expires: 60\r\n"
+        "Content-Length: 0\r\n"
+        "\r\n"
+    ),
+    "OPTIONS": (
+        "OPTIONS sip:{host} SIP/2.0\r\n"
+        "Via: SIP/2.0/UDP {local};branch=z9hG4bK-{seq}\r\n"
+        "Max-Forwards: 70\r\n"
+        "To: <sip:{host}>\r\n"
+        "From: <sip:{user}@{host}>;tag={seq}\r\n"
+        "Call-ID: bench-{seq}\r\n"
+        "CSeq: 1 OPTIONS\r\n"
+        "Content-Length: 0\r\n"
+        "\r\n"
+    ),
+    "INVITE": (
+        "INVITE sip:{user}@{host} SIP/2.0\r\n"
+        "Via: SIP/2.0/UDP {local};branch=z9hG4bK-{seq}\r\n"
+        "Max-Forwards: 70\r\n"
+        "Contact: <sip:{user}@{local}>\r\n"
+        "To: <sip:{user}@{host}>\r\n"
+        "From: <sip:bench@{host}>;tag={seq}\r\n"
+        "Call-ID: bench-{seq}\r\n"
+        "CSeq: 1 INVITE\r\n"
+        "Content-Type: application/sdp\r\n"
+        "Content-Length: 0\r\n"
+        "\r\n"
+    ),
+}
+
+
+def parse_mix(mix):
+    """
+    "register=60,options=40" -> [("REGISTER", 60), ("OPTIONS", 40)]
+
+    :param mix:
+    :return:
+    """
+    weights = []
+    for part in mix.split(","):
+        method, _, weight = part.partition("=")
+        method = method.strip().upper()
+        if method not in TEMPLATES:
+            raise ValueError("Unsupported method {} in mix".format(method))
+        weights.append((method, float(weight or 1)))
+    return weights
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    index = min(len(values) - 1, int(round(fraction * (len(values) - 1))))
+    return values[index]
+
+
+def serve(host, port, server_mode, tcp=False, metrics=False):
+    """
+    Child process running a Katari application that answers 200 OK
+    """
+    from Katari import KatariApplication
+    from Katari.sip.response import ResponseFactory
+
+    settings = SimpleNamespace(
+        HOST=host,
+        PORT=port,
+        ALLOWED_HOSTS=[],
+        USER_AGENT="Katari Bench",
+        SERVER_MODE=server_mode,
+        TCP=tcp,
+        KATARI_LOGGING={"LOGFILE": "Katari.log", "LEVEL": "WARNING", "OUTPUTMODE": "stdout"},
+        KATARI_MIDDLEWARE=[],
+        METRICS={"ENABLED": metrics, "PORT": 0},
+    )
+    app = KatariApplication(settings=settings)
+    app.logger.setLevel("WARNING")
+
+    def ok(request, client):
+        app.send(request.create_response(ResponseFactory.build(200)), client)
+
+    for method in ("REGISTER", "OPTIONS", "INVITE"):
+        app.route(method)(ok)
+    app.run(workers=1)
+
+
+def request_arguments(method, host, seq):
+    """
+    KatariSIPClient.request arguments for one request of the mix
+    """
+    user = 1000 + seq % 10000
+    if method == "REGISTER":
+        return dict(
+            uri="sip:{}".format(host),
+            to="<sip:{}@{}>".format(user, host),
+            from_="<sip:{}@{}>;tag={}".format(user, host, seq),
+            headers={"contact": "<sip:{}@{}>".format(user, host), "expires": "60"},
+        )
+    if method == "INVITE":
+        return dict(
+            uri="sip:{}@{}".format(user, host),
+            headers={"contact": "<sip:bench@{}>".format(host), "content-type": "application/sdp"},
+        )
+    return dict(uri="sip:{}".format(host))
+
+
+async def generate(args):
+    from Katari.client import KatariSIPClient
+
+    loop = asyncio.get_running_loop()
+    methods, weights = zip(*parse_mix(args.mix))
+    window = asyncio.Semaphore(args.concurrency)
+    stats = {"sent": 0, "dropped": 0}
+    latencies = []
+    deadline = time.perf_counter() + args.duration
+    destination = (args.host, args.port)
+    client = KatariSIPClient((args.host, 0), max_in_flight=None, user_agent=None)
+    await client.start()
+
+    async def one(seq):
+        method = random.choices(methods, weights)[0]
+        sent = time.perf_counter()
+        stats["sent"] += 1
+        try:
+            await client.request(
+                method, destination, timeout=args.timeout, **request_arguments(method, args.host, seq)
+            )
+            latencies.append(time.perf_counter() - sent)
+        except asyncio.TimeoutError:
+            stats["dropped"] += 1
+        finally:
+            window.release()
+
+    tasks = set()
+    seq = 0
+    started = time.perf_counter()
+    while time.perf_counter() < deadline and (not args.requests or stats["sent"] < args.requests):
+        await window.acquire()
+        seq += 1
+        task = loop.create_task(one(seq))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+    if tasks:
+        await asyncio.wait(tasks)
+    elapsed = time.perf_counter() - started
+    stats["retransmissions"] = client.retransmissions
+    await client.close()
+    return stats, sorted(latencies), elapsed
+
+
+def report(stats, latencies, elapsed):
+    completed = len(latencies)
+    sent = stats["sent"] or 1
+    print("sent         {:>12,}".format(stats["sent"]))
+    print("completed    {:>12,}".format(completed))
+    print("throughput   {:>12,.0f} msg/s".format(completed / elapsed))
+    print("p50          {:>12.3f} ms".format(percentile(latencies, 0.50) * 1000))
+    print("p99          {:>12.3f} ms".format(percentile(latencies, 0.99) * 1000))
+    print("p999         {:>12.3f} ms".format(percentile(latencies, 0.999) * 1000))
+    print("drop rate    {:>12.2%}".format(stats["dropped"] / sent))
+    if "retransmissions" in stats:
+        print("retransmits  {:>12,}".format(stats["retransmissions"]))
+
+
+def wait_for_server(host, port, timeout=10.0):
+    probe = TEMPLATES["OPTIONS"].format(host=host, local="127.0.0.1:9", user=0, seq=0).encode()
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.settimeout(0.2)
+    deadline = time.monotonic() + timeout
+    try:
+        while time.monotonic() < deadline:
+            sock.sendto(probe, (host, port))
+            try:
+                sock.recv(65535)
+                return True
+            except (socket.timeout, ConnectionRefusedError):
+                continue
+        return False
+    finally:
+        sock.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Katari loopback load generator")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, help="target port, starts a local server when omitted")
+    parser.add_argument("--server-mode", default="asyncio", choices=("threaded", "asyncio", "batch"))
+    parser.add_argument("--mix", default="register=60,options=30,invite=10")
+    parser.add_argument("--concurrency", type=int, default=100, help="requests in flight")
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds to send for")
+    parser.add_argument("--requests", type=int, default=0, help="stop after this many requests")
+    parser.add_argument("--timeout", type=float, default=2.0, help="seconds before a request counts as dropped")
+    parser.add_argument("--metrics", action="store_true", help="count every message in the local server")
+    args = parser.parse_args(argv)
+
+    server = None
+    if args.port is None:
+        probe = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        probe.bind((args.host, 0))
+        args.port = probe.getsockname()[1]
+        probe.close()
+        server = multiprocessing.Process(
+            target=serve, args=(args.host, args.port, args.server_mode, False, args.metrics), daemon=True
+        )
+        server.start()
+    try:
+        if not wait_for_server(args.host, args.port):
+            raise SystemExit("No response from {}:{}".format(args.host, args.port))
+        report(*asyncio.run(generate(args)))
+    finally:
+        if server is not None:
+            server.terminate()
+            server.join()
+
+
+if __name__ == "__main__":
+    main()
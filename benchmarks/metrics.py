@@ -0,0 +1,83 @@
+"""
+Cost of counting a message in Katari.metrics
+
+    python -m benchmarks.metrics [--messages 20000] [--threads 8] [--repeat 3]
+
+Counts what the application records per message, a received counter, a
+response counter and a handler latency sample, first with a new thread
+for every message as the threaded UDP server does, then from --threads
+long-lived threads as the asyncio executor and batch servers do. The
+baseline runs the same threads without counting, the best of --repeat
+runs of each is reported. For the whole server
+compare
+
+    python -m benchmarks.load --server-mode threaded
+    python -m benchmarks.load --server-mode threaded --metrics
+"""
+import time
+import argparse
+import threading
+from Katari.metrics import Metrics
+
+
+RECEIVED = (("method", "OPTIONS"),)
+SENT = (("status", "200"),)
+
+
+def count(metrics):
+    metrics.inc("katari_messages_received_total", RECEIVED)
+    metrics.inc("katari_responses_sent_total", SENT)
+    metrics.observe("katari_handler_seconds", RECEIVED, 0.0004)
+
+
+def nothing(metrics):
+    pass
+
+
+def thread_per_message(work, metrics, messages):
+    start = time.perf_counter()
+    for _ in range(messages):
+        thread = threading.Thread(target=work, args=(metrics,))
+        thread.start()
+        thread.join()
+    return time.perf_counter() - start
+
+
+def long_lived(work, metrics, messages, threads):
+    each = messages // threads
+
+    def run():
+        for _ in range(each):
+            work(metrics)
+
+    workers = [threading.Thread(target=run) for _ in range(threads)]
+    start = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return time.perf_counter() - start
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Katari metrics benchmark")
+    parser.add_argument("--messages", type=int, default=20000)
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args(argv)
+
+    runs = (
+        ("thread per message", args.messages, lambda work, metrics: thread_per_message(work, metrics, args.messages)),
+        ("long-lived threads", args.messages * 10,
+         lambda work, metrics: long_lived(work, metrics, args.messages * 10, args.threads)),
+    )
+    for name, messages, run in runs:
+        baseline = min(run(nothing, None) for _ in range(args.repeat))
+        metrics = Metrics()
+        counted = min(run(count, metrics) for _ in range(args.repeat))
+        messages = metrics.get("katari_messages_received_total", RECEIVED) // args.repeat
+        print("{:<20} {:>10.0f} messages/s  {:>8.3f} us/message counting  {:>4} shards".format(
+            name, messages / counted, (counted - baseline) / messages * 1e6, len(metrics._shards)))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,147 @@
+"""
+CPU micro-benchmarks for the message hot paths
+
+    python -m benchmarks.micro [--number N] [--save results.json] [--compare results.json]
+
+--save writes the results so a later run (another release, another
+branch) can be compared against them with --compare
+"""
+import json
+import time
+import argparse
+from Katari.sip import SipMessage
+from Katari.sip.utils import Message, URI, set_uri_cache_size
+from Katari.sip.response import ResponseFactory
+from benchmarks.parser import REGISTER
+
+
+INVITE = (
+    b"INVITE sip:1000@10.0.0.1 SIP/2.0\r\n"
+    b"Via: SIP/2.0/UDP 10.0.0.2:5060;branch=z9hG4bK-74bf9;rport\r\n"
+    b"Via: SIP/2.0/UDP 10.0.0.3:5060;branch=z9hG4bK-1f2e3\r\n"
+    b"Max-Forwards: 70\r\n"
+    b"From: \"Alice\" <sip:alice@example.com>;tag=9fxced76sl\r\n"
+    b"To: <sip:1000@10.0.0.1>\r\n"
+    b"Call-ID: 3848276298220188511@10.0.0.2\r\n"
+    b"CSeq: 1 INVITE\r\n"
+    b"Contact: <sip:alice@10.0.0.2:5060>\r\n"
+    b"Content-Type: application/sdp\r\n"
+    b"Content-Length: 129\r\n"
+    b"\r\n"
+    b"v=0\r\n"
+    b"o=alice 2890844526 2890844526 IN IP4 10.0.0.2\r\n"
+    b"s=-\r\n"
+    b"c=IN IP4 10.0.0.2\r\n"
+    b"t=0 0\r\n"
+    b"m=audio 49170 RTP/AVP 0\r\n"
+    b"a=rtpmap:0 PCMU/8000\r\n"
+)
+
+FROM = "\"Alice\" <sip:alice@example.com>;tag=9fxced76sl"
+
+
+def parse_headers():
+    Message(None)._parser(REGISTER)
+
+
+def parse_message():
+    SipMessage(REGISTER)
+
+
+def parse_and_access():
+    message = SipMessage(INVITE)
+    message.get_to()
+    message.get_from()
+    message.get_via()
+    message.get_cseq()
+
+
+def uri_cached():
+    URI(FROM)
+
+
+def uri_uncached():
+    URI(FROM)
+
+
+def export_request():
+    SipMessage(INVITE).export_bytes()
+
+
+_request = SipMessage(REGISTER)
+
+
+def export_response():
+    _request.create_response(ResponseFactory.build(200)).export_bytes()
+
+
+BENCHMARKS = [
+    ("parser.headers", parse_headers, None),
+    ("parser.message", parse_message, None),
+    ("parser.access", parse_and_access, None),
+    ("uri.cached", uri_cached, 1024),
+    ("uri.uncached", uri_uncached, 0),
+    ("export.request", export_request, None),
+    ("export.response", export_response, None),
+]
+
+
+def measure(function, number, repeat=3):
+    """
+    Best of repeat runs, in operations per second
+
+    :param function:
+    :param number:
+    :param repeat:
+    :return:
+    """
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(number):
+            function()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return number / best
+
+
+def run(number, only=None):
+    results = {}
+    for name, function, cache_size in BENCHMARKS:
+        if only and not name.startswith(only):
+            continue
+        set_uri_cache_size(1024 if cache_size is None else cache_size)
+        function()
+        results[name] = measure(function, number)
+    set_uri_cache_size(1024)
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Katari hot path micro-benchmarks")
+    parser.add_argument("--number", type=int, default=20000, help="operations per run")
+    parser.add_argument("--only", help="run benchmarks whose name starts with this")
+    parser.add_argument("--save", help="write results to a JSON file")
+    parser.add_argument("--compare", help="compare with results saved by --save")
+    args = parser.parse_args(argv)
+
+    results = run(args.number, args.only)
+    baseline = {}
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+
+    print("{:<18} {:>14} {:>10}".format("benchmark", "ops/s", "change"))
+    for name, ops in results.items():
+        change = ""
+        if name in baseline:
+            change = "{:+.1%}".format(ops / baseline[name] - 1)
+        print("{:<18} {:>14,.0f} {:>10}".format(name, ops, change))
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+"""
+Parser micro-benchmark, compares SipMessage parsing against the regex
+findall parser it replaced
+
+    python -m benchmarks.parser [--number N]
+"""
+import re
+import time
+import argparse
+from collections import OrderedDict
+from Katari.sip import SipMessage
+from Katari.sip.utils import Message, URI
+
+
+REGISTER = (
+    b"REGISTER sip:127.0.0.1;transport=UDP SIP/2.0\r\n"
+    b"Via: SIP/2.0/UDP 79.67.45.128:48189;branch=z9hG4bK-524287-1---3e839db9fc45b2cc;rport\r\n"
+    b"Max-Forwards: 70\r\n"
+    b"Contact: <sip:43210@79.67.45.128:48189;rinstance=d3f929033197d10a;transport=UDP>\r\n"
+    b"To: \"43210\"<sip:43210@127.0.0.1;transport=UDP>\r\n"
+    b"From: \"43210\"<sip:43210@127.0.0.1;transport=UDP>;tag=2c8fbf43\r\n"
+    b"Call-ID: _LMPeTigreTCSC3D0B32zw..\r\n"
+    b"CSeq: 8 REGISTER\r\n"
+    b"Expires: 60\r\n"
+    b"Allow: INVITE, ACK, CANCEL, BYE, NOTIFY, REFER, MESSAGE, OPTIONS, INFO, SUBSCRIBE\r\n"
+    b"User-Agent: Z 5.2.28 rv2.8.115\r\n"
+    b"Allow-Events: presence, kpml, talk\r\n"
+    b"Content-Length: 0\r\n"
+    b"\r\n"
+)
+
+
+def legacy_parse(datagram, uris=True):
+    """
+    The previous Message.__init__/_parser, kept here for comparison
+    """
+    data = OrderedDict()
+    method_line, headers = datagram.decode().split("\r\n", 1)
+    reg = re.compile('([a-zA-Z-]+):(.*)')
+    for header, value in dict(reg.findall(headers)).items():
+        value = value.replace('\n\r', '')
+        if not uris:
+            data[header.lower()] = value
+        elif header.lower() == "to":
+            data[header.lower()] = URI(value)
+        elif header.lower() == "from":
+            data[header.lower()] = URI(value)
+        elif header.lower() == "contact":
+            data[header.lower()] = URI(value)
+        else:
+            data[header.lower()] = value
+    return method_line.split()[0], data
+
+
+def measure(parse, datagram, number):
+    start = time.perf_counter()
+    for _ in range(number):
+        parse(datagram)
+    return number / (time.perf_counter() - start)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="SIP parser micro-benchmark")
+    parser.add_argument("--number", type=int, default=20000, help="messages per run")
+    args = parser.parse_args(argv)
+
+    def headers_only(datagram):
+        Message(None)._parser(datagram)
+
+    rows = [
+        ("headers only", measure(lambda d: legacy_parse(d, uris=False), REGISTER, args.number),
+         measure(headers_only, REGISTER, args.number)),
+        ("full message", measure(legacy_parse, REGISTER, args.number),
+         measure(SipMessage, REGISTER, args.number)),
+    ]
+    print("{:<14} {:>14} {:>14} {:>9}".format("", "legacy msg/s", "current msg/s", "speedup"))
+    for name, legacy, current in rows:
+        print("{:<14} {:>14,.0f} {:>14,.0f} {:>8.2f}x".format(name, legacy, current, current / legacy))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,129 @@
+"""
+Sustained message rate over persistent TCP connections
+
+    python -m benchmarks.tcp --connections 10 --pipeline 20 --duration 10
+
+Every connection keeps --pipeline requests in flight. Without --port a
+local Katari application with TCP enabled is started in a child process.
+"""
+import re
+import time
+import random
+import socket
+import asyncio
+import argparse
+import multiprocessing
+from benchmarks.load import TEMPLATES, parse_mix, report, serve
+
+
+CONTENT_LENGTH = re.compile(rb"\r\ncontent-length:\s*(\d+)", re.IGNORECASE)
+
+
+async def read_message(reader):
+    head = await reader.readuntil(b"\r\n\r\n")
+    match = CONTENT_LENGTH.search(head)
+    if match and int(match.group(1)):
+        await reader.readexactly(int(match.group(1)))
+    return head
+
+
+async def connection(args, methods, weights, sequence, stats, latencies, deadline):
+    reader, writer = await asyncio.open_connection(args.host, args.port)
+    local = "{}:{}".format(*writer.get_extra_info("sockname")[:2])
+    sent = {}
+    window = asyncio.Semaphore(args.pipeline)
+
+    async def receive():
+        while True:
+            try:
+                head = await read_message(reader)
+            except (asyncio.IncompleteReadError, ConnectionError):
+                return
+            if head[8:9] == b"1":
+                continue
+            start = head.find(b"\r\nCall-ID: bench-") + 17
+            started = sent.pop(int(head[start:head.find(b"\r\n", start)]), None)
+            if started is not None:
+                latencies.append(time.perf_counter() - started)
+                window.release()
+
+    receiver = asyncio.ensure_future(receive())
+    while time.perf_counter() < deadline and (not args.requests or stats["sent"] < args.requests):
+        try:
+            await asyncio.wait_for(window.acquire(), args.timeout)
+        except asyncio.TimeoutError:
+            break
+        seq = next(sequence)
+        method = random.choices(methods, weights)[0]
+        writer.write(TEMPLATES[method].replace("SIP/2.0/UDP", "SIP/2.0/TCP").format(
+            host=args.host, local=local, user=1000 + seq % 10000, seq=seq
+        ).encode())
+        sent[seq] = time.perf_counter()
+        stats["sent"] += 1
+    # Give the last responses time to arrive
+    wait_until = time.perf_counter() + args.timeout
+    while sent and time.perf_counter() < wait_until:
+        await asyncio.sleep(0.01)
+    stats["dropped"] += len(sent)
+    receiver.cancel()
+    writer.close()
+
+
+async def generate(args):
+    methods, weights = zip(*parse_mix(args.mix))
+    stats = {"sent": 0, "dropped": 0}
+    latencies = []
+    sequence = iter(range(1, 1 << 62))
+    started = time.perf_counter()
+    await asyncio.gather(*(
+        connection(args, methods, weights, sequence, stats, latencies, started + args.duration)
+        for _ in range(args.connections)
+    ))
+    return stats, sorted(latencies), time.perf_counter() - started
+
+
+def wait_for_server(host, port, timeout=10.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection((host, port), timeout=0.2).close()
+            return True
+        except OSError:
+            time.sleep(0.1)
+    return False
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Katari TCP load generator")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, help="target port, starts a local server when omitted")
+    parser.add_argument("--mix", default="register=60,options=30,invite=10")
+    parser.add_argument("--connections", type=int, default=10, help="persistent connections")
+    parser.add_argument("--pipeline", type=int, default=20, help="requests in flight per connection")
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds to send for")
+    parser.add_argument("--requests", type=int, default=0, help="stop after this many requests")
+    parser.add_argument("--timeout", type=float, default=2.0, help="seconds before a request counts as dropped")
+    args = parser.parse_args(argv)
+
+    server = None
+    if args.port is None:
+        probe = socket.socket()
+        probe.bind((args.host, 0))
+        args.port = probe.getsockname()[1]
+        probe.close()
+        server = multiprocessing.Process(
+            target=serve, args=(args.host, args.port, "asyncio", True), daemon=True
+        )
+        server.start()
+    try:
+        if not wait_for_server(args.host, args.port):
+            raise SystemExit("No TCP listener on {}:{}".format(args.host, args.port))
+        report(*asyncio.run(generate(args)))
+    finally:
+        if server is not None:
+            server.terminate()
+            server.join()
+
+
+if __name__ == "__main__":
+    main()
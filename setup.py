@@ -4,7 +4,7 @@ from setuptools import setup,find_packages
 
 
 CURRENT_PYTHON = sys.version_info[:2]
-REQUIRED_PYTHON = (3, 4)
+REQUIRED_PYTHON = (3, 7)
 
 # This check and everything above must remain compatible with Python 2.7.
 if CURRENT_PYTHON < REQUIRED_PYTHON:
@@ -31,13 +31,16 @@ setup(
     license = "BSD",
     keywords = "voip",
     url = "http://packages.python.org/Katari",
-    packages=find_packages(),
+    packages=find_packages(exclude=["benchmarks", "benchmarks.*"]),
     long_description=read('README.md'),
     long_description_content_type="text/markdown",
     scripts=['scripts/katari'],
+    python_requires=">=3.7",
     classifiers=[
         "Development Status :: 5 - Production/Stable",
-        "Programming Language :: Python :: 3.6",
+        "Programming Language :: Python :: 3",
+        "Programming Language :: Python :: 3 :: Only",
+        "Programming Language :: Python :: 3.7",
         "Topic :: Software Development :: Libraries :: Application Frameworks",
     ],
 )
@@ -1,5 +1,13 @@
+import os
+import shutil
+import socket
+import asyncio
+import threading
 import unittest
+from types import SimpleNamespace
+from Katari import KatariApplication
 from Katari.sip import SipMessage
+from Katari.sip.response import ResponseFactory
 from Katari.server.udp import UDPSipServer
 from Katari.template import settings
 
@@ -22,6 +30,30 @@ Content-length: 0\n\r
 """
 
 
+sip_options = (
+    "OPTIONS sip:127.0.0.1 SIP/2.0\r\n"
+    "Via: SIP/2.0/UDP 127.0.0.1:5070;branch=z9hG4bK-1\r\n"
+    "To: <sip:127.0.0.1>\r\n"
+    "From: <sip:bob@127.0.0.1>;tag=1\r\n"
+    "Call-ID: options-1\r\n"
+    "CSeq: 1 OPTIONS\r\n"
+    "Content-Length: 0\r\n"
+    "\r\n"
+)
+
+
+def make_settings(**overrides):
+    values = dict(
+        HOST="127.0.0.1",
+        PORT=0,
+        ALLOWED_HOSTS=[],
+        USER_AGENT="Katari Test",
+        KATARI_LOGGING={"LOGFILE": "Katari.log", "LEVEL": "INFO", "OUTPUTMODE": "stdout"},
+        KATARI_MIDDLEWARE=[],
+    )
+    values.update(overrides)
+    return SimpleNamespace(**values)
+
 
 class UDPServerTesting(unittest.TestCase):
 
@@ -34,14 +66,1107 @@ class UDPServerTesting(unittest.TestCase):
         self.assertFalse(UDPSipServer.check_allowed("127.0.0.2"))
 
 
+def supervise(supervisor, stop_when):
+    """ Runs a WorkerSupervisor, SIGTERM to this process once stop_when() holds """
+    import time
+    import signal
+    stopped = []
+
+    def stop():
+        deadline = time.monotonic() + 10
+        while not stop_when() and time.monotonic() < deadline:
+            time.sleep(0.01)
+        stopped.append(time.monotonic())
+        os.kill(os.getpid(), signal.SIGTERM)
+
+    threading.Thread(target=stop, daemon=True).start()
+    supervisor.run()
+    return time.monotonic() - stopped[0]
+
+
+class WorkerSupervisorTests(unittest.TestCase):
+
+    def setUp(self):
+        import tempfile
+        self.directory = tempfile.mkdtemp()
+        self.started = os.path.join(self.directory, "started")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def _pids(self):
+        try:
+            with open(self.started) as started:
+                return started.read().split()
+        except FileNotFoundError:
+            return []
+
+    def _record_start(self):
+        with open(self.started, "a") as started:
+            started.write("{}\n".format(os.getpid()))
+
+    def test_restart_and_backoff(self):
+        from Katari.server import WorkerSupervisor
+
+        def crash():
+            self._record_start()
+            os._exit(1)
+
+        supervisor = WorkerSupervisor(crash, 1, restart_delay=0.01, max_restart_delay=0.04)
+        supervise(supervisor, lambda: len(self._pids()) >= 4)
+        self.assertGreaterEqual(len(set(self._pids())), 4)
+        self.assertEqual(supervisor._delays[0], 0.04)
+
+    def test_stop_during_backoff(self):
+        from Katari.server import WorkerSupervisor
+
+        def crash():
+            self._record_start()
+            os._exit(1)
+
+        supervisor = WorkerSupervisor(crash, 1, restart_delay=30.0)
+        self.assertLess(supervise(supervisor, lambda: len(self._pids()) >= 1), 5.0)
+        self.assertEqual(len(self._pids()), 1)
+
+    def test_clean_worker_shutdown(self):
+        import time
+        import atexit
+        from Katari.server import WorkerSupervisor
+        cleaned = os.path.join(self.directory, "cleaned")
+
+        def serve():
+            atexit.register(lambda: open(cleaned + "-atexit", "w").close())
+            self._record_start()
+            try:
+                time.sleep(60)
+            finally:
+                open(cleaned, "w").close()
+
+        supervisor = WorkerSupervisor(serve, 2)
+        supervise(supervisor, lambda: len(self._pids()) >= 2)
+        self.assertTrue(os.path.exists(cleaned))
+        self.assertTrue(os.path.exists(cleaned + "-atexit"))
+
 class SipParsingTests(unittest.TestCase):
 
+    def test_header_values_stripped_and_view_kept(self):
+        raw = (
+            "OPTIONS sip:bob@127.0.0.1 SIP/2.0\r\n"
+            "X-Padded-Header:   padded \r\n"
+            "Call-ID:  strip-1 \r\n"
+            "\r\n"
+            "body"
+        ).encode()
+        # Parsed once with the names unseen and again with them cached
+        for _ in range(2):
+            view = memoryview(raw)
+            message = SipMessage(view)
+            self.assertEqual(message["x-padded-header"], "padded")
+            self.assertEqual(message.get_call_id(), "strip-1")
+            self.assertIs(message.raw_message, view)
+            self.assertEqual(bytes(message.body), b"body")
+
     def test_sip_parse(self):
         message = SipMessage(message=sip_register.encode())
         if message.get_to() == '"sdasdasd"<sip:43210@127.0.0.1;transport=UDP>':
             print("YES")
         print("NO")
 
+    def test_compact_and_repeated_headers(self):
+        message = SipMessage(message=(
+            "INVITE sip:bob@127.0.0.1 SIP/2.0\r\n"
+            "v: SIP/2.0/UDP 10.0.0.1:5060;branch=z9hG4bK-2\r\n"
+            "Via: SIP/2.0/UDP 10.0.0.2:5060;branch=z9hG4bK-1\r\n"
+            "i: compact-1\r\n"
+            "l: 4\r\n"
+            "\r\n"
+            "v=0\r\n"
+        ).encode())
+        self.assertEqual(message.get_call_id(), "compact-1")
+        self.assertEqual([via.branch for via in message.get_via()], ["z9hG4bK-2", "z9hG4bK-1"])
+        self.assertEqual(bytes(message.body), b"v=0\r\n")
+
+    def test_lazy_headers(self):
+        message = SipMessage(message=sip_options.encode())
+        self.assertIsInstance(message._data["to"], str)
+        to = message.get_to()
+        self.assertIs(message.get_to(), to)
+        self.assertEqual(message["cseq"].method, "OPTIONS")
+
+    def test_export_bytes(self):
+        message = SipMessage(message=sip_options.encode())
+        exported = message.export_bytes()
+        self.assertEqual(exported, sip_options.encode())
+        self.assertIn(b"\r\nCall-ID: options-1\r\nCSeq: 1 OPTIONS\r\n", exported)
+
+    def test_uri_cache(self):
+        from Katari.sip.utils import URI, set_uri_cache_size, uri_cache_info
+        set_uri_cache_size(2)
+        uri = URI('"bob"<sip:bob@example.com:5070;transport=UDP>')
+        self.assertEqual((uri.user, uri.address, uri.port), ("bob", "example.com", "5070"))
+        URI('"bob"<sip:bob@example.com:5070;transport=UDP>')
+        info = uri_cache_info()
+        self.assertEqual((info.hits, info.misses, info.maxsize), (1, 1, 2))
+        set_uri_cache_size(1024)
+
+
+class RecordingSocket:
+
+    def __init__(self):
+        self.sent = []
+
+    def sendto(self, data, address):
+        self.sent.append((data, address))
+
+
+class DispatchTests(unittest.TestCase):
+
+    def setUp(self):
+        self.app = KatariApplication(settings=make_settings())
+        self.sock = RecordingSocket()
+        self.app.transports["UDP"] = self.sock
+
+    def test_routes_every_method(self):
+        received = []
+
+        @self.app.bye()
+        def do_bye(request, client):
+            received.append(request.get_message_type())
+
+        self.app._server_run(SipMessage(sip_options.replace("OPTIONS", "BYE").encode()), ("127.0.0.1", 5070))
+        self.assertEqual(received, ["BYE"])
+        self.assertEqual(self.sock.sent, [])
+
+    def test_unknown_method(self):
+        self.app._server_run(SipMessage(sip_options.replace("OPTIONS", "FOO").encode()), ("127.0.0.1", 5070))
+        self.assertTrue(self.sock.sent[0][0].startswith(b"SIP/2.0 501 Not Implemented"))
+
+
+class RequestContextTests(unittest.TestCase):
+
+    def test_response_leaves_on_the_receiving_socket(self):
+        from Katari.server import RequestContext
+        app = KatariApplication(settings=make_settings())
+        udp, tcp = RecordingSocket(), RecordingSocket()
+        app.transports["UDP"] = udp
+
+        @app.options()
+        def do_options(request, client):
+            self.assertEqual(client[0], "127.0.0.1")
+            app.send(request.create_response(ResponseFactory.build(200)), client)
+
+        context = RequestContext(("127.0.0.1", 5070), tcp, "TCP")
+        app._server_run(SipMessage(sip_options.replace("z9hG4bK-1", "z9hG4bK-context").encode()), context)
+        self.assertEqual(udp.sent, [])
+        self.assertEqual(tcp.sent[0][1], ("127.0.0.1", 5070))
+        self.assertFalse(hasattr(app, "client"))
+
+
+class DigestAuthTests(unittest.TestCase):
+
+    def _register(self, authorization=None):
+        message = sip_options.replace("OPTIONS sip", "REGISTER sip").replace("1 OPTIONS", "1 REGISTER")
+        if authorization:
+            message = message.replace("Content-Length", "Authorization: {}\r\nContent-Length".format(authorization))
+        return SipMessage(message.encode())
+
+    def _authorization(self, challenge, nc, password="secret", uri="sip:127.0.0.1"):
+        import hashlib
+        from Katari.auth import parse_authorization
+        nonce = parse_authorization(challenge)["nonce"]
+        ha1 = hashlib.md5("bob:katari:{}".format(password).encode()).hexdigest()
+        ha2 = hashlib.md5("REGISTER:{}".format(uri).encode()).hexdigest()
+        response = hashlib.md5("{}:{}:{}:c1:auth:{}".format(ha1, nonce, nc, ha2).encode()).hexdigest()
+        return ('Digest username="bob", realm="katari", nonce="{}", uri="{}", response="{}", '
+                'algorithm=MD5, qop=auth, nc={}, cnonce="c1"'.format(nonce, uri, response, nc))
+
+    def test_challenge_and_verify(self):
+        from Katari.errors import StopProcessing
+        from Katari.middleware.auth import DigestAuthMiddleware
+        middleware = DigestAuthMiddleware(make_settings(AUTH={"REALM": "katari", "USERS": {"bob": "secret"}}))
+        with self.assertRaises(StopProcessing) as stop:
+            middleware.process_request(self._register(), ("127.0.0.1", 5070))
+        response = stop.exception.response
+        self.assertTrue(response.method_line.startswith("SIP/2.0 401"))
+        challenge = response.get_header_values("www-authenticate")[0]
+        self.assertIn(b"WWW-Authenticate: Digest realm=\"katari\"", response.export_bytes())
+
+        request, _ = middleware.process_request(self._register(self._authorization(challenge, "00000001")), None)
+        self.assertEqual(request.auth_user, "bob")
+        # Replayed nonce count, then a wrong password
+        for authorization in (self._authorization(challenge, "00000001"),
+                              self._authorization(challenge, "00000002", "guess")):
+            with self.assertRaises(StopProcessing):
+                middleware.process_request(self._register(authorization), None)
+        request, _ = middleware.process_request(self._register(self._authorization(challenge, "00000002")), None)
+        self.assertEqual(request.auth_user, "bob")
+        self.assertEqual(middleware.authenticator.ha1.cache_info().misses, 1)
+
+    def test_qop_and_uri_required(self):
+        import hashlib
+        from Katari.auth import DigestAuthenticator, DictCredentialStore, INVALID, VALID
+        authenticator = DigestAuthenticator("katari", DictCredentialStore({"bob": "secret"}))
+        challenge = authenticator.challenge()
+        nonce = challenge.split('nonce="')[1].split('"')[0]
+        ha1 = hashlib.md5(b"bob:katari:secret").hexdigest()
+        ha2 = hashlib.md5(b"REGISTER:sip:127.0.0.1").hexdigest()
+        response = hashlib.md5("{}:{}:{}".format(ha1, nonce, ha2).encode()).hexdigest()
+        # RFC 2069 style, no qop so no nonce count to stop a replay
+        legacy = 'Digest username="bob", realm="katari", nonce="{}", uri="sip:127.0.0.1", response="{}"'.format(
+            nonce, response)
+        for _ in range(2):
+            self.assertEqual(authenticator.verify(self._register(legacy))[0], INVALID)
+        # Valid for the uri the client hashed, which isn't the Request-URI
+        other = self._authorization(challenge, "00000001", uri="sip:127.0.0.2")
+        self.assertEqual(authenticator.verify(self._register(other))[0], INVALID)
+        self.assertEqual(authenticator.verify(self._register(self._authorization(challenge, "00000001")))[0], VALID)
+
+    def test_stale_nonce(self):
+        import time
+        from Katari.auth import DigestAuthenticator, DictCredentialStore, STALE, INVALID
+        authenticator = DigestAuthenticator("katari", DictCredentialStore({"bob": "secret"}), lifetime=60)
+        challenge = 'Digest nonce="{}"'.format(authenticator.nonces.issue(time.time() - 120))
+        request = self._register(self._authorization(challenge, "00000001"))
+        self.assertEqual(authenticator.verify(request)[0], STALE)
+        forged = 'Digest nonce="{}"'.format(authenticator.nonces.issue()[:-2] + "AA")
+        self.assertEqual(authenticator.verify(self._register(self._authorization(forged, "00000001")))[0], INVALID)
+
+    def test_nonce_bound_to_worker(self):
+        from Katari.auth import DigestAuthenticator, DictCredentialStore, STALE, VALID
+        authenticator = DigestAuthenticator("katari", DictCredentialStore({"bob": "secret"}))
+        request = self._register(self._authorization(authenticator.challenge(), "00000001"))
+        pid = os.fork()
+        if pid == 0:
+            # A worker that never saw the count, the replay must not get through
+            os._exit(0 if authenticator.verify(request)[0] == STALE else 1)
+        _, status = os.waitpid(pid, 0)
+        self.assertEqual(os.waitstatus_to_exitcode(status), 0)
+        self.assertEqual(authenticator.verify(request)[0], VALID)
+
+
+class FastPathTests(unittest.TestCase):
+
+    def test_options_and_keepalive(self):
+        from Katari.server.fastpath import FastPath
+        ResponseFactory.configure(user_agent="Katari Test", allow=["INVITE", "OPTIONS"])
+        try:
+            fast_path = FastPath(options=True)
+            sock = RecordingSocket()
+            self.assertTrue(fast_path.handle(b"\r\n\r\n", sock, ("127.0.0.1", 5070)))
+            self.assertTrue(fast_path.handle(sip_options.encode(), sock, ("127.0.0.1", 5070)))
+            self.assertFalse(fast_path.handle(sip_options.replace("OPTIONS", "INVITE").encode(), sock, ("127.0.0.1", 5070)))
+            self.assertFalse(FastPath().handle(sip_options.encode(), sock, ("127.0.0.1", 5070)))
+        finally:
+            ResponseFactory.configure()
+        self.assertEqual(fast_path.stats(), {"options": 1, "keepalives": 1})
+        data, address = sock.sent[0]
+        self.assertEqual(len(sock.sent), 1)
+        self.assertTrue(data.startswith(b"SIP/2.0 200 OK\r\nServer: Katari Test\r\nAllow: INVITE, OPTIONS\r\n"))
+        response = SipMessage(data)
+        self.assertEqual(response.get_call_id(), "options-1")
+        self.assertEqual(response.get_cseq().method, "OPTIONS")
+        self.assertIsNotNone(response.get_to().tag)
+
+
+    def test_exported_with_metrics(self):
+        app = KatariApplication(settings=make_settings(
+            FAST_PATH={"OPTIONS": True}, METRICS={"ENABLED": True, "PORT": 0}
+        ))
+        app.fast_path.handle(b"\r\n\r\n", RecordingSocket(), ("127.0.0.1", 5070))
+        text = app.metrics.render()
+        self.assertIn('katari_fast_path_total{kind="keepalive"} 1\n', text)
+        self.assertIn('katari_fast_path_total{kind="options"} 0\n', text)
+
+class AccessListTests(unittest.TestCase):
+
+    def test_cidr_and_deny(self):
+        from Katari.server.acl import AccessList
+        acl = AccessList(["127.0.0.1", "10.0.0.0/8", "10.1.0.0/16", "11.0.0.0/8", "2001:db8::/32", "pbx.example.com"],
+                         ["10.66.0.0/16", "2001:db8::1"])
+        self.assertEqual(len(acl._rules[0].intervals[4][0]), 2)
+        allowed = ["127.0.0.1", "10.0.0.1", "11.255.255.255", "2001:db8::2", "::ffff:10.1.2.3", "pbx.example.com"]
+        refused = ["127.0.0.2", "10.66.1.1", "12.0.0.0", "2001:db8::1", "2001:db9::", "other.example.com"]
+        for address in allowed:
+            self.assertTrue(acl.allows(address), address)
+        for address in refused:
+            self.assertFalse(acl.allows(address), address)
+        self.assertTrue(AccessList().allows("192.0.2.1"))
+        acl.reload(["192.0.2.0/24"])
+        self.assertTrue(acl.allows("192.0.2.1"))
+        self.assertFalse(acl.allows("10.0.0.1"))
+
+    def test_recompiled_when_settings_change(self):
+        previous = UDPSipServer.settings
+        try:
+            UDPSipServer.settings = make_settings(ALLOWED_HOSTS=["10.0.0.0/8"])
+            self.assertTrue(UDPSipServer.check_allowed("10.1.2.3"))
+            UDPSipServer.settings = make_settings(ALLOWED_HOSTS=["192.0.2.0/24"])
+            self.assertFalse(UDPSipServer.check_allowed("10.1.2.3"))
+            self.assertTrue(UDPSipServer.check_allowed("192.0.2.1"))
+        finally:
+            UDPSipServer.settings = previous
+
+
+class AdmissionTests(unittest.TestCase):
+
+    def test_overload_answered_with_503(self):
+        from Katari.server import RequestContext
+        app = KatariApplication(settings=make_settings(ADMISSION={"MAX_IN_FLIGHT": 1, "RETRY_AFTER": 7}))
+        sock = RecordingSocket()
+        context = RequestContext(("127.0.0.1", 5070), sock)
+        datagram = sip_options.encode()
+        self.assertTrue(app.admit(datagram, context))
+        self.assertFalse(app.admit(datagram, context))
+        self.assertFalse(app.admit(datagram.replace(b"OPTIONS sip", b"ACK sip"), context))
+        app.admission.release()
+        self.assertTrue(app.admit(datagram, context))
+        self.assertEqual(len(sock.sent), 1)
+        response = SipMessage(sock.sent[0][0])
+        self.assertTrue(response.method_line.startswith("SIP/2.0 503"))
+        self.assertIn(b"Retry-After: 7\r\n", sock.sent[0][0])
+        self.assertEqual(response.get_call_id(), "options-1")
+        self.assertIsNotNone(response.get_to().tag)
+        self.assertEqual(app.admission.stats()["shed_overload"], 2)
+
+    def test_slot_held_until_async_handler_done(self):
+        from Katari.server import RequestContext
+        app = KatariApplication(settings=make_settings(ADMISSION={"MAX_IN_FLIGHT": 4}))
+        sock = RecordingSocket()
+        app.transports["UDP"] = sock
+        context = RequestContext(("127.0.0.1", 5070), sock)
+
+        async def run():
+            answer = asyncio.Event()
+
+            @app.options()
+            async def do_options(request, client):
+                await answer.wait()
+                app.send(request.create_response(ResponseFactory.build(200)), client)
+
+            datagram = sip_options.replace("z9hG4bK-1", "z9hG4bK-slot").encode()
+            self.assertTrue(app.admit(datagram, context))
+            app._run_admitted(datagram, context)
+            self.assertEqual(app.admission.in_flight, 1)
+            answer.set()
+            for _ in range(10):
+                await asyncio.sleep(0)
+            return app.admission.in_flight
+
+        self.assertEqual(asyncio.run(run()), 0)
+        self.assertEqual(len(sock.sent), 1)
+
+        def fail(message, client):
+            raise ValueError("unparseable")
+
+        app._server_run = fail
+        self.assertTrue(app.admit(b"OPTIONS", context))
+        with self.assertRaises(ValueError):
+            app._run_admitted(b"OPTIONS", context)
+        self.assertEqual(app.admission.in_flight, 0)
+
+    def test_slot_closed_once_freed(self):
+        from Katari.server.admission import AdmissionControl
+        admission = AdmissionControl(max_in_flight=4)
+        self.assertTrue(admission.admit(b"OPTIONS", ("127.0.0.1", 5070)))
+        slot = admission.slot()
+        slot.done()
+        self.assertEqual(admission.in_flight, 0)
+        # A task scheduled after the message finished must not free it again
+        slot.hold()
+        slot.done()
+        slot.done()
+        self.assertTrue(slot.closed)
+        self.assertEqual(admission.in_flight, 0)
+
+    def test_exported_with_metrics(self):
+        app = KatariApplication(settings=make_settings(
+            ADMISSION={"MAX_IN_FLIGHT": 64}, METRICS={"ENABLED": True, "PORT": 0}
+        ))
+        text = app.metrics.render()
+        self.assertIn("katari_admission_in_flight 0\n", text)
+        self.assertIn("katari_admission_max_in_flight 64\n", text)
+        self.assertIn('katari_admission_shed_total{reason="overload"}', text)
+
+    def test_rate_limiter(self):
+        from Katari.server.admission import RateLimiter
+        limiter = RateLimiter(rate=10, burst=2)
+        self.assertEqual([limiter.allow("10.0.0.1", 0.0) for _ in range(3)], [True, True, False])
+        self.assertTrue(limiter.allow("10.0.0.2", 0.0))
+        self.assertFalse(limiter.allow("10.0.0.1", 0.05))
+        self.assertTrue(limiter.allow("10.0.0.1", 0.2))
+
+    def test_rate_limiter_bounded(self):
+        from Katari.server.admission import RateLimiter
+        limiter = RateLimiter(rate=1, burst=1, max_sources=2)
+        self.assertTrue(limiter.allow("10.0.0.1", 0.0))
+        self.assertTrue(limiter.allow("10.0.0.2", 0.0))
+        self.assertFalse(limiter.allow("10.0.0.1", 0.1))
+        # None of the buckets has refilled, the least recently seen goes
+        self.assertTrue(limiter.allow("10.0.0.3", 0.1))
+        self.assertEqual(len(limiter), 2)
+        self.assertFalse(limiter.allow("10.0.0.1", 0.2))
+        self.assertTrue(limiter.allow("10.0.0.2", 0.2))
+
+
+class MiddlewareTests(unittest.TestCase):
+
+    def setUp(self):
+        self.app = KatariApplication(settings=make_settings())
+        self.sock = RecordingSocket()
+        self.app.transports["UDP"] = self.sock
+        self.handled = []
+
+        @self.app.options()
+        def do_options(request, client):
+            self.handled.append(request.get_call_id())
+            self.app.send(request.create_response(ResponseFactory.build(200)), client)
+
+    def _load(self, *middleware, timing=False):
+        from Katari.middleware import MiddlewareChain
+        self.app.middleware = MiddlewareChain(middleware, timing=timing)
+
+    def test_short_circuit_and_timing(self):
+        from Katari.errors import StopProcessing
+        from Katari.interfaces import MiddlewareInterface
+
+        class Reject(MiddlewareInterface):
+            def process_request(self, message, client):
+                if message.get_call_id() == "options-1":
+                    raise StopProcessing(message.create_response(ResponseFactory.build(403)))
+                return message, client
+
+        class Drop(MiddlewareInterface):
+            def process_request(self, message, client):
+                return None if message.get_call_id() == "options-2" else (message, client)
+
+        self._load(Reject(), Drop(), timing=True)
+        self.assertEqual(self.app.middleware.response_hooks, [])
+        for call_id in ("options-1", "options-2", "options-3"):
+            message = SipMessage(sip_options.replace("options-1", call_id).replace("z9hG4bK-1", "z9hG4bK-" + call_id).encode())
+            self.app._server_run(message, ("127.0.0.1", 5070))
+        self.assertEqual(self.handled, ["options-3"])
+        self.assertEqual([data[:11] for data, _ in self.sock.sent], [b"SIP/2.0 403", b"SIP/2.0 200"])
+        timings = self.app.middleware_timings()
+        self.assertEqual(timings["Reject.process_request"]["calls"], 3)
+        self.assertEqual(timings["Drop.process_request"]["calls"], 2)
+
+    def test_async_hook(self):
+        from Katari.interfaces import MiddlewareInterface
+
+        class Lookup(MiddlewareInterface):
+            async def process_request(self, message, client):
+                await asyncio.sleep(0)
+                message.looked_up = True
+                return message, client
+
+        self._load(Lookup())
+        self.app._server_run(SipMessage(sip_options.encode()), ("127.0.0.1", 5070))
+        self.assertEqual(self.handled, ["options-1"])
+        self.assertTrue(self.sock.sent[0][0].startswith(b"SIP/2.0 200"))
+
+
+class LoggingTests(unittest.TestCase):
+
+    def test_queued_logging_honours_level(self):
+        import logging
+        from Katari.logging import KatariLogging
+        log = KatariLogging(output_mode="stdout", level="WARNING", queued=True)
+        try:
+            self.assertFalse(log.get_logger().isEnabledFor(logging.INFO))
+            self.assertIsNotNone(log.listener)
+        finally:
+            log.stop()
+            log.get_logger().removeHandler(log.queue_handler)
+
+    def test_access_log_formats(self):
+        import os
+        import tempfile
+        from Katari.logging import AccessLog, read_access_log
+        request = SipMessage(sip_options.encode())
+        response = request.create_response(ResponseFactory.build(200))
+        for format_ in ("json", "binary"):
+            path = os.path.join(tempfile.mkdtemp(), "access.log")
+            log = AccessLog(path, format_)
+            log.record("in", request, ("127.0.0.1", 5070), "UDP")
+            log.record("out", response, ("::1", 5070), "UDP", 120)
+            log.stop()
+            records = list(read_access_log(path, format_))
+            self.assertEqual([(r["direction"], r["host"], r["method"], r["status"]) for r in records],
+                             [("in", "127.0.0.1", "OPTIONS", 0), ("out", "::1", "OPTIONS", 200)])
+            self.assertEqual(records[1]["size"], 120)
+            self.assertEqual(records[0]["call_id"], "options-1")
+
+
+class MetricsTests(unittest.TestCase):
+
+    def test_shards_are_summed(self):
+        from Katari.metrics import Metrics
+        metrics = Metrics()
+        labels = (("method", "OPTIONS"),)
+
+        def count():
+            for _ in range(1000):
+                metrics.inc("katari_messages_received_total", labels)
+            metrics.observe("katari_handler_seconds", labels, 0.003)
+
+        threads = [threading.Thread(target=count) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        count()
+        self.assertEqual(metrics.get("katari_messages_received_total", labels), 5000)
+        text = metrics.render()
+        self.assertIn('katari_handler_seconds_bucket{method="OPTIONS",le="0.0025"} 0\n', text)
+        self.assertIn('katari_handler_seconds_bucket{method="OPTIONS",le="0.005"} 5\n', text)
+        self.assertIn('katari_handler_seconds_count{method="OPTIONS"} 5\n', text)
+
+    def test_short_lived_threads_reuse_shards(self):
+        from Katari.metrics import Metrics
+        metrics = Metrics()
+        for _ in range(50):
+            thread = threading.Thread(target=metrics.inc, args=("katari_messages_received_total",))
+            thread.start()
+            thread.join()
+        self.assertEqual(metrics.get("katari_messages_received_total"), 50)
+        self.assertEqual(len(metrics._shards), 1)
+
+    def test_application_endpoint(self):
+        import urllib.request
+        app = KatariApplication(settings=make_settings(METRICS={"ENABLED": True, "PORT": 0}))
+        app.transports["UDP"] = RecordingSocket()
+
+        @app.options()
+        def do_options(request, client):
+            app.send(request.create_response(ResponseFactory.build(200)), client)
+
+        before = app.metrics.get("katari_responses_sent_total", (("status", "200"),))
+        app._server_run(SipMessage(sip_options.replace("z9hG4bK-1", "z9hG4bK-metrics").encode()), ("127.0.0.1", 5070))
+        self.assertEqual(app.metrics.get("katari_responses_sent_total", (("status", "200"),)), before + 1)
+        app.start_metrics()
+        try:
+            address = app.metrics_server.server_address
+            body = urllib.request.urlopen("http://{}:{}/metrics".format(*address[:2]), timeout=5).read().decode()
+        finally:
+            app.metrics_server.shutdown()
+            app.metrics_server.server_close()
+        self.assertIn('katari_messages_received_total{method="OPTIONS"}', body)
+        self.assertIn("# TYPE katari_transactions gauge", body)
+
+
+class ProfilingTests(unittest.TestCase):
+
+    def test_collapsed_stacks(self):
+        import os
+        import time
+        import tempfile
+        from Katari.profiling import SamplingProfiler, profile_settings
+        directory = tempfile.mkdtemp()
+        stop = threading.Event()
+
+        def busy_handler():
+            while not stop.is_set():
+                sum(range(1000))
+
+        worker = threading.Thread(target=busy_handler)
+        worker.start()
+        profiler = SamplingProfiler(directory, interval=0.001).start()
+        time.sleep(0.2)
+        profiler.stop()
+        stop.set()
+        worker.join()
+        self.assertEqual(len(profiler.files), 1)
+        with open(profiler.files[0]) as profile:
+            lines = profile.read().splitlines()
+        self.assertTrue(any("test.py:busy_handler" in line for line in lines))
+        stack, count = lines[0].rsplit(" ", 1)
+        self.assertGreater(int(count), 0)
+        self.assertEqual(os.listdir(directory), [os.path.basename(profiler.files[0])])
+        self.assertEqual(profile_settings(make_settings(), {"DIRECTORY": directory})["DIRECTORY"], directory)
+        self.assertIsNone(profile_settings(make_settings()))
+
+    def test_blocked_handler_sampled_idle_worker_not(self):
+        import time
+        import tempfile
+        from concurrent.futures import ThreadPoolExecutor
+        from Katari.profiling import SamplingProfiler
+        release = threading.Event()
+
+        def blocked_handler():
+            release.wait()
+
+        executor = ThreadPoolExecutor(2)
+        executor.submit(blocked_handler)
+        # The second worker has nothing to do and waits in the pool's queue
+        executor.submit(int).result()
+        profiler = SamplingProfiler(tempfile.mkdtemp(), interval=0.001)
+        for _ in range(20):
+            profiler.sample()
+            time.sleep(0.001)
+        release.set()
+        executor.shutdown()
+        stacks = profiler.collapsed().splitlines()
+        blocked = [stack for stack in stacks if "test.py:blocked_handler" in stack]
+        self.assertTrue(blocked)
+        self.assertTrue(all(stack.split(" ")[0].endswith("threading.py:wait") for stack in blocked))
+        self.assertFalse([stack for stack in stacks if "thread.py:_worker" in stack and stack not in blocked])
+
+
+class TransactionTests(unittest.TestCase):
+
+    def setUp(self):
+        from Katari.sip.transaction import TransactionLayer
+        self.app = KatariApplication(settings=make_settings())
+        self.app.transactions = TransactionLayer(t1=0.01, t2=0.04, t4=0.05)
+        self.sock = RecordingSocket()
+        self.app.transports["UDP"] = self.sock
+        self.calls = 0
+
+    def test_retransmission_absorbed(self):
+        @self.app.options()
+        def do_options(request, client):
+            self.calls += 1
+            self.app.send(request.create_response(ResponseFactory.build(200)), client)
+
+        for _ in range(3):
+            self.app._server_run(SipMessage(sip_options.encode()), ("127.0.0.1", 5070))
+        self.assertEqual(self.calls, 1)
+        self.assertEqual(len(self.sock.sent), 3)
+        self.assertEqual(self.app.transactions.absorbed, 2)
+
+    def test_invite_failure_retransmitted_until_ack(self):
+        import time
+        invite = sip_options.replace("OPTIONS", "INVITE")
+
+        @self.app.invite()
+        def do_invite(request, client):
+            self.app.send(request.create_response(ResponseFactory.build(486)), client)
+
+        self.app._server_run(SipMessage(invite.encode()), ("127.0.0.1", 5070))
+        time.sleep(0.1)
+        self.assertGreater(len(self.sock.sent), 1)
+        self.app._server_run(SipMessage(invite.replace("CSeq: 1 INVITE", "CSeq: 1 ACK").replace("INVITE sip", "ACK sip").encode()), ("127.0.0.1", 5070))
+        sent = len(self.sock.sent)
+        time.sleep(0.2)
+        self.assertEqual(len(self.sock.sent), sent)
+        self.assertEqual(len(self.app.transactions), 0)
+
+
+    def test_matched_on_sent_by_with_layer_timers(self):
+        @self.app.options()
+        def do_options(request, client):
+            self.calls += 1
+            self.app.send(request.create_response(ResponseFactory.build(200)), client)
+
+        self.app._server_run(SipMessage(sip_options.encode()), ("127.0.0.1", 5070))
+        # Same branch from another sent-by is a different transaction
+        other = sip_options.replace("SIP/2.0/UDP 127.0.0.1:5070", "SIP/2.0/UDP 127.0.0.2:5070")
+        self.assertNotEqual(other, sip_options)
+        self.app._server_run(SipMessage(other.encode()), ("127.0.0.2", 5070))
+        self.assertEqual(self.calls, 2)
+        transaction = next(iter(self.app.transactions.transactions.values()))
+        self.assertEqual((transaction.interval, transaction.t2), (0.01, 0.04))
+
+class ResponseTests(unittest.TestCase):
+
+    def test_factory_covers_status_codes(self):
+        from Katari.sip.response import STATUS_CODES
+        for code, reason in STATUS_CODES.items():
+            response = ResponseFactory.build(code)
+            self.assertTrue(response.export_bytes().startswith(
+                "SIP/2.0 {} {}\r\n".format(code, reason).encode()))
+
+    def test_create_response_copies_dialog_headers(self):
+        ResponseFactory.configure(user_agent="Katari Test")
+        request = SipMessage(message=sip_options.encode())
+        response = request.create_response(ResponseFactory.build(404)).export_bytes()
+        self.assertTrue(response.startswith(b"SIP/2.0 404 Not Found\r\nServer: Katari Test\r\n"))
+        self.assertIn(b"Call-ID: options-1\r\nCSeq: 1 OPTIONS\r\nContent-Length: 0\r\n\r\n", response)
+        ResponseFactory.configure()
+
+    def test_unhandled_response_not_answered(self):
+        app = KatariApplication(settings=make_settings())
+        sock = RecordingSocket()
+        app.transports["UDP"] = sock
+        response = SipMessage(sip_options.encode()).create_response(ResponseFactory.build(200)).export_bytes()
+        app._server_run(SipMessage(response), ("127.0.0.1", 5070))
+        self.assertEqual(sock.sent, [])
+
+
+class RegistrarTests(unittest.TestCase):
+
+    def _register(self, cseq, contact, expires=3600):
+        return SipMessage(sip_options.replace("OPTIONS sip", "REGISTER sip")
+                          .replace("1 OPTIONS", "{} REGISTER".format(cseq))
+                          .replace("To: <sip:127.0.0.1>", "To: <sip:bob@127.0.0.1>")
+                          .replace("Content-Length", "Contact: {}\r\nExpires: {}\r\nContent-Length".format(contact, expires))
+                          .encode())
+
+    def test_register_lookup_and_unregister(self):
+        app = KatariApplication(settings=make_settings(KATARI_MIDDLEWARE=["Katari.middleware.registrar"]))
+        request, _ = app.run_middleware_request(self._register(1, "<sip:bob@10.0.0.2>, <sip:bob@10.0.0.3>;q=0.5"), None)
+        registrar = app.middleware_array[0].registrar
+        self.assertIn(b"Contact: <sip:bob@10.0.0.2>;expires=3600\r\n", request.registration.export_bytes())
+        self.assertEqual([b.uri for b in registrar.lookup("sip:bob@127.0.0.1")], ["sip:bob@10.0.0.2", "sip:bob@10.0.0.3"])
+        self.assertEqual(len(registrar.lookup_call_id("options-1")), 2)
+        # Replayed CSeq doesn't touch the bindings
+        registrar.register(self._register(1, "<sip:bob@10.0.0.2>", 0))
+        self.assertEqual(len(registrar.lookup("sip:bob@127.0.0.1")), 2)
+        self.assertTrue(registrar.register(self._register(2, "<sip:bob@10.0.0.2>", 5)).export_bytes().startswith(b"SIP/2.0 423"))
+        registrar.register(self._register(3, "*", 0))
+        self.assertEqual(registrar.lookup("sip:bob@127.0.0.1"), [])
+        self.assertEqual(len(registrar), 0)
+
+    def test_expiry_and_snapshot(self):
+        import os
+        import time
+        import tempfile
+        from Katari.registrar import Registrar
+        registrar = Registrar()
+        for i in range(100):
+            registrar.add("sip:{}@example.com".format(i), "<sip:{}@10.0.0.2>".format(i), "call-{}".format(i), 1, 60 + i)
+        registrar.add("sip:0@example.com", "<sip:0@10.0.0.2>", "call-0", 2, 3600)
+        path = os.path.join(tempfile.mkdtemp(), "bindings")
+        self.assertEqual(registrar.snapshot(path), 100)
+        restored = Registrar()
+        self.assertEqual(restored.restore(path), 100)
+        self.assertEqual(restored.lookup("sip:5@example.com")[0].call_id, "call-5")
+        self.assertEqual(restored.expire(time.time() + 120), 60)
+        self.assertEqual(len(restored), 40)
+        self.assertEqual(len(restored.lookup("sip:0@example.com")), 1)
+        os.remove(path)
+
+    def test_snapshots_per_worker(self):
+        import time
+        import tempfile
+        from Katari import registrar
+        from Katari.server import WorkerSupervisor
+        directory = tempfile.mkdtemp()
+        path = os.path.join(directory, "bindings")
+        previous, registrar._registrar = registrar._registrar, None
+        try:
+            shared = registrar.get_registrar(make_settings(REGISTRAR={"SNAPSHOT": path, "SNAPSHOT_INTERVAL": 60}))
+
+            def serve():
+                registrar.start_snapshots()
+                index = registrar.snapshot_path("{worker}")
+                shared.add("sip:{}@example.com".format(index), "<sip:{}@10.0.0.2>".format(index), "call", 1, 3600)
+                open(os.path.join(directory, "ready-" + index), "w").close()
+                time.sleep(60)
+
+            supervise(WorkerSupervisor(serve, 2), lambda: len(os.listdir(directory)) >= 2)
+            # Nothing snapshots in the supervisor, each worker wrote its own bindings on SIGTERM
+            self.assertIsNone(shared._snapshot_pid)
+            self.assertFalse(os.path.exists(path))
+            for index in ("0", "1"):
+                restored = registrar.Registrar()
+                self.assertEqual(restored.restore("{}.{}".format(path, index)), 1)
+                self.assertEqual(len(restored.lookup("sip:{}@example.com".format(index))), 1)
+        finally:
+            registrar._registrar = previous
+            shutil.rmtree(directory, ignore_errors=True)
+
+
+class AsyncServerTests(unittest.TestCase):
+
+    def _exchange(self, app, datagram):
+        from Katari.server.udp import AsyncUDPSipServer
+        probe = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        probe.bind(("127.0.0.1", 0))
+        address = probe.getsockname()
+        probe.close()
+        threading.Thread(
+            target=asyncio.run, args=(AsyncUDPSipServer.serve(address, app),), daemon=True
+        ).start()
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.settimeout(0.2)
+        try:
+            for _ in range(25):
+                sock.sendto(datagram, address)
+                try:
+                    return sock.recv(65535)
+                except socket.timeout:
+                    continue
+        finally:
+            sock.close()
+
+    def test_async_handler(self):
+        app = KatariApplication(settings=make_settings(SERVER_MODE="asyncio"))
+
+        @app.options()
+        async def do_options(request, client):
+            app.send(request.create_response(ResponseFactory.build(200)), client)
+
+        response = self._exchange(app, sip_options.encode())
+        self.assertTrue(response.startswith(b"SIP/2.0 200 OK"))
+
+
+class BatchServerTests(unittest.TestCase):
+
+    def test_batch_round_trip(self):
+        from Katari.server.udp import BatchUDPSipServer
+        UDPSipServer.settings = make_settings()
+        app = KatariApplication(settings=make_settings(SERVER_MODE="batch"))
+
+        @app.options()
+        def do_options(request, client):
+            app.send(request.create_response(ResponseFactory.build(200)), client)
+
+        server = BatchUDPSipServer.bind(("127.0.0.1", 0))
+        threading.Thread(target=BatchUDPSipServer.serve, args=(server, app), daemon=True).start()
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.settimeout(2)
+        try:
+            for i in range(10):
+                datagram = sip_options.replace("options-1", "options-{}".format(i)).replace("z9hG4bK-1", "z9hG4bK-b{}".format(i))
+                sock.sendto(datagram.encode(), server.getsockname())
+            responses = sorted(sock.recv(65535).split(b"Call-ID: ")[1].split(b"\r\n")[0] for _ in range(10))
+        finally:
+            sock.close()
+        self.assertEqual(responses, sorted("options-{}".format(i).encode() for i in range(10)))
+
+
+class TCPServerTests(unittest.TestCase):
+
+    def test_stream_framing(self):
+        from Katari.server.tcp import TCPSipServer
+        UDPSipServer.settings = make_settings()
+        app = KatariApplication(settings=make_settings())
+        bodies = []
+
+        @app.message()
+        def do_message(request, client):
+            bodies.append(bytes(request.body))
+            app.send(request.create_response(ResponseFactory.build(200)), client)
+
+        started = threading.Event()
+        address = []
+
+        def ready(server):
+            address.append(server.sockets[0].getsockname())
+            started.set()
+
+        threading.Thread(
+            target=asyncio.run, args=(TCPSipServer.serve(("127.0.0.1", 0), app, ready=ready),), daemon=True
+        ).start()
+        self.assertTrue(started.wait(2))
+        request = sip_options.replace("OPTIONS", "MESSAGE").replace("UDP", "TCP")
+        first = request.replace("Content-Length: 0", "Content-Length: 5") + "hello"
+        second = request.replace("z9hG4bK-1", "z9hG4bK-2").replace("Content-Length: 0", "Content-Length: 3") + "bye"
+        data = ("\r\n\r\n" + first + second).encode()
+        sock = socket.create_connection(address[0], timeout=2)
+        try:
+            sock.sendall(data[:40])
+            sock.sendall(data[40:])
+            received = b""
+            while received.count(b"SIP/2.0 200 OK") < 2:
+                received += sock.recv(65535)
+        finally:
+            sock.close()
+        self.assertTrue(received.startswith(b"\r\nSIP/2.0 200 OK"))
+        self.assertEqual(bodies, [b"hello", b"bye"])
+
+
+class TLSServerTests(unittest.TestCase):
+
+    @unittest.skipUnless(shutil.which("openssl"), "openssl is needed to create a test certificate")
+    def test_outbound_pool_resumes_sessions(self):
+        import os
+        import time
+        import tempfile
+        import subprocess
+        from Katari.server.tls import TLSSipServer
+        directory = tempfile.mkdtemp()
+        cert, key = os.path.join(directory, "cert.pem"), os.path.join(directory, "key.pem")
+        subprocess.run(
+            ["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-keyout", key, "-out", cert,
+             "-days", "1", "-subj", "/CN=localhost", "-addext", "subjectAltName=IP:127.0.0.1"],
+            check=True, capture_output=True,
+        )
+        tls_settings = make_settings(TLS=True, TLS_CERTFILE=cert, TLS_KEYFILE=key, TLS_CAFILE=cert)
+        UDPSipServer.settings = tls_settings
+        app = KatariApplication(settings=tls_settings)
+        responses = []
+
+        @app.options()
+        def do_options(request, client):
+            app.send(request.create_response(ResponseFactory.build(200)), client)
+
+        @app.status_response()
+        def do_response(response, client):
+            responses.append(response.method_line)
+
+        started = threading.Event()
+        address = []
+
+        def ready(server):
+            address.append(server.sockets[0].getsockname())
+            started.set()
+
+        threading.Thread(
+            target=asyncio.run, args=(TLSSipServer.serve(("127.0.0.1", 0), app, ready=ready),), daemon=True
+        ).start()
+        self.assertTrue(started.wait(2))
+        # The application sends to itself, the response comes back on the outbound connection
+        pool = app.transports["TLS"]
+        for i in range(2):
+            request = sip_options.replace("UDP", "TLS").replace("z9hG4bK-1", "z9hG4bK-tls{}".format(i))
+            pool.sendto(request.encode(), address[0])
+            for _ in range(100):
+                if len(responses) > i:
+                    break
+                time.sleep(0.02)
+            for protocol in list(pool.connections.values()):
+                pool.loop.call_soon_threadsafe(protocol.transport.close)
+            for _ in range(100):
+                if not pool.connections:
+                    break
+                time.sleep(0.02)
+        self.assertEqual(responses, ["SIP/2.0 200 OK\r\n"] * 2)
+        self.assertEqual(pool.handshakes, 4)
+        self.assertEqual(pool.resumed, 2)
+
+
+class ClientTests(unittest.TestCase):
+
+    def test_client_transactions(self):
+        from Katari.client import KatariSIPClient
+        from Katari.server.udp import AsyncUDPSipServer
+        UDPSipServer.settings = make_settings()
+        app = KatariApplication(settings=make_settings())
+
+        @app.options()
+        def do_options(request, client):
+            app.send(request.create_response(ResponseFactory.build(200)), client)
+
+        @app.invite()
+        def do_invite(request, client):
+            app.send(request.create_response(ResponseFactory.build(180)), client)
+            app.send(request.create_response(ResponseFactory.build(486)), client)
+
+        probe = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        probe.bind(("127.0.0.1", 0))
+        address = probe.getsockname()
+        probe.close()
+        threading.Thread(
+            target=asyncio.run, args=(AsyncUDPSipServer.serve(address, app),), daemon=True
+        ).start()
+
+        async def run():
+            async with KatariSIPClient(("127.0.0.1", 0)) as client:
+                for _ in range(25):
+                    try:
+                        await client.options(address, timeout=0.2)
+                        break
+                    except asyncio.TimeoutError:
+                        continue
+                ringing = []
+                busy = await client.invite(address, "sip:1000@127.0.0.1", on_provisional=ringing.append)
+                responses = await asyncio.gather(*(client.options(address) for _ in range(500)))
+                return busy, ringing, responses
+
+        busy, ringing, responses = asyncio.run(run())
+        self.assertEqual(busy.method_line, "SIP/2.0 486 Busy Here\r\n")
+        self.assertEqual(len(ringing), 1)
+        self.assertEqual(len({r.get_call_id() for r in responses}), 500)
+        self.assertTrue(all(r.method_line == "SIP/2.0 200 OK\r\n" for r in responses))
+
+
+    def test_ringing_outlasts_timer_b(self):
+        import time
+        from Katari.client import KatariSIPClient
+        from Katari.sip.response import render_prefix, fast_response
+        far_end = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        far_end.bind(("127.0.0.1", 0))
+        far_end.settimeout(2)
+
+        def ring_then_busy():
+            data, peer = far_end.recvfrom(65535)
+            far_end.sendto(fast_response(data, render_prefix(180, ())), peer)
+            # Longer than Timer B, 64 * T1
+            time.sleep(0.2)
+            far_end.sendto(fast_response(data, render_prefix(486, ())), peer)
+
+        threading.Thread(target=ring_then_busy, daemon=True).start()
+
+        async def run():
+            async with KatariSIPClient(("127.0.0.1", 0), t1=0.001) as client:
+                return await client.invite(far_end.getsockname(), "sip:1000@127.0.0.1")
+
+        try:
+            response = asyncio.run(run())
+        finally:
+            far_end.close()
+        self.assertTrue(response.method_line.startswith("SIP/2.0 486"))
+
+class DialogTests(unittest.TestCase):
+
+    def test_session_middleware(self):
+        app = KatariApplication(settings=make_settings(KATARI_MIDDLEWARE=["Katari.middleware.sessions"]))
+        app.transactions = None
+        app.transports["UDP"] = RecordingSocket()
+        seen = []
+
+        @app.invite()
+        def do_invite(request, client):
+            response = request.create_response(ResponseFactory.build(200))
+            response._data["to"] = "{};tag=uas".format(request["to"])
+            app.send(response, client)
+
+        @app.bye()
+        def do_bye(request, client):
+            seen.append(request.dialog.state)
+            app.send(request.create_response(ResponseFactory.build(200)), client)
+
+        invite = sip_options.replace("OPTIONS", "INVITE")
+        bye = invite.replace("INVITE", "BYE").replace("To: <sip:127.0.0.1>", "To: <sip:127.0.0.1>;tag=uas")
+        store = app.middleware_array[0].store
+        app._server_run(SipMessage(invite.encode()), ("127.0.0.1", 5070))
+        self.assertEqual(len(store), 1)
+        app._server_run(SipMessage(bye.encode()), ("127.0.0.1", 5070))
+        self.assertEqual(seen, ["terminated"])
+        self.assertEqual(len(store), 0)
+
+    def test_backends(self):
+        import os
+        import tempfile
+        from Katari.sip.dialog import Dialog, MemoryBackend, SQLiteBackend
+        memory = MemoryBackend(ttl=60, max_memory=Dialog("call-10", "a", "b").size() * 10)
+        for i in range(20):
+            dialog = Dialog("call-{}".format(i), "a", "b")
+            memory.set(dialog.key, dialog)
+        self.assertEqual(len(memory), 10)
+        self.assertIsNone(memory.get(Dialog("call-0", "a", "b").key))
+        self.assertEqual(memory.expire(memory.get(Dialog("call-19", "a", "b").key).last_seen + 61), 10)
+
+        import time
+        idle = MemoryBackend(ttl=60)
+        now = time.time()
+        for i in range(3):
+            dialog = Dialog("idle-{}".format(i), "a", "b", last_seen=now - 50)
+            idle.set(dialog.key, dialog)
+        # Reading idle-0 keeps it, the dialogs idle since before it still expire
+        idle.get(Dialog("idle-0", "a", "b").key)
+        self.assertEqual(idle.expire(now + 20), 2)
+        self.assertIsNotNone(idle.get(Dialog("idle-0", "a", "b").key))
+
+        path = os.path.join(tempfile.mkdtemp(), "dialogs.db")
+        first, second = SQLiteBackend(path), SQLiteBackend(path)
+        dialog = Dialog("call-1", "a", "b", data={"route": "carrier-1"})
+        first.set(dialog.key, dialog)
+        self.assertEqual(second.get(dialog.key).data, {"route": "carrier-1"})
+        second.delete(dialog.key)
+        self.assertIsNone(first.get(dialog.key))
+
+    def test_unknown_backend(self):
+        from Katari.sip import dialog
+        store, dialog._store = dialog._store, None
+        try:
+            with self.assertRaises(ValueError):
+                dialog.get_dialog_store(make_settings(DIALOGS={"BACKEND": "redis"}))
+        finally:
+            dialog._store = store
+
 
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file